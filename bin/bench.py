@@ -0,0 +1,391 @@
+"""
+Benchmarks the hot paths of the library:
+bencoding, Torrent parsing, and handling
+of tracker responses.
+
+Every corpus is synthetic and generated from
+a fixed seed, so runs are reproducible and
+comparable across revisions:
+
+    python bin/bench.py -o before.json
+    ... hack ...
+    python bin/bench.py -c before.json
+
+Each case runs in a forked child so that its
+peak memory can be measured on its own.
+"""
+
+import bt.bencode, bt.cache, bt.torrent, bt.tracker
+import os, sys, sha, time, random, tempfile, shutil
+import socket, struct, resource, optparse, json, subprocess
+
+# Minimum time spent timing each case (seconds)
+minTime = 0.5
+
+# Timed rounds per case, the best is reported
+rounds = 3
+
+################
+# Corpora
+
+def pieceHashes(numPieces):
+    """
+    A deterministic string of `numPieces'
+    20 byte hashes.
+    """
+
+    return ''.join([sha.new(str(i)).digest() for i in xrange(numPieces)])
+
+def makeTorrent(numPieces, numFiles, pieceLen = 2**18):
+    """
+    Builds a torrent dictionary with `numPieces'
+    pieces, spread over `numFiles' files (a
+    single-file torrent if `numFiles' is 1).
+    """
+
+    rand = random.Random(numPieces * 31 + numFiles)
+    total = numPieces * pieceLen
+
+    info = {
+        'name'          :   'bench-%d-%d' % (numPieces, numFiles),
+        'piece length'  :   pieceLen,
+        'pieces'        :   pieceHashes(numPieces)
+    }
+
+    if numFiles == 1:
+        info['length'] = total
+    else:
+        # Random cut points make the file sizes
+        # vary without changing the total
+        cuts = rand.sample(xrange(1, total), numFiles - 1)
+        cuts.sort()
+        cuts = [0] + cuts + [total]
+
+        files = []
+        for i in xrange(numFiles):
+            path = ['dir%03d' % (i % 100), 'file%06d.dat' % i]
+            files.append({ 'length' : long(cuts[i + 1] - cuts[i]), 'path' : path })
+        info['files'] = files
+
+    return {
+        'announce'      :   'http://tracker.example.com:6969/announce',
+        'announce-list' :   [['http://tracker.example.com:6969/announce'],
+                             ['udp://tracker.example.org:80/announce']],
+        'comment'       :   'benchmark corpus',
+        'created by'    :   'bench.py',
+        'creation date' :   1190000000L,
+        'info'          :   info
+    }
+
+def compactPeers(numPeers):
+    """
+    A deterministic compact peer list.
+    """
+
+    rand = random.Random(numPeers)
+    peers = []
+    for i in xrange(numPeers):
+        ip = struct.pack('!I', rand.randint(0x01000000, 0xdfffffff))
+        port = struct.pack('!H', rand.randint(1024, 65535))
+        peers.append(ip + port)
+    return ''.join(peers)
+
+def trackerReply(numPeers, compact = True):
+    """
+    A tracker announce response
+    carrying `numPeers' peers.
+    """
+
+    peers = compactPeers(numPeers)
+    if not compact:
+        l = []
+        for i in xrange(0, len(peers), 6):
+            l.append({
+                'peer id'   :   sha.new(peers[i:i + 6]).digest(),
+                'ip'        :   socket.inet_ntoa(peers[i:i + 4]),
+                'port'      :   struct.unpack('!H', peers[i + 4:i + 6])[0]
+            })
+        peers = l
+
+    return {
+        'interval'      :   1800,
+        'min interval'  :   900,
+        'complete'      :   numPeers / 2,
+        'incomplete'    :   numPeers - numPeers / 2,
+        'peers'         :   peers
+    }
+
+# (name, builder) of each corpus
+torrents = [
+    ('torrent-tiny',    lambda: makeTorrent(100, 1)),
+    ('torrent-medium',  lambda: makeTorrent(10000, 1000)),
+    ('torrent-huge',    lambda: makeTorrent(100000, 50000)),
+]
+
+replies = [
+    ('reply-50',        lambda: trackerReply(50)),
+    ('reply-200-dict',  lambda: trackerReply(200, False)),
+    ('reply-5000',      lambda: trackerReply(5000)),
+]
+
+peerLists = [
+    ('peers-50',        lambda: compactPeers(50)),
+    ('peers-200',       lambda: compactPeers(200)),
+    ('peers-5000',      lambda: compactPeers(5000)),
+]
+
+################
+# Cases
+
+class Corpus:
+    """
+    Builds every corpus once, keeps their
+    encoded forms, and writes the torrents
+    out to a scratch directory.
+    """
+
+    def __init__(self, skipHuge = False):
+        self.dir = tempfile.mkdtemp(prefix = 'btbench')
+        self.skipHuge = skipHuge
+        self.structs = {}
+        self.encoded = {}
+        self.paths = {}
+
+        for name, build in torrents + replies + peerLists:
+            if skipHuge and name.endswith('-huge'):
+                continue
+            val = build()
+            if isinstance(val, str):
+                self.encoded[name] = val
+                continue
+
+            self.structs[name] = val
+            self.encoded[name] = bt.bencode.encode(val)
+            if name.startswith('torrent-'):
+                path = os.path.join(self.dir, name + '.torrent')
+                fd = open(path, 'wb')
+                fd.write(self.encoded[name])
+                fd.close()
+                self.paths[name] = path
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, True)
+
+def cases(corpus):
+    """
+    Returns a list of (name, bytes, func) where
+    `bytes' is the amount of data processed by
+    a single call of `func'.
+    """
+
+    l = []
+
+    def add(name, size, func):
+        l.append((name, size, func))
+
+    for name, build in torrents + replies:
+        if name not in corpus.encoded:
+            continue
+        s = corpus.encoded[name]
+        t = corpus.structs[name]
+
+        add('decode/' + name, len(s),
+            lambda s = s: bt.bencode.decode(s))
+        add('encode/' + name, len(s),
+            lambda t = t: bt.bencode.encode(t))
+
+    for name, build in replies:
+        s = corpus.encoded[name]
+
+        def stream(s = s):
+            decoder = bt.bencode.Decoder()
+            for i in xrange(0, len(s), 1460):
+                decoder.feed(s[i:i + 1460])
+            decoder.close()
+
+        add('stream/' + name, len(s), stream)
+
+    for name, build in torrents:
+        if name not in corpus.paths:
+            continue
+        path = corpus.paths[name]
+        t = corpus.structs[name]
+        size = len(corpus.encoded[name])
+
+        add('Torrent(path)/' + name, size,
+            lambda p = path: bt.torrent.Torrent(p))
+        add('Torrent(dict)/' + name, size,
+            lambda t = t: bt.torrent.Torrent(t))
+        add('Torrent(lazy)/' + name, size,
+            lambda p = path: bt.torrent.Torrent(p, lazy = True).hash)
+        # What an announce needs
+        add('Torrent(announce)/' + name, size,
+            lambda p = path: bt.torrent.Torrent(p, lazy = True).length)
+
+        def rewrite(p = path):
+            tor = bt.torrent.Torrent(p)
+            tor.tracker = 'http://other.example.com/announce'
+            tor.toString()
+
+        add('rewrite/' + name, size, rewrite)
+
+        # Prime a cache, then time loading from it
+        cache = bt.cache.Cache(os.path.join(corpus.dir, 'cache'))
+        bt.torrent.Torrent(path, cache)
+        add('Torrent(cached)/' + name, size,
+            lambda p = path, c = cache: bt.torrent.Torrent(p, c))
+
+    for name, build in peerLists:
+        s = corpus.encoded[name]
+        add('peers/' + name, len(s),
+            lambda s = s: bt.tracker.decodeCompactPeers(s))
+
+    return l
+
+################
+# Measurement
+
+def measure(func):
+    """
+    Times `func', returning (seconds per call,
+    calls made, peak memory growth in KiB).
+    """
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Warm up, and find out how many calls
+    # fill `minTime'
+    start = time.time()
+    func()
+    once = max(time.time() - start, 1e-6)
+    calls = max(1, int(minTime / once))
+
+    best = None
+    for i in xrange(rounds):
+        start = time.time()
+        for j in xrange(calls):
+            func()
+        t = (time.time() - start) / calls
+        if best is None or t < best:
+            best = t
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    return (best, calls, peak)
+
+def runIsolated(func):
+    """
+    Runs measure(func) in a forked child.
+    """
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            res = measure(func)
+            os.write(w, json.dumps(res))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    data = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+
+    if not data:
+        raise Exception, 'Benchmark child failed'
+    return json.loads(data)
+
+def revision():
+    """
+    Returns the current git revision,
+    if there is one.
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd = here,
+                             stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE)
+        out, err = p.communicate()
+    except OSError:
+        return ''
+    return out.strip()
+
+def report(results, previous = None):
+    """
+    Prints a results table, along with the
+    speedup over `previous' if given.
+    """
+
+    header = '%-34s %12s %10s %10s %9s' % \
+        ('case', 'time/call', 'MB/s', 'calls/s', 'peak KiB')
+    if previous:
+        header += ' %8s' % 'speedup'
+    print header
+    print '-' * len(header)
+
+    for name in sorted(results):
+        r = results[name]
+        line = '%-34s %10.3fms %10.2f %10.1f %9d' % \
+            (name, r['seconds'] * 1000, r['mbps'], 1.0 / r['seconds'], r['peakKiB'])
+        if previous:
+            if name in previous:
+                line += ' %7.2fx' % (previous[name]['seconds'] / r['seconds'])
+            else:
+                line += ' %8s' % '-'
+        print line
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-o', '--output', dest = 'output',
+                      help = 'save results as JSON to FILE', metavar = 'FILE')
+    parser.add_option('-c', '--compare', dest = 'compare',
+                      help = 'compare against results saved in FILE', metavar = 'FILE')
+    parser.add_option('-k', '--filter', dest = 'filter', default = '',
+                      help = 'only run cases whose name contains TEXT', metavar = 'TEXT')
+    parser.add_option('-q', '--quick', dest = 'quick', action = 'store_true',
+                      default = False, help = 'skip the huge corpora')
+    (options, args) = parser.parse_args()
+
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))['results']
+
+    print 'Building corpora...'
+    corpus = Corpus(options.quick)
+    try:
+        results = {}
+        for name, size, func in cases(corpus):
+            if options.filter not in name:
+                continue
+            seconds, calls, peak = runIsolated(func)
+            results[name] = {
+                'seconds'   :   seconds,
+                'calls'     :   calls,
+                'bytes'     :   size,
+                'mbps'      :   size / seconds / 2**20,
+                'peakKiB'   :   peak
+            }
+            sys.stderr.write('.')
+        sys.stderr.write('\n')
+    finally:
+        corpus.cleanup()
+
+    report(results, previous)
+
+    if options.output:
+        fd = open(options.output, 'w')
+        json.dump({
+            'revision'  :   revision(),
+            'python'    :   sys.version.split()[0],
+            'time'      :   int(time.time()),
+            'results'   :   results
+        }, fd, indent = 1, sort_keys = True)
+        fd.close()
@@ -16,7 +16,9 @@ if __name__ == '__main__':
     port = int(sys.argv[2])
     sleep = int(sys.argv[3])
 
-    cli = bt.client.Client(torrent, port)
+    # Only announces are made, so there's
+    # no need to parse pieces up front
+    cli = bt.client.Client(torrent, port, lazy = True)
 
     # Spoof peer id to look like the newest version of azureus
     cli.emulate('azureus')
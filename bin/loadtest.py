@@ -0,0 +1,261 @@
+"""
+Load tests the tracker path: drives many
+simulated clients (a State each) announcing
+to a tracker, and reports announces per
+second and latency percentiles.
+
+By default the tracker is a MockTracker
+started in process, so runs need nothing
+else and are comparable across revisions:
+
+    python bin/loadtest.py -n 500 -r 4 -j 32
+    python bin/loadtest.py --latency 0.05 --failure-rate 0.1 --gzip
+    python bin/loadtest.py --udp
+
+or point it at a real tracker with -u URL.
+
+Announces go through a connection pool of
+their own, and the circuit breaker is off
+unless --breaker is given, so that every
+announce reaches the tracker.
+"""
+
+import bt.connection, bt.mocktracker, bt.state, bt.torrent, bt.tracker, bt.udp
+import sys, sha, time, optparse, json
+import multiprocessing.pool
+
+def makeTorrent(i, url):
+    """
+    A small torrent, unique to `i',
+    announcing to `url'.
+    """
+
+    return bt.torrent.Torrent({
+        'announce'  :   url,
+        'info'      :   {
+            'name'          :   'loadtest-%06d' % i,
+            'piece length'  :   2**18,
+            'pieces'        :   sha.new(str(i)).digest(),
+            'length'        :   2**18
+        }
+    })
+
+def makeStates(numClients, numTorrents, url, compact = True, pool = None):
+    """
+    Builds `numClients' States spread over
+    `numTorrents' torrents, each client
+    with its own peer ID, address and port,
+    announcing through `pool' if given.
+    """
+
+    torrents = [makeTorrent(i, url) for i in xrange(numTorrents)]
+
+    states = []
+    for i in xrange(numClients):
+        peerID = '-LT0001-%012d' % i
+        ip = '10.%d.%d.%d' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        st = bt.state.State(torrents[i % numTorrents], peerID, 6881 + i % 1000, ip)
+        st.tracker.getCompressedPeerList = compact
+        st.tracker.noPeerID = compact
+        if pool is not None:
+            st.tracker.pool = pool
+        states.append(st)
+    return states
+
+def run(states, rounds, workers, numPeers, progress = None):
+    """
+    Announces every State `rounds' times ('started'
+    then updates), `workers' at a time.  Returns
+    (seconds, latencies, errors), latencies being
+    those of the successful announces.
+    """
+
+    def client(st):
+        latencies = []
+        errors = []
+        for i in xrange(rounds):
+            start = time.time()
+            try:
+                if i == 0:
+                    st.trackerScrape(numPeers)
+                else:
+                    st.trackerUpdate(numPeers)
+            except Exception, msg:
+                errors.append(str(msg))
+                continue
+            latencies.append(time.time() - start)
+        return (latencies, errors)
+
+    latencies = []
+    errors = []
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(states)))
+    try:
+        start = time.time()
+        done = 0
+        for l, e in pool.imap_unordered(client, states):
+            latencies.extend(l)
+            errors.extend(e)
+            done += 1
+            if progress:
+                progress(done, len(states))
+        seconds = time.time() - start
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return (seconds, latencies, errors)
+
+def percentile(sorted, p):
+    """
+    The `p'th percentile (0-100) of a
+    sorted list, by nearest rank.
+    """
+
+    if not sorted:
+        return 0.0
+    i = int(round(p / 100.0 * (len(sorted) - 1)))
+    return sorted[i]
+
+def summarize(seconds, latencies, errors):
+    latencies = sorted(latencies)
+    total = len(latencies) + len(errors)
+    res = {
+        'announces'     :   total,
+        'failures'      :   len(errors),
+        'seconds'       :   seconds,
+        'perSecond'     :   total / max(seconds, 1e-9)
+    }
+    for p in (50, 90, 99):
+        res['p%d' % p] = percentile(latencies, p)
+    res['max'] = latencies and latencies[-1] or 0.0
+    return res
+
+def report(res, errors):
+    print '%d announces (%d failed) in %.2fs: %.1f announces/s' % \
+        (res['announces'], res['failures'], res['seconds'], res['perSecond'])
+    print 'latency  p50 %.2fms  p90 %.2fms  p99 %.2fms  max %.2fms' % \
+        (res['p50'] * 1000, res['p90'] * 1000, res['p99'] * 1000, res['max'] * 1000)
+
+    # The most common errors
+    counts = {}
+    for e in errors:
+        counts[e] = counts.get(e, 0) + 1
+    for n, e in sorted([(n, e) for e, n in counts.items()], reverse = True)[:5]:
+        print '%6d x %s' % (n, e)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-n', '--clients', dest = 'clients', type = 'int', default = 200,
+                      help = 'number of simulated clients')
+    parser.add_option('-t', '--torrents', dest = 'torrents', type = 'int', default = 0,
+                      help = 'number of torrents shared by the clients (default: one each)')
+    parser.add_option('-r', '--rounds', dest = 'rounds', type = 'int', default = 3,
+                      help = 'announces made by each client')
+    parser.add_option('-j', '--workers', dest = 'workers', type = 'int', default = 32,
+                      help = 'clients announcing at once')
+    parser.add_option('-c', '--connections', dest = 'connections', type = 'int', default = 8,
+                      help = 'kept alive connections per tracker host')
+    parser.add_option('-p', '--peers', dest = 'peers', type = 'int', default = 50,
+                      help = 'peers asked for by each announce')
+    parser.add_option('-u', '--url', dest = 'url',
+                      help = 'announce to URL instead of a mock tracker', metavar = 'URL')
+    parser.add_option('--dict-peers', dest = 'compact', action = 'store_false',
+                      default = True, help = 'ask for dict rather than compact peer lists')
+    parser.add_option('--breaker', dest = 'breaker', action = 'store_true',
+                      default = False, help = 'fail fast once the tracker seems down')
+    parser.add_option('-o', '--output', dest = 'output',
+                      help = 'save results as JSON to FILE', metavar = 'FILE')
+
+    group = optparse.OptionGroup(parser, 'Mock tracker options')
+    group.add_option('--udp', dest = 'udp', action = 'store_true', default = False,
+                     help = 'announce over UDP')
+    group.add_option('--latency', dest = 'latency', type = 'float', default = 0.0,
+                     help = 'seconds each response is delayed by')
+    group.add_option('--jitter', dest = 'jitter', type = 'float', default = 0.0,
+                     help = 'seconds of random latency added on top')
+    group.add_option('--failure-rate', dest = 'failureRate', type = 'float', default = 0.0,
+                     help = 'fraction of announces answered with a failure')
+    group.add_option('--error-rate', dest = 'errorRate', type = 'float', default = 0.0,
+                     help = 'fraction of requests answered with a 500 (dropped over UDP)')
+    group.add_option('--gzip', dest = 'gzip', action = 'store_true', default = False,
+                     help = 'gzip responses')
+    group.add_option('--seed', dest = 'seed', type = 'int', default = 0,
+                     help = 'seed of the injected latency and failures')
+    parser.add_option_group(group)
+    (options, args) = parser.parse_args()
+
+    mock = None
+    url = options.url
+    if not url:
+        latency = options.latency
+        if options.jitter:
+            latency = (latency, latency + options.jitter)
+        udpPort = None
+        if options.udp:
+            udpPort = 0
+        mock = bt.mocktracker.MockTracker(udpPort = udpPort,
+                                          latency = latency,
+                                          failureRate = options.failureRate,
+                                          errorRate = options.errorRate,
+                                          gzip = options.gzip,
+                                          seed = options.seed)
+        mock.start()
+        if options.udp:
+            url = mock.udpURL()
+        else:
+            url = mock.announceURL()
+
+        # Don't wait out UDP retransmissions of
+        # dropped requests for minutes
+        bt.udp.baseTimeout = 1
+
+    pool = bt.connection.ConnectionPool(maxPerHost = options.connections,
+                                        timeout = bt.tracker.readTimeout,
+                                        connectTimeout = bt.tracker.connectTimeout)
+
+    # Start from closed breakers, that
+    # never open unless asked for
+    bt.tracker.breakers.clear()
+    if not options.breaker:
+        bt.tracker.breakerThreshold = sys.maxint
+
+    states = makeStates(options.clients,
+                        options.torrents or options.clients,
+                        url,
+                        options.compact,
+                        pool)
+
+    def progress(done, total):
+        sys.stderr.write('\r%d/%d clients' % (done, total))
+
+    print 'Announcing to %s...' % url
+    try:
+        seconds, latencies, errors = run(states,
+                                         options.rounds,
+                                         options.workers,
+                                         options.peers,
+                                         progress)
+    finally:
+        sys.stderr.write('\n')
+        pool.close()
+        if mock is not None:
+            mock.stop()
+
+    res = summarize(seconds, latencies, errors)
+    report(res, errors)
+    if not url.startswith('udp:'):
+        print 'connections: %d opened, %d reused' % (pool.connects, pool.reuses)
+    if mock is not None:
+        print 'mock tracker: %s' % ', '.join(
+            ['%s %d' % (k, v) for k, v in sorted(mock.stats.items())])
+
+    if options.output:
+        fd = open(options.output, 'w')
+        json.dump({
+            'url'       :   url,
+            'clients'   :   options.clients,
+            'rounds'    :   options.rounds,
+            'workers'   :   options.workers,
+            'results'   :   res
+        }, fd, indent = 1, sort_keys = True)
+        fd.close()
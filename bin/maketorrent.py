@@ -0,0 +1,58 @@
+"""
+Create a .torrent file for
+a file or a directory.
+"""
+
+import bt.torrent
+import sys, time, optparse
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage = '%prog [options] <file or directory> <tracker url>...')
+    parser.add_option('-o', '--output', dest = 'output',
+                      help = 'write the torrent to FILE', metavar = 'FILE')
+    parser.add_option('-l', '--piece-length', dest = 'pieceLen', type = 'int',
+                      default = 0, help = 'piece length in KiB (default: automatic)')
+    parser.add_option('-c', '--comment', dest = 'comment', default = '')
+    parser.add_option('-n', '--name', dest = 'name', default = None,
+                      help = 'name of the download (default: base name of the path)')
+    parser.add_option('-p', '--private', dest = 'private', action = 'store_true',
+                      default = False, help = 'set the private flag')
+    parser.add_option('-j', '--jobs', dest = 'workers', type = 'int', default = 0,
+                      help = 'number of hashing workers (default: one per CPU)')
+    parser.add_option('--processes', dest = 'processes', action = 'store_true',
+                      default = False, help = 'hash in processes instead of threads')
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error('Too few arguments')
+
+    path = args[0]
+    trackers = args[1:]
+    output = options.output or (path.rstrip('/\\') + '.torrent')
+
+    def progress(done, total):
+        sys.stderr.write('\rHashing: %d/%d pieces' % (done, total))
+
+    start = time.time()
+    tor = bt.torrent.makeTorrent(path,
+                                 options.pieceLen * 1024,
+                                 trackers,
+                                 comment = options.comment,
+                                 createdBy = 'PyBTOMG/0001',
+                                 private = options.private,
+                                 name = options.name,
+                                 workers = options.workers,
+                                 processes = options.processes,
+                                 progress = progress)
+    elapsed = time.time() - start
+    sys.stderr.write('\n')
+
+    tor.save(output)
+
+    print 'Torrent: %s' % output
+    print 'Info Hash: %s' % tor.hash.encode('hex')
+    print 'Size: %d bytes in %d pieces of %d bytes' % \
+        (tor.length, len(tor.pieces), tor.pieceLen)
+    print 'Hashed in %.2fs (%.1f MB/s)' % \
+        (elapsed, tor.length / max(elapsed, 1e-6) / 2**20)
@@ -1 +1 @@
-__all__ = [ 'bencode', 'client', 'state', 'torrent', 'tracker' ]
+__all__ = [ 'bencode', 'cache', 'client', 'connection', 'index', 'library', 'metrics', 'mocktracker', 'peers', 'scheduler', 'state', 'storage', 'torrent', 'tracker', 'udp' ]
@@ -6,7 +6,7 @@ Copyright (C) 2007 Matt Waddell
 ALL RIGHTS RESERVED
 """
 
-import string
+import string, mmap
 
 symbols = {}
 symbols['dict'] = 'd'
@@ -26,55 +26,114 @@ def encode(struct):
         Integer (Long)
         String
 
-    Lists and Dictionaries may be nested
+    Lists and Dictionaries may be nested, and
+    may contain Encoded values.
 
     See:
     http://wiki.theory.org/BitTorrentSpecification#bencoding
     """
 
-    def __encode(struct):
-        """
-        Recursively construct a bencoded
-        string from a structure.
-        """
+    parts = []
+    try:
+        __encode(struct, parts.append)
+    except Exception, msg:
+        raise Exception, 'Encode Error: %s' % str(msg)
 
-        if isinstance(struct, dict):
-            s = symbols['dict']
+    return ''.join(parts)
 
-            # Apprently the keys have to be sorted
-            # lexicographically
-            keys = struct.keys()
-            keys.sort()
-            for key in keys:
-                # Keys must be strings as well
-                if not isinstance(key, str):
-                    raise Exception, 'Dictionary keys must be Strings'
+def encodeTo(fd, struct, bufSize = 65536):
+    """
+    Bencodes a structure straight into `fd',
+    which may be anything with a write()
+    method: a file, a StringIO, or a socket
+    wrapped with makefile().
+
+    Output is gathered into writes of roughly
+    `bufSize' bytes; strings at least that
+    large are written through without being
+    copied into the buffer.
+    """
 
-                val = struct[key]
-                keyEnc = __encode(key)
-                valEnc = __encode(val)
-                s += '%s%s' % (keyEnc,valEnc)
-            s += symbols['end']
-            return s
-        elif isinstance(struct, list):
-            s = symbols['list']
-            for val in struct:
-                s += __encode(val)
-            s += symbols['end']
-            return s
-        elif isinstance(struct, int) or isinstance(struct, long):
-            return '%s%d%s' % (symbols['int'],struct,symbols['end'])
-        elif isinstance(struct, str):
-            return '%d%s%s' % (len(struct), symbols['strLenSep'], struct)
-        else:
-            raise Exception, 'Unsupported structure: %s' % struct.__class__.__name__
+    buf = []
+    bufLen = [0]
+
+    def write(s):
+        if len(s) >= bufSize:
+            if buf:
+                fd.write(''.join(buf))
+                del buf[:]
+                bufLen[0] = 0
+            fd.write(s)
+            return
+
+        buf.append(s)
+        bufLen[0] += len(s)
+        if bufLen[0] >= bufSize:
+            fd.write(''.join(buf))
+            del buf[:]
+            bufLen[0] = 0
 
     try:
-        s = __encode(struct)
+        __encode(struct, write)
     except Exception, msg:
-        raise 'Encode Error: %s' % str(msg)
+        raise Exception, 'Encode Error: %s' % str(msg)
 
-    return s
+    if buf:
+        fd.write(''.join(buf))
+
+class Encoded:
+    """
+    Wraps a value that is already bencoded,
+    so that it can be placed in a structure
+    and emitted by the encoders as is, e.g.
+    to splice the original bytes of a torrent's
+    info dict back into a new torrent.
+    """
+
+    def __init__(self, s):
+        self.data = str(s)
+
+    def __repr__(self):
+        return '<Encoded %d bytes>' % len(self.data)
+
+def __encode(struct, write):
+    """
+    Recursively emit the bencoded form
+    of a structure, one piece at a time,
+    through `write'.  Nothing already
+    emitted is ever copied again.
+    """
+
+    if isinstance(struct, Encoded):
+        write(struct.data)
+    elif isinstance(struct, dict):
+        write(symbols['dict'])
+
+        # Apprently the keys have to be sorted
+        # lexicographically
+        keys = struct.keys()
+        keys.sort()
+        for key in keys:
+            # Keys must be strings as well
+            if not isinstance(key, str):
+                raise Exception, 'Dictionary keys must be Strings'
+
+            write('%d%s' % (len(key), symbols['strLenSep']))
+            write(key)
+            __encode(struct[key], write)
+        write(symbols['end'])
+    elif isinstance(struct, list):
+        write(symbols['list'])
+        for val in struct:
+            __encode(val, write)
+        write(symbols['end'])
+    elif isinstance(struct, int) or isinstance(struct, long):
+        write('%s%d%s' % (symbols['int'],struct,symbols['end']))
+    elif isinstance(struct, str):
+        write('%d%s' % (len(struct), symbols['strLenSep']))
+        write(struct)
+    else:
+        raise Exception, 'Unsupported structure: %s' % struct.__class__.__name__
 
 def decode(s, strict = False):
     """
@@ -92,136 +151,858 @@ def decode(s, strict = False):
     http://wiki.theory.org/BitTorrentSpecification#bencoding
     """
 
-    def __decode(parts):
+    tree, i = decodeAt(s, 0, strict)
+    return tree
+
+def decodeAt(s, i, strict = False):
+    """
+    Parses the single bencoded value that
+    begins at offset `i' of `s', returning:
+
+    (value, end)
+
+    where `end' is the offset just past
+    the value.  Anything following it in
+    `s' is left alone.
+    """
+
+    if strict:
+        decoders = strictDecoders
+    else:
+        decoders = plainDecoders
+
+    try:
+        try:
+            return decoders[s[i]](s, i, decoders)
+        except IndexError:
+            raise Exception, 'Unexpected EOF'
+        except KeyError:
+            raise Exception, 'Unexpected Character: %s' % s[i]
+    except Exception, msg:
+        raise Exception, 'Parse Error: ' + str(msg)
+
+# The parsers decodeAt() dispatches to on the first
+# byte of a value.  Each takes (s, i, decoders) and
+# returns (value, end) like decodeAt() itself, using
+# `decoders' in turn for the values inside it.
+
+def __decodeDict(s, i, decoders):
+    # i.e. d3:fooi123ee
+    #
+    # Strings (every key, and most values) and
+    # integers are parsed inline, being by far
+    # the most common
+
+    sLen = len(s)
+    d = {}
+    i += 1
+    try:
+        c = s[i]
+        while c != 'e':
+            if c in '0123456789':
+                j = s.find(':', i)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                try:
+                    num = strLengths[s[i:j]]
+                except KeyError:
+                    num = __strLength(s[i:j])
+                j += 1
+                i = j + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                key = s[j:i]
+            else:
+                key, i = decoders[c](s, i, decoders)
+
+            c = s[i]
+            if c in '0123456789':
+                j = s.find(':', i)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                try:
+                    num = strLengths[s[i:j]]
+                except KeyError:
+                    num = __strLength(s[i:j])
+                j += 1
+                i = j + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                d[key] = s[j:i]
+            elif c == 'i':
+                j = s.find('e', i + 1)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in Integer declaration'
+                try:
+                    d[key] = long(s[i + 1:j])
+                except ValueError:
+                    raise Exception, 'Malformed Integer value: %s' % s[i + 1:j]
+                i = j + 1
+            else:
+                d[key], i = decoders[c](s, i, decoders)
+            c = s[i]
+    except IndexError:
+        raise Exception, 'Unexpected EOF in Dict declaration'
+    except KeyError:
+        raise Exception, 'Unexpected Character: %s' % s[i]
+    return d, i + 1
+
+def __decodeStrictDict(s, i, decoders):
+    """
+    Halts if the dict keys are not strings,
+    or do not appear in sorted order.
+    """
+
+    d = {}
+    inputOrderedKeys = []
+    i += 1
+    try:
+        while s[i] != 'e':
+            key, i = decoders[s[i]](s, i, decoders)
+
+            # Specification states that the dict keys
+            # must be strings
+            if not isinstance(key, str):
+                raise Exception, 'Dictionary keys must be Strings'
+            inputOrderedKeys.append(key)
+
+            d[key], i = decoders[s[i]](s, i, decoders)
+    except IndexError:
+        raise Exception, 'Unexpected EOF in Dict declaration'
+    except KeyError:
+        raise Exception, 'Unexpected Character: %s' % s[i]
+
+    sortedKeys = d.keys()
+    sortedKeys.sort()
+    if sortedKeys != inputOrderedKeys:
+        raise Exception, 'Dictionary keys must be in sorted order'
+    return d, i + 1
+
+def __decodeList(s, i, decoders):
+    # i.e. l3:foo3:bare
+    #
+    # Strings are parsed inline (see __decodeDict())
+
+    sLen = len(s)
+    l = []
+    i += 1
+    try:
+        c = s[i]
+        while c != 'e':
+            if c in '0123456789':
+                j = s.find(':', i)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                try:
+                    num = strLengths[s[i:j]]
+                except KeyError:
+                    num = __strLength(s[i:j])
+                j += 1
+                i = j + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                l.append(s[j:i])
+            else:
+                val, i = decoders[c](s, i, decoders)
+                l.append(val)
+            c = s[i]
+    except IndexError:
+        raise Exception, 'Unexpected EOF in List declaration'
+    except KeyError:
+        raise Exception, 'Unexpected Character: %s' % s[i]
+    return l, i + 1
+
+def __decodeInt(s, i, decoders):
+    # i.e. i345e
+    j = s.find('e', i + 1)
+    if j < 0:
+        raise Exception, 'Unexpected EOF in Integer declaration'
+    try:
+        return long(s[i + 1:j]), j + 1
+    except ValueError:
+        raise Exception, 'Malformed Integer value: %s' % s[i + 1:j]
+
+def __decodeString(s, i, decoders):
+    # i.e. 5:hello
+    j = s.find(':', i)
+    if j < 0:
+        raise Exception, 'Unexpected EOF in String declaration'
+    try:
+        num = strLengths[s[i:j]]
+    except KeyError:
+        num = __strLength(s[i:j])
+
+    # Now take num characters in one step
+    j += 1
+    if j + num > len(s):
+        raise Exception, 'Unexpected EOF in String declaration'
+    return s[j:j + num], j + num
+
+def __strLength(num):
+    try:
+        return int(num)
+    except ValueError:
+        raise Exception, 'Malformed Integer value in String length: %s' % num
+
+# The lengths of short strings, looked up
+# rather than converted with int()
+strLengths = dict([(str(n), n) for n in xrange(1024)])
+
+plainDecoders = {
+    'd' :   __decodeDict,
+    'l' :   __decodeList,
+    'i' :   __decodeInt
+}
+for c in string.digits:
+    plainDecoders[c] = __decodeString
+
+strictDecoders = plainDecoders.copy()
+strictDecoders['d'] = __decodeStrictDict
+
+class Decoder:
+    """
+    Incremental (push) bencode parser.
+
+    Data is handed over in arbitrarily sized
+    chunks via feed(), which returns a list
+    holding the top level value once that chunk
+    completes it (and an empty list otherwise).
+    As with decode(), anything following the
+    value, such as a trailing newline, is
+    ignored.  Only the unfinished token and the
+    containers still open are kept between
+    calls, so nothing has to be buffered up
+    front, e.g.:
+
+        decoder = Decoder()
+        for chunk in chunks:
+            for value in decoder.feed(chunk):
+                ...
+        decoder.close()
+
+    `strict' has the same meaning as for decode().
+    """
+
+    # Longest integer or string length token
+    # accepted before giving up on it
+    maxTokenLen = 64
+
+    def __init__(self, strict = False):
+        self.strict = strict
+
+        # Unconsumed tail of the last chunk
+        # (an incomplete int or string length)
+        self.buf = ''
+
+        # Open containers, innermost last:
+        # [list] or [dict, pendingKey, inputOrderedKeys]
+        self.stack = []
+
+        # Bytes still owed to the string being read,
+        # and the pieces of it seen so far
+        self.strLeft = None
+        self.strParts = []
+
+        # Whether the top level value is complete
+        self.done = False
+
+    def feed(self, chunk):
         """
-        Recursive descent parser:
-        Works backwards on a list
-        of characters, and returns
-        the next whole part of a
-        bencoded string.  
+        Parses as much of `chunk' as possible and
+        returns the list of completed top level
+        values (possibly empty).
         """
 
-        c = parts.pop()
+        try:
+            return self.__feed(chunk)
+        except Exception, msg:
+            raise Exception, 'Parse Error: ' + str(msg)
 
-        if c == symbols['dict']:
-            # Parse Dictionary
-            # i.e. d3:fooi123ee
+    def close(self):
+        """
+        Signals the end of the input.
+        Raises an exception if a value
+        was left unfinished.
+        """
 
-            c = parts.pop()
-            d = {}
-            inputOrderedKeys = []
-            while c != symbols['end']:
-                parts.append(c)
-                key = __decode(parts)
-                
-                # Save the input order of the key if
-                # using strict evaluation
-                if strict:
-                    inputOrderedKeys.append(key)
+        if self.buf or self.stack or self.strLeft is not None:
+            raise Exception, 'Parse Error: Unexpected EOF'
+
+    def __feed(self, chunk):
+        values = []
+        if self.done:
+            return values
+        stack = self.stack
+
+        s = self.buf + chunk
+        sLen = len(s)
+        i = 0
+
+        while True:
+            if self.done:
+                # Ignore whatever follows the value
+                i = sLen
+                break
+
+            if self.strLeft is not None:
+                # Continue (or finish) a string body
+                j = min(i + self.strLeft, sLen)
+                self.strParts.append(s[i:j])
+                self.strLeft -= j - i
+                i = j
+                if self.strLeft:
+                    break
+
+                val = ''.join(self.strParts)
+                self.strLeft = None
+                self.strParts = []
+                self.__push(val, values)
+                continue
+
+            if i >= sLen:
+                break
+
+            c = s[i]
+
+            if c == symbols['dict']:
+                stack.append([{}, None, []])
+                i += 1
+            elif c == symbols['list']:
+                stack.append([[]])
+                i += 1
+            elif c == symbols['end']:
+                if not stack:
+                    raise Exception, 'Unexpected Character: %s' % c
+                top = stack.pop()
+                if len(top) > 1:
+                    d, pendingKey, inputOrderedKeys = top
+                    if pendingKey is not None:
+                        raise Exception, 'Unexpected Character: %s' % c
+
+                    # Check that the keys were in sorted order
+                    # if using strict evaluation
+                    if self.strict:
+                        sortedKeys = d.keys()
+                        sortedKeys.sort()
+                        if sortedKeys != inputOrderedKeys:
+                            raise Exception, \
+                                'Dictionary keys must be in sorted order'
+                i += 1
+                self.__push(top[0], values)
+            elif c == symbols['int']:
+                j = s.find(symbols['end'], i + 1)
+                if j < 0:
+                    self.__checkToken(s[i + 1:])
+                    break
+
+                num = s[i + 1:j]
+                try:
+                    num = long(num)
+                except:
+                    raise Exception, 'Malformed Integer value: %s' % num
+                i = j + 1
+                self.__push(num, values)
+            elif c in string.digits:
+                j = s.find(symbols['strLenSep'], i)
+                if j < 0:
+                    self.__checkToken(s[i:])
+                    break
+
+                num = s[i:j]
+                try:
+                    num = int(num)
+                except:
+                    raise Exception, \
+                        'Malformed Integer value in String length: %s' % num
+                i = j + 1
+                self.strLeft = num
+            else:
+                raise Exception, 'Unexpected Character: %s' % c
+
+        self.buf = s[i:]
+        return values
+
+    def __checkToken(self, token):
+        """
+        Refuses to keep buffering a number
+        that can't possibly be well formed.
+        """
+
+        if len(token) > self.maxTokenLen:
+            raise Exception, 'Malformed Integer value: %s...' % \
+                token[:self.maxTokenLen]
+
+    def __push(self, val, values):
+        """
+        Hands a finished value to the innermost
+        open container, or to `values' if it
+        is a top level value.
+        """
 
-                # Specification states that the dict keys
-                # must be strings
-                if strict and not isinstance(key, str):
+        if not self.stack:
+            values.append(val)
+            self.done = True
+            return
+
+        top = self.stack[-1]
+        if len(top) == 1:
+            top[0].append(val)
+        elif top[1] is None:
+            # Specification states that the dict keys
+            # must be strings
+            if self.strict:
+                if not isinstance(val, str):
                     raise Exception, 'Dictionary keys must be Strings'
+                top[2].append(val)
+            top[1] = (val,)
+        else:
+            top[0][top[1][0]] = val
+            top[1] = None
 
-                d[key] = __decode(parts)
-                if not parts:
-                    raise Exception, 'Unexpected EOF in Dict declaration'
-                c = parts.pop()
-
-            # Check that the keys were in sorted order
-            # if using strict evaluation
-            if strict:
-                sortedKeys = d.keys()
-                sortedKeys.sort()
-                if sortedKeys != inputOrderedKeys:
-                    raise Exception, 'Dictionary keys must be in sorted order'
-
-            return d
-        elif c == symbols['list']:
-            # Parse List
-            # i.e. l3:foo3:bare
-
-            c = parts.pop()
-            l = []
-            while c != symbols['end']:
-                parts.append(c)
-                val = __decode(parts)
-                l.append(val)
-                if not parts:
-                    raise Exception, 'Unexpected EOF in List declaration'
-                c = parts.pop()
-            return l
-        elif c == symbols['int']:
-            # Parse Integer
-            # i.e. i345e
-
-            c = parts.pop()
-            num = ''
-            while c != symbols['end']:
-                num += c
-                if not parts:
-                    raise Exception, 'Unexpected EOF in Integer declaration'
-                c = parts.pop()
+def skipAt(s, i, ends = None, tally = None):
+    """
+    Returns the offset just past the bencoded
+    value that begins at offset `i' of `s',
+    walking over it without building anything.
+
+    If given, `ends' maps the start offset of
+    dicts and lists already walked over to their
+    end; it is consulted, and filled in for the
+    value and the containers directly inside it,
+    so that nested containers aren't walked again
+    when they are indexed in turn.
+
+    If given, `tally' maps paths inside the value
+    to running totals: the integers found along
+    each path are added to its total on the way.
+    A path is a tuple of the dict keys leading to
+    the integers, with None standing for every
+    element of a list; ('files', None, 'length')
+    adds up the file lengths of an info dict.
+    """
 
-            try:
-                num = long(num)
-            except:
-                raise Exception, 'Malformed Integer value: %s' % num 
-
-            return num
-        elif c in string.digits:
-            # Parse string  
-            # i.e. 5:hello
-
-            # Parse string length
-            num = c
-            c = parts.pop()
-            while c != symbols['strLenSep']:
-                num += c
-                if not parts:
-                    raise Exception, 'Unexpected EOF in String declaration'
-                c = parts.pop()
+    if tally:
+        return __tallyAt(s, i, ends, tally)
 
-            try:
-                num = int(num)
-            except:
-                raise (Exception,
-                    'Malformed Integer value in String length: %s' % num)
-
-            # Now read num characters
-            s = ''
-            while num > 0:
-                if not parts:
+    sLen = len(s)
+
+    # Start offsets of the containers still open
+    opened = []
+
+    try:
+        while True:
+            c = s[i:i + 1]
+            if c == symbols['dict'] or c == symbols['list']:
+                if ends is not None and i in ends:
+                    i = ends[i]
+                else:
+                    opened.append(i)
+                    i += 1
+                    continue
+            elif c == symbols['end'] and opened:
+                i += 1
+                start = opened.pop()
+                if ends is not None and len(opened) < 2:
+                    ends[start] = i
+            elif c == symbols['int']:
+                j = s.find(symbols['end'], i + 1)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in Integer declaration'
+                i = j + 1
+            elif c and c in string.digits:
+                j = s.find(symbols['strLenSep'], i)
+                if j < 0:
                     raise Exception, 'Unexpected EOF in String declaration'
-                c = parts.pop()
-                s += c
-                num -= 1
-            return s
+                try:
+                    num = int(s[i:j])
+                except:
+                    raise Exception, \
+                        'Malformed Integer value in String length: %s' % s[i:j]
+                i = j + 1 + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+            elif not c:
+                raise Exception, 'Unexpected EOF'
+            else:
+                raise Exception, 'Unexpected Character: %s' % c
 
-        else:
-            raise Exception, 'Unexpected Character: %s' % c
+            if not opened:
+                return i
+    except Exception, msg:
+        raise Exception, 'Parse Error: ' + str(msg)
+
+def __tallyAt(s, i, ends, tally):
+    """
+    skipAt() when there is a `tally' to keep.
+    Containers are always walked, since the
+    integers in them are needed.
+    """
+
+    sLen = len(s)
+
+    # [start, isDict, key] of each container still
+    # open, `key' being what the value being read
+    # is stored under (None while reading the key,
+    # and for lists)
+    opened = []
 
-    chars = list(s)
-    chars.reverse()
     try:
-        tree = __decode(chars)
+        while True:
+            c = s[i:i + 1]
+            top = opened and opened[-1]
+
+            if top and top[1] and top[2] is None and c != symbols['end']:
+                # A dict key
+                j = s.find(symbols['strLenSep'], i)
+                if not c in string.digits or j < 0:
+                    raise Exception, 'Dictionary keys must be Strings'
+                try:
+                    num = int(s[i:j])
+                except:
+                    raise Exception, \
+                        'Malformed Integer value in String length: %s' % s[i:j]
+                i = j + 1 + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                top[2] = s[j + 1:i]
+                continue
+
+            if c == symbols['dict'] or c == symbols['list']:
+                opened.append([i, c == symbols['dict'], None])
+                i += 1
+                continue
+            elif c == symbols['end'] and opened:
+                i += 1
+                start = opened.pop()[0]
+                if ends is not None and len(opened) < 2:
+                    ends[start] = i
+            elif c == symbols['int']:
+                j = s.find(symbols['end'], i + 1)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in Integer declaration'
+                path = tuple([o[2] for o in opened])
+                if path in tally:
+                    try:
+                        tally[path] += long(s[i + 1:j])
+                    except ValueError:
+                        raise Exception, 'Malformed Integer value: %s' % s[i + 1:j]
+                i = j + 1
+            elif c and c in string.digits:
+                j = s.find(symbols['strLenSep'], i)
+                if j < 0:
+                    raise Exception, 'Unexpected EOF in String declaration'
+                try:
+                    num = int(s[i:j])
+                except:
+                    raise Exception, \
+                        'Malformed Integer value in String length: %s' % s[i:j]
+                i = j + 1 + num
+                if i > sLen:
+                    raise Exception, 'Unexpected EOF in String declaration'
+            elif not c:
+                raise Exception, 'Unexpected EOF'
+            else:
+                raise Exception, 'Unexpected Character: %s' % c
+
+            if not opened:
+                return i
+
+            # The value is done; a dict
+            # reads its next key
+            if opened[-1][1]:
+                opened[-1][2] = None
     except Exception, msg:
         raise Exception, 'Parse Error: ' + str(msg)
-    return tree
 
-def decodeFile(torrentFile, strict = False):
+def decodeLazy(s, strict = False, tally = None):
+    """
+    Like decode(), but dictionaries and lists
+    come back as LazyDict and LazyList proxies
+    over `s', which may be a string or an mmap.
+    Values are only decoded when they are
+    accessed, and every container remembers
+    the span of `s' it was read from.
+
+    Integers and strings at the top level
+    are simply decoded.  If given, `tally' is
+    kept as the top level dict is indexed (see
+    skipAt()), paths starting from its keys.
+    """
+
+    return decodeLazyAt(s, 0, strict, None, tally)
+
+def decodeLazyAt(s, i, strict = False, ends = None, tally = None):
+    """
+    decodeLazy() for the value that begins
+    at offset `i' of `s'.  `ends' is shared
+    by every proxy over the same source (see
+    skipAt()).
+    """
+
+    if ends is None:
+        ends = {}
+
+    c = s[i:i + 1]
+    if c == symbols['dict']:
+        return LazyDict(s, i, strict, ends, tally)
+    elif c == symbols['list']:
+        return LazyList(s, i, strict, ends)
+    else:
+        val, i = decodeAt(s, i, strict)
+        return val
+
+class LazyNode:
+    """
+    Common behaviour of the lazy proxies.
+
+    source  : The string or mmap being decoded
+    start   : Offset of the first byte of the node
+    end     : Offset just past the last byte of the node
+    """
+
+    def __init__(self, s, start, strict, ends):
+        self.source = s
+        self.start = start
+        self.end = start
+        self.strict = strict
+
+        # Container end offsets known so far,
+        # shared with the rest of the tree
+        self.ends = ends
+
+        # Values decoded so far
+        self.cache = {}
+
+    def span(self, key = None):
+        """
+        Returns (start, end) of this node, or
+        of the value stored under `key'.
+        """
+
+        if key is None:
+            return (self.start, self.end)
+        return self.spanOf(key)
+
+    def raw(self, key = None):
+        """
+        Returns the original bencoded bytes of
+        this node, or of the value under `key',
+        as a buffer into the source (no copy).
+        """
+
+        start, end = self.span(key)
+        return buffer(self.source, start, end - start)
+
+    def rawString(self, key = None):
+        """
+        Like raw(), but returns a copy of the
+        bytes as a string (the source itself, if
+        it is a string and this node spans it).
+        """
+
+        start, end = self.span(key)
+        return self.source[start:end]
+
+    def view(self, key):
+        """
+        Returns the contents of the string
+        stored under `key' as a buffer into
+        the source, without copying it.
+        """
+
+        start, end = self.spanOf(key)
+        if not self.source[start:start + 1] in string.digits:
+            raise Exception, 'Not a String value: %s' % key
+        j = self.source.find(symbols['strLenSep'], start) + 1
+        return buffer(self.source, j, end - j)
+
+    def materialize(self, key = None):
+        """
+        Fully decodes the node, or the value
+        under `key' (without making a proxy
+        for it first), into plain dicts and
+        lists.
+        """
+
+        start, end = self.span(key)
+        val, i = decodeAt(self.source, start, self.strict)
+        return val
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            return self.cache[key]
+
+        start, end = self.spanOf(key)
+        val = decodeLazyAt(self.source, start, self.strict, self.ends)
+        self.cache[key] = val
+        return val
+
+class LazyDict(LazyNode):
+    """
+    Read-only dictionary proxy whose values
+    are decoded on first access.  The keys
+    (and where each value lives) are indexed
+    up front, keeping `tally' on the way (see
+    skipAt()), paths starting from the keys.
+    """
+
+    def __init__(self, s, start, strict = False, ends = None, tally = None):
+        if ends is None:
+            ends = {}
+        LazyNode.__init__(self, s, start, strict, ends)
+
+        # key -> (start, end) of its value
+        self.index = {}
+        inputOrderedKeys = []
+
+        i = start + 1
+        while s[i:i + 1] != symbols['end']:
+            key, i = decodeAt(s, i, strict)
+
+            # Specification states that the dict keys
+            # must be strings
+            if strict and not isinstance(key, str):
+                raise Exception, \
+                    'Parse Error: Dictionary keys must be Strings'
+            inputOrderedKeys.append(key)
+
+            sub = None
+            if tally:
+                sub = dict([(path[1:], 0) for path in tally if path[0] == key])
+            j = skipAt(s, i, ends, sub)
+            if sub:
+                for path, total in sub.iteritems():
+                    tally[(key,) + path] += total
+            self.index[key] = (i, j)
+            i = j
+
+        self.end = i + 1
+
+        # Check that the keys were in sorted order
+        # if using strict evaluation
+        if strict:
+            sortedKeys = self.index.keys()
+            sortedKeys.sort()
+            if sortedKeys != inputOrderedKeys:
+                raise Exception, \
+                    'Parse Error: Dictionary keys must be in sorted order'
+
+    def spanOf(self, key):
+        return self.index[key]
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return [self[key] for key in self.index]
+
+    def items(self):
+        return [(key, self[key]) for key in self.index]
+
+    def get(self, key, default = None):
+        if key in self.index:
+            return self[key]
+        return default
+
+    def has_key(self, key):
+        return key in self.index
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return '<LazyDict %d keys at %d:%d>' % \
+            (len(self.index), self.start, self.end)
+
+class LazyList(LazyNode):
+    """
+    Read-only list proxy whose elements
+    are decoded on first access.  Only the
+    offset of each element is indexed up
+    front.
+    """
+
+    def __init__(self, s, start, strict = False, ends = None):
+        if ends is None:
+            ends = {}
+        LazyNode.__init__(self, s, start, strict, ends)
+
+        # Offsets of each element, followed
+        # by the offset of the closing byte
+        self.offsets = []
+
+        i = start + 1
+        while s[i:i + 1] != symbols['end']:
+            self.offsets.append(i)
+            i = skipAt(s, i, ends)
+        self.offsets.append(i)
+
+        self.end = i + 1
+
+    def spanOf(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError, 'LazyList index out of range'
+        return (self.offsets[index], self.offsets[index + 1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return LazyNode.__getitem__(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return '<LazyList %d items at %d:%d>' % \
+            (len(self), self.start, self.end)
+
+def decodeFile(torrentFile, strict = False, lazy = False, mapped = True, tally = None):
     """
     Parses a file file, and returns
     a dictionary containing its values
+
+    If `lazy' is True the file is decoded with
+    decodeLazy() instead.  Unless `mapped' is
+    False it is memory mapped, so nothing is read
+    or copied until it is used; the map (and the
+    file descriptor it holds) stays open as long
+    as the proxies do, or until it is closed
+    through their `source'.  `tally' is handed
+    to decodeLazy().
     """
 
     try:
-        fd = open(torrentFile)
+        fd = open(torrentFile, 'rb')
     except:
         raise Exception, 'Unable to open torrent file: %s' % torrentFile
 
-    s = fd.read()
+    try:
+        if lazy and mapped:
+            try:
+                s = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+            except Exception, msg:
+                raise Exception, 'Unable to map torrent file: %s (%s)' % \
+                    (torrentFile, str(msg))
+            return decodeLazy(s, strict, tally)
+
+        s = fd.read()
+    finally:
+        fd.close()
+
+    if lazy:
+        return decodeLazy(s, strict, tally)
     return decode(s, strict)
 
 def __test(torrentFile):
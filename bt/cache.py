@@ -0,0 +1,169 @@
+"""
+Defines an on disk cache of parsed torrent
+metadata, so that torrents don't have to be
+decoded and hashed again every time they are
+loaded.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import os, sha, marshal, tempfile
+
+# Bumped whenever the cached fields change
+cacheVersion = 1
+
+class Cache:
+    """
+    Stores the fields of parsed torrents, one
+    marshalled file per torrent, keyed by the
+    torrent file's path.
+
+    An entry is only used if the torrent file's
+    size and modification time still match those
+    it was cached with; stale entries are removed.
+    The least recently used entries are evicted
+    once there are more than `maxEntries'.
+    """
+
+    def __init__(self, directory, maxEntries = 10000):
+        self.directory = directory
+        self.maxEntries = maxEntries
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.numEntries = len(self.__entries())
+
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        Returns the fields cached for the torrent
+        file at `path', or None if there aren't
+        any (or they are out of date).
+        """
+
+        entry = self.__entryPath(path)
+        try:
+            fd = open(entry, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            try:
+                key, fields = marshal.load(fd)
+            except (EOFError, ValueError, TypeError):
+                key, fields = None, None
+        finally:
+            fd.close()
+
+        if key != self.__key(path):
+            # Stale (or unreadable)
+            self.__remove(entry)
+            self.misses += 1
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return fields
+
+    def put(self, path, fields):
+        """
+        Caches the fields of the torrent
+        file at `path'.  `fields' may only
+        hold marshallable values.
+        """
+
+        key = self.__key(path)
+        if key is None:
+            return
+
+        entry = self.__entryPath(path)
+        existed = os.path.exists(entry)
+
+        # Write to a temporary file first so that
+        # readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            os.write(fd, marshal.dumps((key, fields), 2))
+        finally:
+            os.close(fd)
+        os.rename(tmp, entry)
+
+        if not existed:
+            self.numEntries += 1
+            if self.numEntries > self.maxEntries:
+                self.__evict()
+
+    def invalidate(self, path):
+        """
+        Drops the entry for `path', if any.
+        """
+
+        self.__remove(self.__entryPath(path))
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+
+        for entry in self.__entries():
+            self.__remove(entry)
+
+    def __key(self, path):
+        """
+        What an entry must have been cached with
+        to still be valid, or None if `path'
+        doesn't exist.
+        """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (cacheVersion, os.path.abspath(path), st.st_size, st.st_mtime)
+
+    def __entryPath(self, path):
+        name = sha.new(os.path.abspath(path)).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def __entries(self):
+        return [os.path.join(self.directory, name)
+                    for name in os.listdir(self.directory)
+                        if not name.endswith('.tmp')]
+
+    def __remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            return
+        self.numEntries -= 1
+
+    def __evict(self):
+        """
+        Removes the least recently used entries,
+        leaving room for a tenth of `maxEntries'
+        more before this has to be done again.
+        """
+
+        entries = []
+        for entry in self.__entries():
+            try:
+                entries.append((os.path.getmtime(entry), entry))
+            except OSError:
+                pass
+        entries.sort()
+
+        self.numEntries = len(entries)
+        keep = self.maxEntries - self.maxEntries / 10
+        for mtime, entry in entries[:max(0, len(entries) - keep)]:
+            self.__remove(entry)
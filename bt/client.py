@@ -18,9 +18,12 @@ class Client:
     functions of a torrent.
     """
 
-    def __init__(self, tor, port, ip = None):
+    def __init__(self, tor, port, ip = None, cache = None, lazy = False):
 
-        tor = torrent.Torrent(tor)
+        # `cache' is an optional cache.Cache of
+        # parsed torrent files, and `lazy' defers
+        # parsing pieces and files until used
+        tor = torrent.Torrent(tor, cache, lazy)
 
         # Port to listen for connection on
         self.port = port
@@ -0,0 +1,387 @@
+"""
+Defines a pool of persistent HTTP connections,
+so that repeated requests to the same host (a
+tracker being announced to for many torrents,
+say) don't each pay for a new connection.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import httplib, urlparse, socket, threading, time
+
+# Redirects followed before giving up
+maxRedirects = 5
+
+# Most bytes of an unread response body
+# skipped to keep its connection open
+maxDrain = 65536
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections, keyed by
+    (scheme, host, port), for reuse by later
+    requests to the same place.
+
+    At most `maxPerHost' connections to a host are
+    in use at once; further requests wait for one
+    to be released, for as long as their timeout
+    (raising socket.timeout).  Connections idle for more than
+    `idleTimeout' seconds are closed rather than
+    reused, and a request that fails on a reused
+    connection (because the server closed it in the
+    meantime) is retried once on a new one.
+
+    `timeout' is the socket timeout (in seconds)
+    of requests, or None for none, and
+    `connectTimeout' the time allowed to connect
+    (by default, `timeout').
+    """
+
+    def __init__(self,
+                 maxPerHost = 4,
+                 idleTimeout = 60,
+                 timeout = None,
+                 connectTimeout = None):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.connectTimeout = connectTimeout
+
+        self.lock = threading.Condition()
+
+        # key -> [(lastUsed, connection), ...],
+        # the most recently used last
+        self.idle = {}
+
+        # key -> number of connections in use
+        self.busy = {}
+
+        # Pool statistics
+        self.connects = 0
+        self.reuses = 0
+
+    def get(self, url, headers = {}, timeout = None, sample = None,
+            connectTimeout = None):
+        """
+        Sends a GET request for `url', following
+        redirects, and returns the Response.  It
+        must be closed once read from, which hands
+        its connection back to the pool.
+
+        `timeout' and `connectTimeout' override
+        the pool's timeouts for this request.  If a
+        metrics.Sample is given, the time spent
+        and bytes moved are added to it.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        if connectTimeout is None:
+            connectTimeout = self.connectTimeout
+        if connectTimeout is None:
+            connectTimeout = timeout
+        timeouts = (timeout, connectTimeout)
+
+        for i in xrange(maxRedirects + 1):
+            resp = self.__get(url, headers, timeouts, sample)
+            location = resp.getheader('location')
+            if resp.status in (301, 302, 303, 307) and location:
+                resp.close()
+                url = urlparse.urljoin(url, location)
+                continue
+            return resp
+
+        raise Exception, 'Too many redirects: %s' % url
+
+    def close(self):
+        """
+        Closes all of the idle connections.
+        """
+
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+        for conns in idle.values():
+            for lastUsed, conn in conns:
+                conn.close()
+
+    def release(self, key, conn):
+        """
+        Returns a connection taken for `key' to the
+        pool, or just frees its slot if `conn' is
+        None (it was closed instead).
+        """
+
+        self.lock.acquire()
+        try:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+            if conn is not None:
+                self.idle.setdefault(key, []).append((time.time(), conn))
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def __get(self, url, headers, timeouts, sample):
+        """
+        Sends a single GET request.  `timeouts' is
+        (timeout, connectTimeout).
+        """
+
+        parts = urlparse.urlparse(url)
+        scheme = parts.scheme.lower()
+        if scheme == 'http':
+            port = parts.port or httplib.HTTP_PORT
+        elif scheme == 'https':
+            port = parts.port or httplib.HTTPS_PORT
+        else:
+            raise Exception, 'Unsupported URL scheme: %s' % scheme
+        if not parts.hostname:
+            raise Exception, 'No host in URL: %s' % url
+
+        key = (scheme, parts.hostname, port)
+
+        target = parts.path or '/'
+        if parts.params:
+            target += ';' + parts.params
+        if parts.query:
+            target += '?' + parts.query
+
+        conn, reused = self.__acquire(key, timeouts, sample)
+        try:
+            try:
+                resp = self.__send(conn, target, headers, sample)
+            except socket.timeout:
+                raise
+            except (socket.error, httplib.HTTPException):
+                if not reused:
+                    raise
+
+                # The server most likely closed the
+                # connection while it sat idle
+                conn.close()
+                conn = self.__connect(key, timeouts, sample)
+                resp = self.__send(conn, target, headers, sample)
+        except:
+            conn.close()
+            self.release(key, None)
+            raise
+
+        return Response(self, key, conn, resp, sample)
+
+    def __send(self, conn, target, headers, sample):
+        if sample is None:
+            conn.request('GET', target, headers = headers)
+            return conn.getresponse()
+
+        start = time.time()
+        sent = conn.bytesSent
+        conn.request('GET', target, headers = headers)
+        resp = conn.getresponse()
+        sample.add('transfer', time.time() - start)
+        sample.bytesOut += conn.bytesSent - sent
+
+        # The status line and headers
+        sample.bytesIn += len('HTTP/1.1 %d %s\r\n\r\n' % (resp.status, resp.reason)) + \
+            sum([len(h) for h in resp.msg.headers])
+        return resp
+
+    def __acquire(self, key, timeouts, sample):
+        """
+        Takes a connection for `key', waiting for a
+        free slot if needed (up to the timeout).
+        Returns (connection, reused).
+        """
+
+        timeout = timeouts[0]
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.lock.acquire()
+        try:
+            while self.busy.get(key, 0) >= self.maxPerHost:
+                if deadline is None:
+                    self.lock.wait()
+                    continue
+                left = deadline - time.time()
+                if left <= 0:
+                    raise socket.timeout('Timed out waiting for a connection to %s' % key[1])
+                self.lock.wait(left)
+            self.busy[key] = self.busy.get(key, 0) + 1
+
+            # Drop connections that have been idle too
+            # long, then take the most recently used
+            now = time.time()
+            fresh = []
+            for lastUsed, c in self.idle.get(key, []):
+                if now - lastUsed <= self.idleTimeout:
+                    fresh.append((lastUsed, c))
+                else:
+                    c.close()
+
+            conn = None
+            if fresh:
+                lastUsed, conn = fresh.pop()
+            if fresh:
+                self.idle[key] = fresh
+            elif key in self.idle:
+                del self.idle[key]
+
+            if conn is not None:
+                self.reuses += 1
+        finally:
+            self.lock.release()
+
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+
+        try:
+            return (self.__connect(key, timeouts, sample), False)
+        except:
+            self.release(key, None)
+            raise
+
+    def __connect(self, key, timeouts, sample):
+        scheme, host, port = key
+        timeout, connectTimeout = timeouts
+
+        start = time.time()
+        if scheme == 'https':
+            conn = HTTPSConnection(host, port, timeout = connectTimeout)
+            conn.connect()
+        else:
+            # Look the host up separately, so
+            # that the time it takes shows
+            conn = HTTPConnection(host, port, timeout = connectTimeout)
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            if sample is not None:
+                now = time.time()
+                sample.add('dns', now - start)
+                start = now
+            conn.sock = connectTo(addresses, connectTimeout)
+        if sample is not None:
+            sample.add('connect', time.time() - start)
+
+        # Connected, so the request timeout applies
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        self.connects += 1
+        return conn
+
+class HTTPConnection(httplib.HTTPConnection):
+    """
+    Counts the bytes it sends.
+    """
+
+    bytesSent = 0
+
+    def send(self, data):
+        self.bytesSent += len(data)
+        httplib.HTTPConnection.send(self, data)
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    """
+    Counts the bytes it sends.
+    """
+
+    bytesSent = 0
+
+    def send(self, data):
+        self.bytesSent += len(data)
+        httplib.HTTPSConnection.send(self, data)
+
+def connectTo(addresses, timeout):
+    """
+    Connects to the first of `addresses' (as
+    returned by getaddrinfo) that accepts,
+    returning the socket.
+    """
+
+    error = socket.error('No addresses to connect to')
+    for family, socktype, proto, name, address in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(timeout)
+            sock.connect(address)
+            return sock
+        except socket.error, msg:
+            error = msg
+            if sock is not None:
+                sock.close()
+    raise error
+
+class Response:
+    """
+    A response read off a pooled connection.
+    """
+
+    def __init__(self, pool, key, conn, resp, sample = None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.sample = sample
+
+        self.status = resp.status
+        self.reason = resp.reason
+
+    def getheader(self, name, default = None):
+        return self.resp.getheader(name, default)
+
+    def read(self, size = None):
+        start = time.time()
+        if size is None:
+            data = self.resp.read()
+        else:
+            data = self.resp.read(size)
+
+        if self.sample is not None:
+            self.sample.add('transfer', time.time() - start)
+            self.sample.bytesIn += len(data)
+            self.sample.bodyBytes += len(data)
+        return data
+
+    def close(self):
+        """
+        Hands the connection back to the pool if
+        the server will keep it open, closing it
+        otherwise.
+        """
+
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+
+        keep = False
+        try:
+            # Skip whatever is left of the body,
+            # if there isn't too much of it
+            left = maxDrain
+            while not self.resp.isclosed() and left > 0:
+                data = self.resp.read(min(left, 16384))
+                if not data:
+                    break
+                left -= len(data)
+
+            keep = self.resp.isclosed() and \
+                not self.resp.will_close and conn.sock is not None
+        except (socket.error, httplib.HTTPException):
+            pass
+
+        if keep:
+            self.pool.release(self.key, conn)
+        else:
+            self.resp.close()
+            conn.close()
+            self.pool.release(self.key, None)
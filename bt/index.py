@@ -1,3 +1,233 @@
+"""
+Defines a status page for the torrents of a
+running session, in the Prometheus text format
+or as JSON.
 
-def index(req):
-  return ''
+Everything reported is read straight off the
+State and Tracker objects, which only keep plain
+counters up to date, so the page can be polled
+often without slowing anything else down.  The
+metrics of each tracker host (see bt.metrics)
+are reported alongside.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import json
+import state, metrics as hostMetrics
+
+# (name, type, help) of each metric, in output order
+metrics = [
+    ('bt_torrent_state', 'gauge',
+        'State of the torrent (see the ST_ constants in bt.state)'),
+    ('bt_torrent_uploaded_bytes', 'counter',
+        'Bytes uploaded'),
+    ('bt_torrent_downloaded_bytes', 'counter',
+        'Bytes downloaded'),
+    ('bt_tracker_interval_seconds', 'gauge',
+        'Announce interval last given by the tracker'),
+    ('bt_tracker_min_interval_seconds', 'gauge',
+        'Minimum announce interval last given by the tracker'),
+    ('bt_tracker_complete', 'gauge',
+        'Peers that have completed the torrent, as last reported'),
+    ('bt_tracker_incomplete', 'gauge',
+        'Peers that have not completed the torrent, as last reported'),
+    ('bt_tracker_requests_total', 'counter',
+        'Requests made to the tracker'),
+    ('bt_tracker_failures_total', 'counter',
+        'Requests to the tracker that failed'),
+    ('bt_tracker_last_request_timestamp_seconds', 'gauge',
+        'When the last request to the tracker was made'),
+    ('bt_tracker_latency_seconds', 'gauge',
+        'Time taken by the last request to the tracker'),
+    ('bt_tracker_latency_seconds_total', 'counter',
+        'Time taken by all requests to the tracker'),
+    ('bt_tracker_last_failure', 'gauge',
+        'Always 1, labelled with the kind of the last failure '
+        '(one of bt.tracker.failureKinds; the reason is in the JSON)'),
+]
+
+# (name, type, help, key) of each tracker host
+# metric, `key' being where it is in the snapshot
+hostMetricList = [
+    ('bt_tracker_host_requests_total', 'counter',
+        'Requests made to the tracker host', 'requests'),
+    ('bt_tracker_host_failures_total', 'counter',
+        'Requests to the tracker host that failed', 'failures'),
+    ('bt_tracker_host_warnings_total', 'counter',
+        'Responses from the tracker host carrying a warning', 'warnings'),
+    ('bt_tracker_host_sent_bytes_total', 'counter',
+        'Bytes sent to the tracker host', 'bytesOut'),
+    ('bt_tracker_host_received_bytes_total', 'counter',
+        'Bytes received from the tracker host', 'bytesIn'),
+    ('bt_tracker_host_body_bytes_total', 'counter',
+        'Response body bytes received, as sent', 'bodyBytes'),
+    ('bt_tracker_host_decoded_bytes_total', 'counter',
+        'Response body bytes received, once gunzipped', 'decodedBytes'),
+    ('bt_tracker_host_latency_seconds', 'histogram',
+        'Time taken by requests to the tracker host, by phase', 'latency'),
+]
+
+def index(req, format = 'prometheus'):
+    """
+    Serves the status of every torrent in
+    this process.  `format' is either
+    'prometheus' (the default) or 'json'.
+    """
+
+    stats = [status(s) for s in state.sessions()]
+    stats.sort(key = lambda st: (st['infoHash'], st['peerID']))
+    hosts = hostMetrics.snapshot()
+
+    if format == 'json':
+        req.content_type = 'application/json'
+        return toJSON(stats, hosts)
+
+    req.content_type = 'text/plain; version=0.0.4'
+    return toPrometheus(stats, hosts)
+
+def status(st):
+    """
+    Takes a snapshot of a State and its
+    Tracker, returned as a dictionary.
+    """
+
+    tor = st.torrent
+    tr = st.tracker
+
+    return {
+        'infoHash'      :   tor.hash.encode('hex'),
+        'peerID'        :   st.peerID.encode('hex'),
+        'name'          :   tor.fileName,
+        'state'         :   st.state,
+        'uploaded'      :   st.totalUploaded,
+        'downloaded'    :   st.totalDownloaded,
+        'tracker'       :   {
+            'url'           :   tr.tracker,
+            'interval'      :   tr.interval,
+            'minInterval'   :   tr.minInterval,
+            'complete'      :   tr.complete,
+            'incomplete'    :   tr.incomplete,
+            'requests'      :   tr.numRequests,
+            'failures'      :   tr.numFailures,
+            'lastRequest'   :   tr.lastRequest,
+            'lastLatency'   :   tr.lastLatency,
+            'totalLatency'  :   tr.totalLatency,
+            'lastFailure'   :   tr.lastFailure,
+            'lastFailureKind' : tr.lastFailureKind,
+            'lastWarning'   :   tr.lastWarning
+        }
+    }
+
+def toJSON(stats, hosts = {}):
+    """
+    Formats the snapshots returned by
+    status() and metrics.snapshot().
+    """
+
+    return json.dumps(toText({ 'torrents' : stats, 'trackers' : hosts }),
+                      indent = 1, sort_keys = True)
+
+def toText(value):
+    """
+    Copies a snapshot with its byte strings
+    (names, urls and failure reasons, as
+    sent by trackers) decoded as UTF-8, any
+    invalid bytes being replaced.
+    """
+
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict([(toText(k), toText(v)) for k, v in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [toText(v) for v in value]
+    return value
+
+def toPrometheus(stats, hosts = {}):
+    """
+    Formats the snapshots returned by
+    status() and metrics.snapshot() in the
+    Prometheus text exposition format.
+    """
+
+    samples = {}
+    for name, kind, help in metrics:
+        samples[name] = []
+
+    for st in stats:
+        # Several sessions may share a torrent,
+        # told apart by their peer IDs
+        tr = st['tracker']
+        labels = 'infohash="%s",peerid="%s",name="%s"' % \
+            (st['infoHash'], st['peerID'], escapeLabel(st['name']))
+
+        def add(name, value, extra = ''):
+            # Values not known yet are left out
+            if value is not None:
+                samples[name].append('%s{%s%s} %s' % \
+                    (name, labels, extra, formatValue(value)))
+
+        add('bt_torrent_state', st['state'])
+        add('bt_torrent_uploaded_bytes', st['uploaded'])
+        add('bt_torrent_downloaded_bytes', st['downloaded'])
+        add('bt_tracker_interval_seconds', tr['interval'])
+        add('bt_tracker_min_interval_seconds', tr['minInterval'])
+        add('bt_tracker_complete', tr['complete'])
+        add('bt_tracker_incomplete', tr['incomplete'])
+        add('bt_tracker_requests_total', tr['requests'])
+        add('bt_tracker_failures_total', tr['failures'])
+        add('bt_tracker_last_request_timestamp_seconds', tr['lastRequest'])
+        add('bt_tracker_latency_seconds', tr['lastLatency'])
+        add('bt_tracker_latency_seconds_total', tr['totalLatency'])
+        # Labelled with just the kind, as free
+        # form reasons would each make a series
+        if tr['lastFailureKind']:
+            add('bt_tracker_last_failure', 1,
+                ',reason="%s"' % tr['lastFailureKind'])
+
+    lines = []
+    for name, kind, help in metrics:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.extend(samples[name])
+
+    for name, kind, help, key in hostMetricList:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for host in sorted(hosts):
+            labels = 'host="%s"' % escapeLabel(host)
+            value = hosts[host][key]
+            if kind != 'histogram':
+                lines.append('%s{%s} %s' % (name, labels, formatValue(value)))
+                continue
+
+            for phase in hostMetrics.phases:
+                h = value[phase]
+                if not h['count']:
+                    continue
+                phaseLabels = '%s,phase="%s"' % (labels, phase)
+                bounds = [repr(b) for b in hostMetrics.buckets] + ['+Inf']
+                for bound, count in zip(bounds, h['buckets']):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % \
+                        (name, phaseLabels, bound, count))
+                lines.append('%s_sum{%s} %s' % (name, phaseLabels, formatValue(h['sum'])))
+                lines.append('%s_count{%s} %d' % (name, phaseLabels, h['count']))
+    return '\n'.join(lines) + '\n'
+
+def escapeLabel(s):
+    """
+    Escapes a Prometheus label value,
+    which must be valid UTF-8.
+    """
+
+    if not isinstance(s, unicode):
+        s = str(s).decode('utf-8', 'replace')
+    s = s.encode('utf-8')
+    return s.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,311 @@
+"""
+Defines an index over a collection of torrent
+files, answering which torrent has a given info
+hash, name, or file in it.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import os, marshal, tempfile
+import torrent, storage
+
+# Bumped whenever the saved entries change
+libraryVersion = 1
+
+# Torrents handed to a worker at a time
+chunkSize = 16
+
+def readTorrent(path):
+    """
+    Parses the torrent file at `path', returning:
+
+    (path, size, mtime, fields, error)
+
+    where `fields' is (hash, name, length, files),
+    `files' being the paths of the files of the
+    download relative to the download directory,
+    or None if the file could not be parsed (and
+    `error' says why).
+
+    This is the unit of work handed to the
+    worker pool, so it only takes and returns
+    plain (picklable) values.
+    """
+
+    try:
+        st = os.stat(path)
+    except OSError, msg:
+        return (path, None, None, None, str(msg))
+
+    try:
+        # The file table is always needed, so
+        # a lazy torrent would only parse twice
+        tor = torrent.Torrent(path)
+        if tor.fileMode == 'single-file':
+            files = (tor.fileName,)
+        else:
+            files = tuple([os.path.join(tor.fileName, f['path'])
+                                for f in tor.files])
+        fields = (tor.hash, tor.fileName, tor.length, files)
+    except Exception, msg:
+        return (path, st.st_size, st.st_mtime, None, str(msg))
+
+    return (path, st.st_size, st.st_mtime, fields, '')
+
+class Library:
+    """
+    Indexes the torrent files found under a set of
+    directories.  Every torrent is kept as:
+
+    path -> (size, mtime, fields, error)
+
+    with `fields' as returned by readTorrent(), from
+    which three lookup tables are built:
+
+    byHash      : info hash -> set of torrent paths
+    byName      : download name -> set of torrent paths
+    byFile      : file path (relative to the download
+                  directory) -> set of torrent paths
+
+    scan() only parses the torrent files whose size or
+    modification time changed since they were last
+    indexed.  If `path' is given the index is loaded
+    from there, and save() writes it back.
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+
+        self.entries = {}
+        self.byHash = {}
+        self.byName = {}
+        self.byFile = {}
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def scan(self,
+             directory,
+             workers = None,
+             processes = True,
+             progress = None):
+        """
+        Brings the index up to date with the
+        '.torrent' files under `directory',
+        parsing new and changed ones in parallel.
+        Torrents that have gone from `directory'
+        are dropped.  Returns:
+
+        (added, updated, removed)
+
+        workers     : Number of processes (or threads if
+                      `processes' is False), one per CPU
+                      by default
+        progress    : Optional callback, called as
+                      progress(torrentsParsed, numToParse)
+        """
+
+        directory = os.path.abspath(directory)
+
+        found = {}
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.endswith('.torrent'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (st.st_size, st.st_mtime)
+
+        # Work out what changed
+        stale = []
+        for path, entry in self.entries.items():
+            if path == directory or path.startswith(os.path.join(directory, '')):
+                if found.get(path) != entry[:2]:
+                    stale.append(path)
+
+        todo = [path for path in found
+                    if path not in self.entries or path in stale]
+        todo.sort()
+
+        added = len([path for path in todo if path not in self.entries])
+        updated = len(todo) - added
+        removed = len([path for path in stale if path not in found])
+
+        for path in stale:
+            self.__remove(path)
+
+        if todo:
+            if len(todo) < chunkSize:
+                # Not worth starting a pool for
+                results = map(readTorrent, todo)
+            else:
+                pool = storage.newPool(workers, processes)
+                try:
+                    results = []
+                    for res in pool.imap_unordered(readTorrent, todo, chunkSize):
+                        results.append(res)
+                        if progress:
+                            progress(len(results), len(todo))
+                except:
+                    pool.terminate()
+                    pool.join()
+                    raise
+                pool.close()
+                pool.join()
+
+            for path, size, mtime, fields, error in results:
+                if size is not None:
+                    self.__add(path, (size, mtime, fields, error))
+
+        return (added, updated, removed)
+
+    def lookup(self, infoHash):
+        """
+        Returns the paths of the torrents with
+        the given (raw, 20 byte) info hash.
+        """
+
+        return sorted(self.byHash.get(infoHash, ()))
+
+    def named(self, name):
+        """
+        Returns the paths of the torrents
+        whose download is called `name'.
+        """
+
+        return sorted(self.byName.get(name, ()))
+
+    def containing(self, path):
+        """
+        Returns the paths of the torrents with a
+        file at `path' (relative to the download
+        directory, starting with the download name).
+        """
+
+        return sorted(self.byFile.get(os.path.normpath(path), ()))
+
+    def info(self, path):
+        """
+        Returns what is known of the torrent
+        file at `path' as a dictionary, or None
+        if it isn't indexed.
+        """
+
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None:
+            return None
+
+        size, mtime, fields, error = entry
+        d = {
+            'torrent'   :   os.path.abspath(path),
+            'error'     :   error
+        }
+        if fields is not None:
+            d['hash'], d['name'], d['length'], d['files'] = fields
+        return d
+
+    def errors(self):
+        """
+        Returns { path : error } for the torrent
+        files that could not be parsed.
+        """
+
+        d = {}
+        for path, entry in self.entries.items():
+            if entry[2] is None:
+                d[path] = entry[3]
+        return d
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self, path = None):
+        """
+        Writes the index to `path' (by
+        default, the path it was loaded from).
+        """
+
+        path = path or self.path
+        if path is None:
+            raise Exception, 'No path to save the library to'
+
+        # Write to a temporary file first so that
+        # a crash never leaves a partial index
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        try:
+            os.write(fd, marshal.dumps((libraryVersion, self.entries), 2))
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+    def load(self, path = None):
+        """
+        Replaces the index with the one
+        saved at `path'.  An index saved by
+        another version is ignored.
+        """
+
+        path = path or self.path
+        fd = open(path, 'rb')
+        try:
+            try:
+                version, entries = marshal.load(fd)
+            except (EOFError, ValueError, TypeError):
+                version, entries = None, {}
+        finally:
+            fd.close()
+
+        self.entries = {}
+        self.byHash = {}
+        self.byName = {}
+        self.byFile = {}
+
+        if version != libraryVersion:
+            return
+
+        for path, entry in entries.items():
+            self.__add(path, entry)
+
+    def __add(self, path, entry):
+        self.entries[path] = entry
+
+        fields = entry[2]
+        if fields is None:
+            return
+
+        infoHash, name, length, files = fields
+        self.byHash.setdefault(infoHash, set()).add(path)
+        self.byName.setdefault(name, set()).add(path)
+        for f in files:
+            self.byFile.setdefault(f, set()).add(path)
+
+    def __remove(self, path):
+        entry = self.entries.pop(path)
+
+        fields = entry[2]
+        if fields is None:
+            return
+
+        infoHash, name, length, files = fields
+        discard(self.byHash, infoHash, path)
+        discard(self.byName, name, path)
+        for f in files:
+            discard(self.byFile, f, path)
+
+def discard(table, key, path):
+    """
+    Removes `path' from the set
+    under `key', and drops the set
+    once it is empty.
+    """
+
+    paths = table.get(key)
+    if paths is not None:
+        paths.discard(path)
+        if not paths:
+            del table[key]
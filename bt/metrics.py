@@ -0,0 +1,314 @@
+"""
+Defines metrics kept per tracker host: how
+many requests were made and how many failed,
+where their time went, and how many bytes
+they moved.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import bisect, threading, time, urlparse
+
+# Phases a request's time is split into.  DNS and
+# connect are only seen by requests that open a
+# connection (HTTPS requests count the DNS lookup
+# as part of connecting); transfer covers sending
+# the request and reading the response; total is
+# the whole request, end to end.
+phases = ('dns', 'connect', 'transfer', 'gunzip', 'decode', 'total')
+
+# Upper bounds of the latency histogram
+# buckets (seconds), with +Inf after
+buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# Set to False to stop collecting
+enabled = True
+
+# host -> HostMetrics
+hosts = {}
+hostsLock = threading.Lock()
+
+# Called as listener(host, sample) after
+# every request, from the requesting thread
+listeners = []
+
+# Number of exceptions raised by listeners,
+# which are dropped rather than failing
+# the request being recorded
+listenerErrors = 0
+
+def addListener(listener):
+    """
+    Has `listener' called after every
+    request to a tracker, to export what
+    it measured elsewhere.
+    """
+
+    listeners.append(listener)
+
+def removeListener(listener):
+    if listener in listeners:
+        listeners.remove(listener)
+
+def newSample():
+    """
+    A Sample to fill in for a new request,
+    or None if metrics are turned off.
+    """
+
+    if not enabled:
+        return None
+    return Sample()
+
+def record(url, sample, error = None, warning = None):
+    """
+    Adds a finished request to the metrics of
+    its host, and hands it to the listeners.
+    Does nothing if `sample' is None.
+    """
+
+    global listenerErrors
+
+    if sample is None:
+        return
+
+    sample.add('total', time.time() - sample.start)
+    if error is not None:
+        sample.error = str(error)
+    sample.warning = warning
+
+    host = hostOf(url)
+    metricsFor(host).add(sample)
+    for listener in listeners[:]:
+        try:
+            listener(host, sample)
+        except Exception:
+            hostsLock.acquire()
+            try:
+                listenerErrors += 1
+            finally:
+                hostsLock.release()
+
+def hostOf(url):
+    """
+    The host metrics are kept under for
+    a tracker url: 'scheme://host:port'.
+    """
+
+    parts = urlparse.urlparse(url)
+    scheme = parts.scheme.lower()
+    port = parts.port
+    if port is None:
+        port = { 'http' : 80, 'https' : 443 }.get(scheme, 0)
+    return '%s://%s:%d' % (scheme, parts.hostname, port)
+
+def metricsFor(host):
+    hostsLock.acquire()
+    try:
+        if host not in hosts:
+            hosts[host] = HostMetrics()
+        return hosts[host]
+    finally:
+        hostsLock.release()
+
+def snapshot():
+    """
+    Returns { host : HostMetrics.snapshot() }
+    for every host requests were made to.
+    """
+
+    hostsLock.acquire()
+    try:
+        items = hosts.items()
+    finally:
+        hostsLock.release()
+
+    snap = {}
+    for host, m in items:
+        snap[host] = m.snapshot()
+    return snap
+
+def slowest(n = 10):
+    """
+    The `n' hosts the most time has been spent
+    on, as (seconds, host), most first.
+    """
+
+    l = [(s['latency']['total']['sum'], host)
+            for host, s in snapshot().items()]
+    l.sort(reverse = True)
+    return l[:n]
+
+def reset():
+    """
+    Forgets every host's metrics.
+    """
+
+    hostsLock.acquire()
+    try:
+        hosts.clear()
+    finally:
+        hostsLock.release()
+
+class Sample:
+    """
+    What a single request measured, filled in
+    by each layer it goes through.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+
+        # phase -> seconds
+        self.phases = {}
+
+        # Bytes sent and received on the wire
+        self.bytesOut = 0
+        self.bytesIn = 0
+
+        # Bytes of response body as received,
+        # and once gunzipped
+        self.bodyBytes = 0
+        self.decodedBytes = 0
+
+        self.error = None
+        self.warning = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+class Histogram:
+    """
+    Counts of the values observed falling
+    in each of the `buckets', cumulated
+    only when read.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates the `q'th quantile (0-1) as the
+        upper bound of the bucket it falls in, or
+        the largest bound if it is past all of them
+        (so that snapshots stay valid JSON).
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i in xrange(len(buckets)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return buckets[i]
+        return buckets[-1]
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for n in self.counts:
+            seen += n
+            cumulative.append(seen)
+        return {
+            'buckets'   :   cumulative,
+            'count'     :   self.count,
+            'sum'       :   self.sum
+        }
+
+class HostMetrics:
+    """
+    Metrics of every request to one
+    tracker host.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.failures = 0
+        self.warnings = 0
+
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.bodyBytes = 0
+        self.decodedBytes = 0
+
+        # phase -> Histogram
+        self.latency = {}
+        for phase in phases:
+            self.latency[phase] = Histogram()
+
+        self.lastFailure = ''
+        self.lastWarning = ''
+
+    def add(self, sample):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if sample.error is not None:
+                self.failures += 1
+                self.lastFailure = sample.error
+            if sample.warning:
+                self.warnings += 1
+                self.lastWarning = sample.warning
+
+            self.bytesOut += sample.bytesOut
+            self.bytesIn += sample.bytesIn
+            self.bodyBytes += sample.bodyBytes
+            self.decodedBytes += sample.decodedBytes
+
+            for phase, seconds in sample.phases.iteritems():
+                self.latency[phase].observe(seconds)
+        finally:
+            self.lock.release()
+
+    def compressionRatio(self):
+        """
+        Response body bytes once gunzipped per
+        byte received, or None before any.
+        """
+
+        if not self.bodyBytes:
+            return None
+        return float(self.decodedBytes) / self.bodyBytes
+
+    def snapshot(self):
+        """
+        Returns a copy of the metrics
+        as a dictionary.
+        """
+
+        self.lock.acquire()
+        try:
+            latency = {}
+            for phase, h in self.latency.iteritems():
+                latency[phase] = h.snapshot()
+                latency[phase]['p50'] = h.quantile(0.5)
+                latency[phase]['p99'] = h.quantile(0.99)
+
+            return {
+                'requests'          :   self.requests,
+                'failures'          :   self.failures,
+                'warnings'          :   self.warnings,
+                'bytesOut'          :   self.bytesOut,
+                'bytesIn'           :   self.bytesIn,
+                'bodyBytes'         :   self.bodyBytes,
+                'decodedBytes'      :   self.decodedBytes,
+                'compressionRatio'  :   self.compressionRatio(),
+                'latency'           :   latency,
+                'lastFailure'       :   self.lastFailure,
+                'lastWarning'       :   self.lastWarning
+            }
+        finally:
+            self.lock.release()
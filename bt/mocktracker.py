@@ -0,0 +1,456 @@
+"""
+Defines a tracker that runs in process, for
+testing and load testing the tracker client
+without a real tracker.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import BaseHTTPServer, SocketServer, urlparse, socket, struct
+import threading, random, time, sys, zlib
+import bencode, udp
+
+class MockTracker:
+    """
+    A tracker serving announces and scrapes over
+    HTTP, and over UDP (BEP 15) if `udpPort' is
+    given (0 picks any free port).  It keeps a real
+    swarm per torrent, so peers announced show up
+    in the responses to the others.
+
+    latency     : Seconds each response is delayed by,
+                  or a (min, max) range to pick from
+    failureRate : Fraction of announces answered with
+                  a 'failure reason'
+    errorRate   : Fraction of HTTP requests answered
+                  with a 500 error (UDP requests that
+                  are dropped instead)
+    gzip        : Whether to gzip HTTP responses
+    interval    : Announce interval handed out
+    minInterval : Min interval handed out (optional)
+
+    Compact or dict peer lists are returned as the
+    client asks.  Counts of what was served are kept
+    in `stats', 'connects' counting both the HTTP
+    connections accepted and the UDP connects.
+    """
+
+    def __init__(self,
+                 host = '127.0.0.1',
+                 port = 0,
+                 udpPort = None,
+                 latency = 0.0,
+                 failureRate = 0.0,
+                 errorRate = 0.0,
+                 gzip = False,
+                 interval = 1800,
+                 minInterval = None,
+                 seed = None):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.errorRate = errorRate
+        self.gzip = gzip
+        self.interval = interval
+        self.minInterval = minInterval
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # infoHash -> { peerKey : (ip, port, peerID, left) }
+        self.swarms = {}
+
+        # infoHash -> times completed
+        self.downloads = {}
+
+        # UDP connection id -> when it was handed out
+        self.connectionIDs = {}
+
+        self.stats = {
+            'announces'     :   0,
+            'scrapes'       :   0,
+            'failures'      :   0,
+            'errors'        :   0,
+            'connects'      :   0
+        }
+
+        self.http = HTTPServer((host, port), HTTPHandler)
+        self.http.tracker = self
+        self.host, self.port = self.http.server_address[:2]
+
+        self.udp = None
+        if udpPort is not None:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind((host, udpPort))
+            self.udpPort = self.udp.getsockname()[1]
+
+        self.threads = []
+
+    def announceURL(self):
+        return 'http://%s:%d/announce' % (self.host, self.port)
+
+    def udpURL(self):
+        return 'udp://%s:%d/announce' % (self.host, self.udpPort)
+
+    def start(self):
+        """
+        Starts serving, in background threads.
+        """
+
+        t = threading.Thread(target = self.http.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.threads.append(t)
+
+        if self.udp is not None:
+            t = threading.Thread(target = self.__serveUDP)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.http.shutdown()
+        self.http.server_close()
+        self.http.closeAll()
+        if self.udp is not None:
+            self.udp.close()
+
+    def announce(self, infoHash, peerID, ip, port, left, event, numwant):
+        """
+        Updates the swarm of a torrent with an
+        announce, returning the response as a
+        dictionary, peers as (ip, port, peerID)
+        tuples.
+        """
+
+        key = (ip, port)
+
+        self.lock.acquire()
+        try:
+            self.stats['announces'] += 1
+            if self.random.random() < self.failureRate:
+                self.stats['failures'] += 1
+                return { 'failure reason' : 'Injected failure' }
+
+            swarm = self.swarms.setdefault(infoHash, {})
+            if event == 'stopped':
+                swarm.pop(key, None)
+            else:
+                if event == 'completed':
+                    self.downloads[infoHash] = self.downloads.get(infoHash, 0) + 1
+                swarm[key] = (ip, port, peerID, left)
+
+            others = [p for k, p in swarm.iteritems() if k != key]
+            if numwant < len(others):
+                others = self.random.sample(others, numwant)
+
+            complete = len([p for p in swarm.itervalues() if p[3] == 0])
+            res = {
+                'interval'      :   self.interval,
+                'complete'      :   complete,
+                'incomplete'    :   len(swarm) - complete,
+                'peers'         :   [(p[0], p[1], p[2]) for p in others]
+            }
+            if self.minInterval:
+                res['min interval'] = self.minInterval
+            return res
+        finally:
+            self.lock.release()
+
+    def scrape(self, infoHashes):
+        """
+        Returns the scrape response
+        for `infoHashes'.
+        """
+
+        self.lock.acquire()
+        try:
+            self.stats['scrapes'] += 1
+            files = {}
+            for infoHash in infoHashes:
+                if infoHash not in self.swarms:
+                    continue
+                swarm = self.swarms[infoHash]
+                complete = len([p for p in swarm.itervalues() if p[3] == 0])
+                files[infoHash] = {
+                    'complete'      :   complete,
+                    'downloaded'    :   self.downloads.get(infoHash, 0),
+                    'incomplete'    :   len(swarm) - complete
+                }
+            return { 'files' : files }
+        finally:
+            self.lock.release()
+
+    def delay(self):
+        """
+        Seconds to hold the next response for.
+        """
+
+        if isinstance(self.latency, tuple):
+            lo, hi = self.latency
+            return self.random.uniform(lo, hi)
+        return self.latency
+
+    def injectError(self):
+        self.lock.acquire()
+        try:
+            if self.random.random() < self.errorRate:
+                self.stats['errors'] += 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def __serveUDP(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(2048)
+            except socket.error:
+                # Closed by stop()
+                return
+
+            if self.injectError():
+                continue
+
+            d = self.delay()
+            if d > 0:
+                t = threading.Timer(d, self.__handleUDP, (data, addr))
+                t.setDaemon(True)
+                t.start()
+            else:
+                self.__handleUDP(data, addr)
+
+    def __handleUDP(self, data, addr):
+        if len(data) < 16:
+            return
+        connectionID, action, tid = struct.unpack('!QII', data[:16])
+
+        if action == udp.ACTION_CONNECT:
+            if connectionID != udp.protocolID:
+                return
+            connectionID = self.random.getrandbits(64)
+            self.lock.acquire()
+            try:
+                self.stats['connects'] += 1
+                self.connectionIDs[connectionID] = time.time()
+            finally:
+                self.lock.release()
+            reply = struct.pack('!IIQ', udp.ACTION_CONNECT, tid, connectionID)
+            self.__sendUDP(reply, addr)
+            return
+
+        # Connection ids are good for two minutes
+        issued = self.connectionIDs.get(connectionID)
+        if issued is None or time.time() - issued > 120:
+            self.__sendUDP(struct.pack('!II', udp.ACTION_ERROR, tid) +
+                           'Connection ID expired', addr)
+            return
+
+        if action == udp.ACTION_ANNOUNCE and len(data) >= 98:
+            infoHash, peerID, downloaded, left, uploaded, event, ip, key, numwant, port = \
+                struct.unpack('!20s20sQQQIIIiH', data[16:98])
+            if ip:
+                ip = socket.inet_ntoa(struct.pack('!I', ip))
+            else:
+                ip = addr[0]
+            if numwant < 0:
+                numwant = 50
+            for name, value in udp.events.items():
+                if value == event:
+                    event = name
+                    break
+
+            res = self.announce(infoHash, peerID, ip, port, left, event, numwant)
+            if 'failure reason' in res:
+                reply = struct.pack('!II', udp.ACTION_ERROR, tid) + res['failure reason']
+            else:
+                reply = struct.pack('!IIIII', udp.ACTION_ANNOUNCE, tid,
+                                    res['interval'], res['incomplete'], res['complete'])
+                reply += compactPeers(res['peers'])
+            self.__sendUDP(reply, addr)
+
+        elif action == udp.ACTION_SCRAPE:
+            hashes = data[16:]
+            hashes = [hashes[i:i + 20] for i in xrange(0, len(hashes) - 19, 20)]
+            files = self.scrape(hashes)['files']
+            reply = struct.pack('!II', udp.ACTION_SCRAPE, tid)
+            for infoHash in hashes:
+                st = files.get(infoHash, { 'complete' : 0, 'downloaded' : 0, 'incomplete' : 0 })
+                reply += struct.pack('!III', st['complete'], st['downloaded'], st['incomplete'])
+            self.__sendUDP(reply, addr)
+
+    def __sendUDP(self, data, addr):
+        try:
+            self.udp.sendto(data, addr)
+        except socket.error:
+            pass
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Keeps track of the connections it has open, so
+    that kept alive ones can be closed on stopping.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.connections = set()
+        self.connectionsLock = threading.Lock()
+
+    def process_request(self, request, clientAddress):
+        self.connectionsLock.acquire()
+        try:
+            self.connections.add(request)
+        finally:
+            self.connectionsLock.release()
+
+        tracker = self.tracker
+        tracker.lock.acquire()
+        try:
+            tracker.stats['connects'] += 1
+        finally:
+            tracker.lock.release()
+        SocketServer.ThreadingMixIn.process_request(self, request, clientAddress)
+
+    def shutdown_request(self, request):
+        self.connectionsLock.acquire()
+        try:
+            self.connections.discard(request)
+        finally:
+            self.connectionsLock.release()
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def closeAll(self, wait = 1.0):
+        """
+        Ends every open connection, and waits up
+        to `wait' seconds for the threads serving
+        them to finish.
+        """
+
+        self.connectionsLock.acquire()
+        try:
+            connections = list(self.connections)
+        finally:
+            self.connectionsLock.release()
+
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        end = time.time() + wait
+        while self.connections and time.time() < end:
+            time.sleep(0.01)
+
+    def handle_error(self, request, clientAddress):
+        # Clients dropping kept alive connections
+        # aren't worth a traceback
+        if not issubclass(sys.exc_info()[0], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /announce and /scrape,
+    keeping connections alive.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Buffer the response so it goes out in one piece
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        tracker = self.server.tracker
+        parts = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(parts.query)
+
+        d = tracker.delay()
+        if d > 0:
+            time.sleep(d)
+
+        if tracker.injectError():
+            self.__reply(500, 'Injected error')
+            return
+
+        name = parts.path.rsplit('/', 1)[-1]
+        try:
+            if name.startswith('announce'):
+                res = self.__announce(tracker, query)
+            elif name.startswith('scrape'):
+                res = tracker.scrape(query.get('info_hash', []))
+            else:
+                self.__reply(404, 'Not found')
+                return
+        except (KeyError, ValueError), msg:
+            res = { 'failure reason' : 'Bad request: %s' % str(msg) }
+
+        body = bencode.encode(res)
+        headers = []
+        if tracker.gzip:
+            zipper = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = zipper.compress(body) + zipper.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+        self.__reply(200, body, headers)
+
+    def __announce(self, tracker, query):
+        def arg(name, default = None):
+            if name in query:
+                return query[name][0]
+            if default is None:
+                raise KeyError, name
+            return default
+
+        infoHash = arg('info_hash')
+        peerID = arg('peer_id')
+        port = int(arg('port'))
+        left = int(arg('left'))
+        numwant = int(arg('numwant', '50'))
+        ip = arg('ip', self.client_address[0])
+
+        res = tracker.announce(infoHash, peerID, ip, port, left,
+                               arg('event', ''), numwant)
+        if 'failure reason' in res:
+            return res
+
+        if arg('compact', '0') == '1':
+            res['peers'] = compactPeers(res['peers'])
+        else:
+            noPeerID = arg('no_peer_id', '0') == '1'
+            peers = []
+            for ip, port, peerID in res['peers']:
+                peer = { 'ip' : ip, 'port' : port }
+                if not noPeerID:
+                    peer['peer id'] = peerID
+                peers.append(peer)
+            res['peers'] = peers
+        return res
+
+    def __reply(self, code, body, headers = []):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def compactPeers(peers):
+    """
+    Packs (ip, port, ...) tuples into a compact
+    peer list, skipping those that aren't IPv4.
+    """
+
+    l = []
+    for peer in peers:
+        try:
+            l.append(socket.inet_aton(peer[0]) + struct.pack('!H', peer[1]))
+        except socket.error:
+            pass
+    return ''.join(l)
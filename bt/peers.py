@@ -0,0 +1,293 @@
+"""
+Defines a store of the peers of a torrent,
+merged from every announce to every tracker.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import heapq, socket, struct, time
+
+# What a peer is doing
+PEER_READY = 0
+PEER_WAITING = 1
+PEER_BUSY = 2
+PEER_CONNECTED = 3
+
+# Fields of a peer record (a list, to
+# keep thousands of them small)
+IP = 0
+PORT = 1
+FIRST_SEEN = 2
+LAST_SEEN = 3
+TIMES_SEEN = 4
+FAILURES = 5
+RETRY_AT = 6
+STATUS = 7
+VERSION = 8
+
+class PeerStore:
+    """
+    Keeps each peer of a torrent once, however many
+    announces and trackers it came from, along with
+    when it was first and last seen and how often
+    connecting to it has failed.
+
+    Peers not seen for `ttl' seconds are dropped,
+    and at most `maxPeers' are kept: past that, the
+    peers least likely to be worth connecting to go
+    (never those being connected to).  So that new
+    peers always have room, no more than `maxActive'
+    are handed out or connected at once.
+
+    candidates() hands out the best peers to connect
+    to: those that haven't failed, most recently seen
+    first, then those that have, once they have waited
+    out their backoff (`retryDelay' seconds, doubled
+    for every failure in a row).  Each peer handed out
+    is reported back with connected() or failed().
+    """
+
+    def __init__(self, ttl = 3600, maxPeers = 2000, retryDelay = 60, maxActive = 200):
+        self.ttl = ttl
+        self.maxPeers = maxPeers
+        self.retryDelay = retryDelay
+        self.maxActive = min(maxActive, maxPeers / 2)
+
+        # key -> record
+        self.peers = {}
+
+        # Keys of the peers handed out or
+        # connected to (PEER_BUSY or PEER_CONNECTED)
+        self.active = set()
+
+        # Heaps of (priority..., key, version); an
+        # entry is stale unless its version is the
+        # record's.  Peers ready to be handed out:
+        self.ready = []
+        # and peers backing off after a failure:
+        self.waiting = []
+
+        # Last version given to a record, so that
+        # a dropped peer coming back never matches
+        # its old entries
+        self.version = 0
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, peer):
+        return peerKey(peer[0], peer[1]) in self.peers
+
+    def add(self, peers, now = None):
+        """
+        Merges a list of (ip, port) tuples, as
+        returned by an announce, into the store.
+        Returns how many new peers were kept.
+        """
+
+        if now is None:
+            now = time.time()
+
+        new = []
+        for ip, port in peers:
+            key = peerKey(ip, port)
+            rec = self.peers.get(key)
+            if rec is None:
+                rec = [ip, port, now, now, 1, 0, 0, PEER_READY, 0]
+                self.peers[key] = rec
+                self.__push(key, rec)
+                new.append(key)
+            else:
+                rec[LAST_SEEN] = now
+                rec[TIMES_SEEN] += 1
+                if rec[STATUS] == PEER_READY:
+                    # Seen more recently, so ranks higher
+                    self.__push(key, rec)
+
+        if len(self.peers) > self.maxPeers:
+            self.expire(now)
+        if len(self.peers) > self.maxPeers:
+            self.__evict(len(self.peers) - self.maxPeers)
+
+        # Don't let stale heap entries pile up
+        if len(self.ready) + len(self.waiting) > 4 * len(self.peers) + 64:
+            self.__rebuild()
+
+        return len([key for key in new if key in self.peers])
+
+    def candidates(self, n, now = None):
+        """
+        Hands out up to `n' of the best peers to
+        connect to, as (ip, port) tuples (fewer
+        if `maxActive' are already active).
+        """
+
+        if now is None:
+            now = time.time()
+
+        # Peers done backing off are ready again
+        while self.waiting and self.waiting[0][0] <= now:
+            retryAt, key, version = heapq.heappop(self.waiting)
+            rec = self.peers.get(key)
+            if rec is not None and rec[VERSION] == version:
+                rec[STATUS] = PEER_READY
+                self.__push(key, rec)
+
+        n = min(n, self.maxActive - len(self.active))
+
+        peers = []
+        while self.ready and len(peers) < n:
+            failures, lastSeen, key, version = heapq.heappop(self.ready)
+            rec = self.peers.get(key)
+            if rec is None or rec[VERSION] != version:
+                continue
+            if now - rec[LAST_SEEN] > self.ttl:
+                del self.peers[key]
+                continue
+
+            rec[STATUS] = PEER_BUSY
+            rec[VERSION] = self.__nextVersion()
+            self.active.add(key)
+            peers.append((rec[IP], rec[PORT]))
+        return peers
+
+    def connected(self, peer):
+        """
+        A peer handed out was connected to.
+        """
+
+        key = peerKey(peer[0], peer[1])
+        rec = self.peers.get(key)
+        if rec is not None:
+            self.active.add(key)
+            rec[FAILURES] = 0
+            rec[STATUS] = PEER_CONNECTED
+            rec[VERSION] = self.__nextVersion()
+
+    def disconnected(self, peer, now = None):
+        """
+        A connected peer is available to
+        be handed out again.
+        """
+
+        key = peerKey(peer[0], peer[1])
+        rec = self.peers.get(key)
+        if rec is not None:
+            if now is None:
+                now = time.time()
+            rec[LAST_SEEN] = now
+            rec[STATUS] = PEER_READY
+            self.active.discard(key)
+            self.__push(key, rec)
+
+    def failed(self, peer, now = None):
+        """
+        Connecting to a peer handed
+        out (or connected) failed.
+        """
+
+        key = peerKey(peer[0], peer[1])
+        rec = self.peers.get(key)
+        if rec is None:
+            return
+
+        if now is None:
+            now = time.time()
+        self.active.discard(key)
+        rec[FAILURES] += 1
+        rec[RETRY_AT] = now + self.retryDelay * 2**min(rec[FAILURES] - 1, 16)
+        rec[STATUS] = PEER_WAITING
+        rec[VERSION] = self.__nextVersion()
+        heapq.heappush(self.waiting, (rec[RETRY_AT], key, rec[VERSION]))
+
+    def info(self, peer):
+        """
+        Returns what is known of a peer as
+        a dictionary, or None.
+        """
+
+        rec = self.peers.get(peerKey(peer[0], peer[1]))
+        if rec is None:
+            return None
+        return {
+            'ip'        :   rec[IP],
+            'port'      :   rec[PORT],
+            'firstSeen' :   rec[FIRST_SEEN],
+            'lastSeen'  :   rec[LAST_SEEN],
+            'timesSeen' :   rec[TIMES_SEEN],
+            'failures'  :   rec[FAILURES],
+            'retryAt'   :   rec[RETRY_AT],
+            'status'    :   rec[STATUS]
+        }
+
+    def expire(self, now = None):
+        """
+        Drops the peers not seen for `ttl' seconds
+        (unless connected to), returning how many.
+        """
+
+        if now is None:
+            now = time.time()
+
+        stale = [key for key, rec in self.peers.iteritems()
+                    if now - rec[LAST_SEEN] > self.ttl and
+                        rec[STATUS] != PEER_CONNECTED]
+        for key in stale:
+            del self.peers[key]
+            self.active.discard(key)
+        return len(stale)
+
+    def __evict(self, n):
+        """
+        Drops the `n' least promising peers that
+        aren't being connected to (the most failed,
+        then the stalest).  There are always enough,
+        active peers being capped at `maxActive'.
+        """
+
+        recs = [(rec[FAILURES], -rec[LAST_SEEN], key)
+                    for key, rec in self.peers.iteritems()
+                        if key not in self.active]
+        for failures, lastSeen, key in heapq.nlargest(n, recs):
+            del self.peers[key]
+
+    def __nextVersion(self):
+        self.version += 1
+        return self.version
+
+    def __push(self, key, rec):
+        rec[VERSION] = self.__nextVersion()
+        heapq.heappush(self.ready,
+                       (rec[FAILURES], -rec[LAST_SEEN], key, rec[VERSION]))
+
+    def __rebuild(self):
+        """
+        Rebuilds both heaps from the
+        records, without stale entries.
+        """
+
+        self.ready = []
+        self.waiting = []
+        for key, rec in self.peers.iteritems():
+            if rec[STATUS] == PEER_READY:
+                self.ready.append((rec[FAILURES], -rec[LAST_SEEN], key, rec[VERSION]))
+            elif rec[STATUS] == PEER_WAITING:
+                self.waiting.append((rec[RETRY_AT], key, rec[VERSION]))
+        heapq.heapify(self.ready)
+        heapq.heapify(self.waiting)
+
+def peerKey(ip, port):
+    """
+    The key a peer is stored under: its address
+    packed as in a compact peer list (6 bytes for
+    IPv4, 18 for IPv6), or 'host:port' for peers
+    given by host name.
+    """
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip) + struct.pack('!H', port)
+        except (socket.error, ValueError):
+            pass
+    return '%s:%d' % (ip, port)
@@ -0,0 +1,298 @@
+"""
+Defines a scheduler that keeps the torrents of
+a session announced to their trackers, as often
+as the trackers ask and no more.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import heapq, random, threading, time, urlparse
+import multiprocessing.pool
+
+# Interval used until a tracker gives one (seconds)
+defaultInterval = 1800
+
+class Scheduler:
+    """
+    Announces each State added to it to its tracker:
+    'started' first, then regular updates every
+    `interval' the tracker asks for.  All of the
+    announce times are kept in a single heap, looked
+    after by one thread.
+
+    Announces are made `jitter' (a fraction of the
+    interval) early at random, so torrents added at
+    the same time drift apart, but never sooner than
+    the tracker's min interval allows.  Failed
+    announces are retried after `retryInterval',
+    doubled for every failure in a row up to
+    `maxRetryInterval' (plus `jitter' of that).
+
+    Announces falling due within `window' seconds of
+    each other are handed out together, grouped by
+    tracker host.  Each host's group is split into
+    up to `perHost' batches (by default, as many as
+    the connections its pool keeps per host), each
+    made one after another by one of `workers'
+    threads over a kept alive connection.
+
+    onAnnounce, if set, is called from the worker
+    threads as onAnnounce(state, error) after every
+    announce, `error' being None on success.
+    """
+
+    def __init__(self,
+                 workers = 16,
+                 numPeers = 50,
+                 jitter = 0.1,
+                 retryInterval = 300,
+                 maxRetryInterval = 3600,
+                 window = 1.0,
+                 perHost = None):
+        self.workers = workers
+        self.numPeers = numPeers
+        self.jitter = jitter
+        self.retryInterval = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+        self.window = window
+        self.perHost = perHost
+
+        self.onAnnounce = None
+
+        self.lock = threading.Condition()
+
+        # Heap of (due, seq, key); an item is only
+        # current if it matches self.due[key]
+        self.heap = []
+        self.seq = 0
+
+        # key -> State, and key -> (due, seq) of
+        # every State scheduled (not being announced)
+        self.states = {}
+        self.due = {}
+
+        # Keys of the States that have been
+        # announced as started
+        self.started = set()
+
+        # key -> announces failed in a row
+        self.retries = {}
+
+        self.pool = None
+        self.thread = None
+        self.running = False
+
+        # Scheduler statistics
+        self.announces = 0
+        self.failures = 0
+        self.batches = 0
+
+    def add(self, state, delay = 0):
+        """
+        Schedules a State's first announce
+        `delay' seconds from now.
+        """
+
+        self.lock.acquire()
+        try:
+            key = id(state)
+            self.states[key] = state
+            self.__schedule(key, time.time() + delay)
+        finally:
+            self.lock.release()
+
+    def remove(self, state):
+        """
+        Stops announcing a State (an announce
+        already under way still completes).
+        """
+
+        self.lock.acquire()
+        try:
+            key = id(state)
+            self.states.pop(key, None)
+            self.due.pop(key, None)
+            self.started.discard(key)
+            self.retries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.states)
+
+    def nextAnnounce(self, state):
+        """
+        When a State is next due to be announced,
+        or None if it isn't scheduled (or is being
+        announced right now).
+        """
+
+        entry = self.due.get(id(state))
+        if entry is None:
+            return None
+        return entry[0]
+
+    def start(self):
+        """
+        Starts the scheduler thread
+        and the worker pool.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.running:
+                return
+            self.running = True
+            self.pool = multiprocessing.pool.ThreadPool(self.workers)
+            self.thread = threading.Thread(target = self.__run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """
+        Stops the scheduler, waiting for the
+        announces under way to complete.
+        """
+
+        self.lock.acquire()
+        try:
+            if not self.running:
+                return
+            self.running = False
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+
+    def __run(self):
+        self.lock.acquire()
+        try:
+            while self.running:
+                now = time.time()
+                batches = self.__takeDue(now)
+                for batch in batches:
+                    self.batches += 1
+                    self.pool.apply_async(self.__announceBatch, (batch,))
+
+                # Sleep until the next announce is due
+                # (or something changes)
+                if self.heap:
+                    self.lock.wait(max(0.0, self.heap[0][0] - time.time()))
+                else:
+                    self.lock.wait()
+        finally:
+            self.lock.release()
+
+    def __takeDue(self, now):
+        """
+        Takes the States due within `window' of
+        `now' off the heap, returning them grouped
+        by tracker host, each group split into
+        batches.  Must hold the lock.
+        """
+
+        byHost = {}
+        while self.heap and self.heap[0][0] <= now + self.window:
+            due, seq, key = heapq.heappop(self.heap)
+            if self.due.get(key) != (due, seq):
+                # Removed or rescheduled
+                continue
+            del self.due[key]
+
+            state = self.states[key]
+            byHost.setdefault(trackerHost(state), []).append(state)
+
+        batches = []
+        for states in byHost.values():
+            n = min(self.__batchesFor(states[0]), len(states))
+            for i in xrange(n):
+                batches.append(states[i::n])
+        return batches
+
+    def __batchesFor(self, state):
+        """
+        How many batches the announces to
+        a State's tracker host are split into.
+        """
+
+        if self.perHost:
+            return self.perHost
+        return max(1, state.tracker.pool.maxPerHost)
+
+    def __schedule(self, key, when):
+        """
+        Must hold the lock.
+        """
+
+        self.seq += 1
+        self.due[key] = (when, self.seq)
+        heapq.heappush(self.heap, (when, self.seq, key))
+        self.lock.notifyAll()
+
+    def __announceBatch(self, states):
+        for state in states:
+            self.__announce(state)
+
+    def __announce(self, state):
+        """
+        Announces a State, and schedules
+        its next announce.
+        """
+
+        key = id(state)
+        tracker = state.tracker
+
+        error = None
+        try:
+            if key in self.started:
+                state.trackerUpdate(self.numPeers)
+            else:
+                state.trackerScrape(self.numPeers)
+                self.started.add(key)
+        except Exception, msg:
+            error = msg
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.announces += 1
+            if error is None:
+                self.retries.pop(key, None)
+                interval = tracker.interval or defaultInterval
+                interval -= interval * self.jitter * random.random()
+            else:
+                self.failures += 1
+                retries = self.retries.get(key, 0)
+                interval = min(self.retryInterval * 2**min(retries, 16),
+                               self.maxRetryInterval)
+                interval *= 1 + self.jitter * random.random()
+
+            # Being handed out up to `window' early must
+            # still leave the min interval respected
+            if tracker.minInterval:
+                interval = max(interval, tracker.minInterval + self.window)
+
+            if key in self.states:
+                if error is not None:
+                    self.retries[key] = retries + 1
+                self.__schedule(key, now + interval)
+        finally:
+            self.lock.release()
+
+        if self.onAnnounce:
+            self.onAnnounce(state, error)
+
+def trackerHost(state):
+    """
+    The (scheme, host, port) of the
+    tracker a State announces to.
+    """
+
+    parts = urlparse.urlparse(state.tracker.tracker)
+    return (parts.scheme.lower(), parts.hostname, parts.port)
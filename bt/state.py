@@ -7,7 +7,8 @@ Copyright (C) 2007 Matt Waddell
 ALL RIGHTS RESERVED
 """
 
-import torrent, tracker
+import torrent, tracker, peers
+import weakref
 
 ST_NONE = 0
 ST_READY = 1
@@ -21,6 +22,18 @@ ST_SEEDQUEUE = 8
 ST_STOP = 9
 ST_ERROR = (2**32) - 1
 
+# Every State alive in this process, by id(),
+# so that the status page can find them
+registry = weakref.WeakValueDictionary()
+
+def sessions():
+    """
+    Returns the State objects
+    alive in this process.
+    """
+
+    return registry.values()
+
 class State:
     """
     Keeps track of a torrents network state.
@@ -50,9 +63,9 @@ class State:
                                         self.port,
                                         self.ip)
 
-        # List of dicts { ip, port } if in compressed mode
-        # list of dicts { peerid, ip, port} if not
-        #self.peers = []
+        # Every peer the trackers have told us
+        # about, as a peers.PeerStore
+        self.peers = peers.PeerStore()
 
         # Total downloaded
         self.totalDownloaded = 0
@@ -62,6 +75,8 @@ class State:
 
         self.state = ST_READY
 
+        registry[id(self)] = self
+
     def setUserAgent(self, userAgent):
         self.tracker.userAgent = userAgent
 
@@ -69,6 +84,25 @@ class State:
         self.peerID = peerID
         self.tracker.peerID = peerID
 
+    def nextPeers(self, n):
+        """
+        Returns up to `n' peers to connect to, as
+        (ip, port) tuples.  How each goes must be
+        reported with peerConnected() or peerFailed(),
+        and peerDisconnected() once it is over.
+        """
+
+        return self.peers.candidates(n)
+
+    def peerConnected(self, peer):
+        self.peers.connected(peer)
+
+    def peerDisconnected(self, peer):
+        self.peers.disconnected(peer)
+
+    def peerFailed(self, peer):
+        self.peers.failed(peer)
+
     def trackerScrape(self, numPeers):
         """
         Register us with the tracker,
@@ -84,9 +118,25 @@ class State:
                             self.totalDownloaded, 
                             left, 
                             numPeers)
+        self.peers.add(self.tracker.peers)
 
         self.state = ST_QUEUE
 
+    def trackerUpdate(self, numPeers):
+        """
+        Sends the tracker a regular update,
+        asking for more peers.
+        """
+
+        infoHash = self.torrent.hash
+        left = self.torrent.length - self.totalDownloaded
+        self.tracker.update(infoHash,
+                            self.totalUploaded,
+                            self.totalDownloaded,
+                            left,
+                            numPeers)
+        self.peers.add(self.tracker.peers)
+
     def trackerStop(self):
         """
         Tells the tracker that we have completed the torrent.
@@ -111,6 +161,7 @@ class State:
                               self.totalUploaded,
                               self.torrent.length,
                               numPeers)
+        self.peers.add(self.tracker.peers)
         
         self.state = ST_DONE
 
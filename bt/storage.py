@@ -0,0 +1,358 @@
+"""
+Defines helpers for reading the data of a
+torrent from disk: walking pieces across file
+boundaries, and hashing them in parallel.
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import os, sha, mmap, bisect
+import multiprocessing, multiprocessing.pool
+
+# Amount of data handed to a worker at a time
+taskSize = 2**24
+
+class FileIndex:
+    """
+    Maps pieces to the byte ranges of the files
+    they are made of, and files to the pieces
+    holding them, for files laid end to end.
+
+    Lookups bisect a table of cumulative file
+    offsets, so they take O(log n) in the number
+    of files.
+    """
+
+    def __init__(self, lengths, pieceLen):
+        self.lengths = lengths
+        self.pieceLen = pieceLen
+
+        # offsets[j] is where file j starts, and
+        # offsets[-1] is the total length
+        self.offsets = [0]
+        for length in lengths:
+            self.offsets.append(self.offsets[-1] + length)
+
+        self.length = self.offsets[-1]
+        self.numPieces = (self.length + pieceLen - 1) / pieceLen
+
+    def pieceSpans(self, index):
+        """
+        Returns [(fileIndex, offset, length), ...]
+        for the files making up a piece.
+        """
+
+        if index < 0 or index >= self.numPieces:
+            raise IndexError, 'Piece index out of range'
+
+        start = index * self.pieceLen
+        end = min(start + self.pieceLen, self.length)
+
+        # The last file starting at or before the
+        # piece (which skips empty files)
+        j = bisect.bisect_right(self.offsets, start) - 1
+
+        spans = []
+        while start < end:
+            n = min(end, self.offsets[j + 1]) - start
+            if n > 0:
+                spans.append((j, start - self.offsets[j], n))
+                start += n
+            j += 1
+        return spans
+
+    def piecesForFile(self, fileIndex):
+        """
+        Returns the range of indices of
+        the pieces that hold part of a file
+        (empty for empty files).
+        """
+
+        start = self.offsets[fileIndex]
+        length = self.lengths[fileIndex]
+
+        first = start / self.pieceLen
+        if not length:
+            return xrange(first, first)
+        return xrange(first, (start + length - 1) / self.pieceLen + 1)
+
+    def fileAt(self, offset):
+        """
+        Returns the index of the file holding
+        the byte at `offset' of the download.
+        """
+
+        if offset < 0 or offset >= self.length:
+            raise IndexError, 'Offset out of range'
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+def hashPieces(pieces):
+    """
+    Hashes pieces straight out of memory mapped
+    files.  `pieces' is a list of pieces, each a
+    list of (path, offset, length) spans.
+
+    Returns a list with the SHA-1 digest of each
+    piece, or None for pieces that could not be
+    read in full (missing or short files).
+
+    This is the unit of work handed to the
+    worker pool, so it only takes and returns
+    plain (picklable) values.
+    """
+
+    maps = {}
+    digests = []
+
+    def getMap(path):
+        if path not in maps:
+            # Remember files that can't be mapped
+            maps[path] = None
+            fd = open(path, 'rb')
+            try:
+                maps[path] = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+            finally:
+                fd.close()
+        if maps[path] is None:
+            raise IOError, 'Unable to map: %s' % path
+        return maps[path]
+
+    try:
+        for spans in pieces:
+            s = sha.new()
+            for path, offset, length in spans:
+                try:
+                    m = getMap(path)
+                except (IOError, OSError, ValueError, mmap.error):
+                    s = None
+                    break
+                if offset + length > len(m):
+                    s = None
+                    break
+
+                # sha releases the GIL while it hashes
+                # a large buffer, and the page faults
+                # that read the data happen then too
+                s.update(buffer(m, offset, length))
+
+            if s is None:
+                digests.append(None)
+            else:
+                digests.append(s.digest())
+    finally:
+        for m in maps.values():
+            if m is not None:
+                m.close()
+
+    return digests
+
+def hashTask(task):
+    """
+    hashPieces() for a (firstPieceIndex, pieces)
+    task as yielded by tasks(), returning
+    (firstPieceIndex, digests) so that results
+    can be collected out of order.
+    """
+
+    first, pieces = task
+    return (first, hashPieces(pieces))
+
+def tasks(paths, fileIndex, first = 0, last = None):
+    """
+    Groups pieces `first' to `last' (exclusive)
+    of the files at `paths', laid out as given by
+    a FileIndex, into lists of roughly `taskSize'
+    bytes, each ready to be handed to hashPieces(),
+    and yields (firstPieceIndex, pieces) for each.
+    """
+
+    piecesPerTask = max(1, taskSize / fileIndex.pieceLen)
+    if last is None or last > fileIndex.numPieces:
+        last = fileIndex.numPieces
+
+    for taskStart in xrange(first, last, piecesPerTask):
+        task = []
+        for index in xrange(taskStart, min(taskStart + piecesPerTask, last)):
+            task.append([(paths[f], offset, n)
+                            for f, offset, n in fileIndex.pieceSpans(index)])
+        yield (taskStart, task)
+
+def newPool(workers = None, processes = False):
+    """
+    Returns a pool of `workers' threads (or
+    processes), one per CPU by default.
+
+    Threads are usually enough: hashing and
+    reading both happen without the GIL.
+    """
+
+    if not workers:
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+
+    if processes:
+        return multiprocessing.Pool(workers)
+    return multiprocessing.pool.ThreadPool(workers)
+
+def filePaths(tor, directory):
+    """
+    Returns the paths of the files of a
+    torrent downloaded into `directory'.
+    """
+
+    base = os.path.join(directory, tor.fileName)
+    if tor.fileMode == 'single-file':
+        return [base]
+    return [os.path.join(base, f['path']) for f in tor.files]
+
+def fileLengths(tor):
+    """
+    Returns the lengths of the files
+    of a torrent, in order.
+    """
+
+    if tor.fileMode == 'single-file':
+        return [tor.length]
+    return [f['length'] for f in tor.files]
+
+def verify(tor,
+           directory,
+           workers = None,
+           processes = False,
+           progress = None,
+           cancel = None):
+    """
+    Checks which pieces of a torrent are present
+    and valid on disk, hashing them concurrently,
+    and returns:
+
+    (bitfield, completion)
+
+    where `bitfield' is a Bitfield with a bit
+    set for each valid piece, and `completion'
+    lists for each file the fraction of its bytes
+    covered by valid pieces.
+
+    directory   : Directory the torrent was
+                  downloaded into
+    workers     : Number of threads (or processes if
+                  `processes' is True), one per CPU
+                  by default
+    progress    : Optional callback, called as
+                  progress(piecesChecked, numPieces)
+    cancel      : Optional threading.Event; once set,
+                  no more pieces are checked and
+                  those left are reported missing
+    """
+
+    paths = filePaths(tor, directory)
+    lengths = fileLengths(tor)
+    fileIndex = tor.fileIndex
+
+    numPieces = len(tor.pieces)
+    if fileIndex.numPieces != numPieces:
+        raise Exception, 'Number of pieces does not match the torrent length'
+
+    bitfield = Bitfield(numPieces)
+    checked = 0
+
+    pool = newPool(workers, processes)
+    try:
+        work = tasks(paths, fileIndex)
+        for first, digests in pool.imap_unordered(hashTask, work):
+            for i in xrange(len(digests)):
+                if digests[i] is not None and \
+                        tor.pieces.matches(first + i, digests[i]):
+                    bitfield.set(first + i)
+
+            checked += len(digests)
+            if progress:
+                progress(checked, numPieces)
+            if cancel is not None and cancel.isSet():
+                break
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.terminate()
+    pool.join()
+
+    # Credit each file with the bytes
+    # of the valid pieces it holds
+    done = [0] * len(lengths)
+    for index in xrange(numPieces):
+        if bitfield[index]:
+            for f, offset, length in fileIndex.pieceSpans(index):
+                done[f] += length
+
+    completion = []
+    for i in xrange(len(lengths)):
+        if lengths[i]:
+            completion.append(float(done[i]) / lengths[i])
+        elif os.path.isfile(paths[i]):
+            completion.append(1.0)
+        else:
+            completion.append(0.0)
+
+    return (bitfield, completion)
+
+class Bitfield:
+    """
+    A set of piece indices, stored as in the
+    peer wire protocol: one bit per piece, the
+    high bit of the first byte being piece 0.
+    """
+
+    def __init__(self, length, data = None):
+        self.length = length
+        if data is None:
+            self.data = bytearray((length + 7) / 8)
+        else:
+            if len(data) != (length + 7) / 8:
+                raise Exception, 'Bitfield is the wrong length'
+            self.data = bytearray(data)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.length:
+            raise IndexError, 'Bitfield index out of range'
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def set(self, index, value = True):
+        if index < 0 or index >= self.length:
+            raise IndexError, 'Bitfield index out of range'
+        if value:
+            self.data[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def count(self):
+        """
+        Number of bits set.
+        """
+
+        n = 0
+        for b in self.data:
+            while b:
+                b &= b - 1
+                n += 1
+        return n
+
+    def complete(self):
+        return self.count() == self.length
+
+    def toString(self):
+        """
+        The bitfield as sent in a
+        'bitfield' message.
+        """
+
+        return str(self.data)
+
+    def __repr__(self):
+        return '<Bitfield %d/%d>' % (self.count(), self.length)
@@ -9,8 +9,23 @@ Copyright (C) 2007 Matt Waddell
 ALL RIGHTS RESERVED
 """
 
-import os, sha, copy
-import bencode
+import os, sha, copy, time
+import bencode, storage
+
+# Maps pieces to the byte ranges of files
+FileIndex = storage.FileIndex
+
+# Where the file lengths are in a torrent
+# (see bencode.skipAt())
+fileLengthsPath = ('info', 'files', None, 'length')
+
+# Top level keys that are kept as members of
+# Torrent, rather than only in torrentDict
+topLevelKeys = [ 'announce',
+                 'announce-list',
+                 'creation date',
+                 'comment',
+                 'created by' ]
 
 class Torrent:
     """
@@ -29,7 +44,7 @@ class Torrent:
     createdBy           : Creator string (optional)
 
     pieceLen            : File block len (bytes)
-    pieces              : List of SHA-1 hashes for all pieces
+    pieces              : PieceTable of SHA-1 hashes for all pieces
     private             : Whether the torrent is private
     fileMode            : 'single-file' or 'multi-file'
     length              : Length of entire download
@@ -46,29 +61,62 @@ class Torrent:
                           file['length'] : Length of file
                           file['md5sum'] : Optional md5sum of file
                           file['path']   : Path relative to fileName
-                          file['pieces'] : List of piece hashes of file
+                          file['pieces'] : Range of indices of the pieces
+                                           that hold part of the file
 
+    fileIndex           : FileIndex mapping pieces to file byte ranges
     hash                : A sha1 hash of the torrent
     """
 
-    def __init__(self, t):
+    def __init__(self, t, cache = None, lazy = False):
         """
         If the argument is a string, it is assumed
         to be a path to a torrent file.  If it is
         a dictionary, that is used to create the 
         torrent class instead.
 
+        If a cache.Cache is given, the members of a
+        torrent file are taken from it when they are
+        up to date, and stored in it otherwise.
+
+        If `lazy' is True only the top level members,
+        the info hash, pieceLen, private, fileName,
+        fileMode (and length in 'single-file' mode)
+        are parsed up front, off a memory map of the
+        file that is closed again straight away.
+        pieces, files, fileIndex, length and md5sum
+        are parsed the first time one of them is
+        used, and a torrent file is not kept open
+        until then.  Otherwise the file is read into
+        memory, so no torrent keeps its file open.
+
         An exception will be thrown if the resulting
         dictionary is malformed.
         """
 
+        tally = None
         if isinstance(t, dict):
             self.torrent = ''
             self.torrentDict = t
         elif isinstance(t, str):
-            # parse the torrent
             self.torrent = t
-            self.torrentDict = bencode.decodeFile(t)
+
+            if cache is not None:
+                fields = cache.get(t)
+                if fields is not None:
+                    self.__restore(fields)
+                    return
+
+            # parse the torrent (lazily, straight off
+            # a memory map of the file if only the top
+            # level is wanted, adding up the file lengths
+            # as the info dict is walked over)
+            if lazy and cache is None:
+                tally = { fileLengthsPath : 0L }
+            self.torrentDict = bencode.decodeFile(t,
+                                                  lazy = True,
+                                                  mapped = lazy and cache is None,
+                                                  tally = tally)
         else:
             raise Exception, 'Argument must be either a Dictionary or String'
 
@@ -81,6 +129,8 @@ class Torrent:
         # a list of alternate trackers
         if 'announce-list' in self.torrentDict:
             self.backupTrackers = self.torrentDict['announce-list']
+            if isinstance(self.backupTrackers, bencode.LazyNode):
+                self.backupTrackers = self.backupTrackers.materialize()
         else:
             self.backupTrackers = []
 
@@ -107,30 +157,29 @@ class Torrent:
         info = self.torrentDict['info']
 
         # The tracker identifies the torrent
-        # by a hash of the bencoded info dict
-        infoStr = bencode.encode(info)
-        s = sha.new(infoStr)
+        # by a hash of the bencoded info dict.
+        # If it came from a file, hash the bytes
+        # exactly as they appear there.
+        if isinstance(info, bencode.LazyDict):
+            s = sha.new(info.raw())
+        else:
+            s = sha.new(bencode.encode(info))
         self.hash = s.digest()
 
-        self.pieceLen = info['piece length']
-
-        # Parse the peices list:
-        # Input consists of one long string of
-        # 20 byte sha1 hashes.  break them up
-        # and produce a list of hashes.
-
-        lenPieces = len(info['pieces'])
-        hashLen = 20
-        if lenPieces % hashLen != 0:
-            raise Exception, 'List of file hashes is incomplete'
+        # Keep the whole torrent, if it was read from
+        # a file, and where the info dict is in it, so
+        # that toString() never has to encode it again.
+        # A lazy torrent reads it again if need be.
+        if not (lazy and cache is None and self.torrent):
+            if isinstance(info, bencode.LazyDict):
+                self.__raw = self.torrentDict.rawString()
+                self.__infoSpan = infoSpan(self.torrentDict)
+            else:
+                self.__raw = None
+                self.__infoSpan = None
+        self.__fields = copy.deepcopy(self.__topLevel())
 
-        self.pieces = []
-        i,j = 0, hashLen
-        while j < lenPieces:
-            p = info['pieces'][i:j]
-            self.pieces.append(p)
-            i += hashLen
-            j += hashLen 
+        self.pieceLen = info['piece length']
 
         if 'private' in info:
             if not isinstance(info['private'], long):
@@ -142,20 +191,87 @@ class Torrent:
         # Advisory file/directory name for the download
         self.fileName = info['name']
 
-        self.files = []
         # Determine mode (multi-file, or single-file)
         if 'files' in info:
+            self.fileMode = 'multi-file'
+        else:
+            self.fileMode = 'single-file'
+            self.length = info['length']
+
+        self.__infoParsed = False
+        if lazy and cache is None:
+            if self.fileMode == 'multi-file' and tally is not None:
+                # Announces only need the total
+                self.length = tally[fileLengthsPath]
+
+            if self.torrent:
+                # Let go of the file until
+                # it is needed again
+                source = self.torrentDict.source
+                del self.torrentDict
+                source.close()
+            return
+
+        self.__parseInfo()
+
+        if cache is not None and self.torrent:
+            cache.put(self.torrent, self.__cacheFields())
+
+    def __parseInfo(self):
+        """
+        Parses the members that depend on the
+        size of the info dict: pieces, files
+        (or md5sum), length and fileIndex.
+        """
+
+        if '_Torrent__cachedFiles' in self.__dict__:
+            # Restored from a cache
+            self.files = []
+            for length, md5sum, path in self.__cachedFiles:
+                self.files.append({
+                    'length'    :   length,
+                    'md5sum'    :   md5sum,
+                    'path'      :   path
+                })
+            del self.__cachedFiles
+
+            self.__indexFiles()
+            self.__infoParsed = True
+            return
+
+        info = self.torrentDict['info']
+
+        # Parse the peices list:
+        # Input consists of one long string of
+        # 20 byte sha1 hashes, which is kept
+        # as is and indexed by the PieceTable.
+
+        if isinstance(info, bencode.LazyDict):
+            # Take the hashes straight out of the file
+            pieces = info.view('pieces')
+        else:
+            pieces = info['pieces']
+
+        self.pieces = PieceTable(pieces)
+
+        self.files = []
+        if self.fileMode == 'multi-file':
             # if its a multi-file torrent
             # it will have a list of files
             # along with their lengths,
             # path/filenames, and optionally
             # and md5sums.
-            self.fileMode = 'multi-file'
 
-            self.files = []
             totalLen = 0
-            pieceIndex = 0
-            for file in info['files']:
+
+            # Every entry is needed, so decode the
+            # list in one go rather than entry by entry
+            if isinstance(info, bencode.LazyDict):
+                files = info.materialize('files')
+            else:
+                files = info['files']
+
+            for file in files:
 
                 # Fix up the file dict
                 # 
@@ -178,17 +294,6 @@ class Torrent:
                 # relative to the base dir--self.file
                 f['path'] = os.sep.join(file['path'])
 
-                # Get list of piece hashes
-                #
-                numPieces,mod = divmod(f['length'],self.pieceLen)
-                
-                # Round up to the next piece
-                if mod:
-                    numPieces += 1
-
-                f['pieces'] = self.pieces[pieceIndex : pieceIndex + numPieces]
-                pieceIndex += numPieces
-
                 self.files.append(f)
 
             # Total length of the download
@@ -197,7 +302,6 @@ class Torrent:
         else:
             # if its just a single file torrent 
             # it may have a single md5sum.
-            self.fileMode = 'single-file'
 
             # Total length of the download
             self.length = info['length']
@@ -207,16 +311,510 @@ class Torrent:
             else:
                 self.md5sum = ''
 
+        self.__indexFiles()
+        self.__infoParsed = True
+
+    def __indexFiles(self):
+        """
+        Builds the FileIndex, and the piece
+        ranges of each file from it.
+        """
+
+        if self.fileMode == 'single-file':
+            self.fileIndex = FileIndex([self.length], self.pieceLen)
+            return
+
+        # Pieces run on across file boundaries,
+        # so a file's pieces are the ones its
+        # bytes overlap
+        self.fileIndex = FileIndex([f['length'] for f in self.files],
+                                   self.pieceLen)
+        for j in xrange(len(self.files)):
+            self.files[j]['pieces'] = self.fileIndex.piecesForFile(j)
+
+    def __cacheFields(self):
+        """
+        Returns the parsed members of the torrent
+        as plain values for a cache.Cache.
+        """
+
+        fields = {
+            'hash'              :   self.hash,
+            'tracker'           :   self.tracker,
+            'backupTrackers'    :   self.backupTrackers,
+            'creationDate'      :   self.creationDate,
+            'comment'           :   self.comment,
+            'createdBy'         :   self.createdBy,
+            'pieceLen'          :   self.pieceLen,
+            'pieces'            :   self.pieces.toString(),
+            'private'           :   self.private,
+            'fileMode'          :   self.fileMode,
+            'fileName'          :   self.fileName,
+            'length'            :   self.length
+        }
+
+        if self.fileMode == 'single-file':
+            fields['md5sum'] = self.md5sum
+        else:
+            fields['files'] = [(f['length'], f['md5sum'], f['path'])
+                                    for f in self.files]
+        return fields
+
+    def __restore(self, fields):
+        """
+        Sets the members of the torrent from
+        fields returned by __cacheFields().  The
+        torrent file itself is only read again
+        if torrentDict is used (see __getattr__).
+        """
+
+        self.hash = fields['hash']
+        self.tracker = fields['tracker']
+        self.backupTrackers = fields['backupTrackers']
+        self.creationDate = fields['creationDate']
+        self.comment = fields['comment']
+        self.createdBy = fields['createdBy']
+        self.pieceLen = fields['pieceLen']
+        self.pieces = PieceTable(fields['pieces'])
+        self.private = fields['private']
+        self.fileMode = fields['fileMode']
+        self.fileName = fields['fileName']
+        self.length = fields['length']
+
+        self.__fields = copy.deepcopy(self.__topLevel())
+
+        if self.fileMode == 'single-file':
+            self.md5sum = fields['md5sum']
+            self.files = []
+            self.__indexFiles()
+            self.__infoParsed = True
+        else:
+            # The file table is only built if used
+            self.__cachedFiles = fields['files']
+            self.__infoParsed = False
+
+    def __getattr__(self, name):
+        """
+        Parses the members a lazy torrent, or one
+        restored from a cache, goes without (reading
+        the torrent file again if needed) the first
+        time one of them is used.
+        """
+
+        if name == 'length' and self.fileMode == 'multi-file' \
+                and not self.__dict__.get('_Torrent__infoParsed', True) \
+                and not self.torrent:
+            # Announces only need the total, so
+            # don't build the file table
+            self.length = self.__totalLength()
+            return self.length
+
+        elif name in ('pieces', 'files', 'fileIndex', 'length', 'md5sum') \
+                and not self.__dict__.get('_Torrent__infoParsed', True):
+            self.__parseInfo()
+            if name in self.__dict__:
+                return self.__dict__[name]
+
+        elif name in ('torrentDict', '_Torrent__infoSpan', '_Torrent__raw') \
+                and self.__dict__.get('torrent'):
+            # Read into memory, rather than mapped,
+            # so that the file isn't held open
+            torrentDict = bencode.decodeFile(self.torrent, lazy = True, mapped = False)
+            if sha.new(torrentDict['info'].raw()).digest() != self.hash:
+                raise Exception, 'Torrent file has changed: %s' % self.torrent
+
+            self.torrentDict = torrentDict
+            self.__infoSpan = infoSpan(torrentDict)
+            self.__raw = torrentDict.rawString()
+            return self.__dict__[name]
+
+        raise AttributeError, name
+
+    def __totalLength(self):
+        """
+        Adds up the file lengths of a 'multi-file'
+        torrent made from a dictionary, without
+        building the file table.  (A torrent read
+        from a file adds them up as it is parsed.)
+        """
+
+        files = self.torrentDict['info']['files']
+        totalLen = 0
+        for file in files:
+            if not isinstance(file['length'], long):
+                raise Exception, 'File length is malformed'
+            totalLen += file['length']
+        return totalLen
+
+    def pieceSpans(self, index):
+        """
+        Returns the byte ranges of the files that
+        make up a piece:
+
+        [(fileIndex, offset, length), ...]
+
+        (fileIndex is always 0 in 'single-file' mode)
+        """
+
+        return self.fileIndex.pieceSpans(index)
+
+    def piecesForFile(self, fileIndex):
+        """
+        Returns the range of indices of the
+        pieces that hold part of a file.
+        """
+
+        return self.fileIndex.piecesForFile(fileIndex)
+
     def toDict(self):
         """
         Converts the torrent class back to a
         dictionary.
+
+        The top level fields reflect any changes
+        made to the members above.  The info dict
+        is the one the torrent was created from
+        (decoded afresh if it was read from a file).
         """
-        pass
+
+        d = {}
+        for key in self.torrentDict.keys():
+            if key in topLevelKeys:
+                continue
+            val = self.torrentDict[key]
+            if isinstance(val, bencode.LazyNode):
+                val = val.materialize()
+            d[key] = val
+
+        d.update(self.__topLevel())
+        return d
     
     def toString(self):
         """
         Converts torrent back to a bencoded
         string.
+
+        An unchanged torrent read from a file is
+        returned byte for byte as it was read.
+        Otherwise only the top level fields are
+        encoded, and the info dict is spliced in
+        from the bytes it was hashed over (or, for
+        a torrent made from a dictionary, encoded).
+        """
+
+        fields = self.__topLevel()
+        if self.__raw is not None and fields == self.__fields:
+            return self.__raw
+
+        d = {}
+        for key in self.torrentDict.keys():
+            if key in topLevelKeys:
+                continue
+            elif key == 'info' and self.__infoSpan is not None:
+                start, end = self.__infoSpan
+                d[key] = bencode.Encoded(self.__raw[start:end])
+            elif isinstance(self.torrentDict, bencode.LazyDict):
+                d[key] = bencode.Encoded(self.torrentDict.raw(key))
+            else:
+                d[key] = self.torrentDict[key]
+
+        d.update(fields)
+        return bencode.encode(d)
+
+    def save(self, path):
+        """
+        Writes the torrent, as returned
+        by toString(), to a file.
+        """
+
+        s = self.toString()
+        fd = open(path, 'wb')
+        try:
+            fd.write(s)
+        finally:
+            fd.close()
+
+    def __topLevel(self):
+        """
+        Returns the top level keys of the torrent,
+        other than info, as currently set on the
+        class (optional members are left out when
+        empty).
+        """
+
+        fields = { 'announce' : self.tracker }
+        if self.backupTrackers:
+            fields['announce-list'] = self.backupTrackers
+        if self.creationDate:
+            fields['creation date'] = self.creationDate
+        if self.comment:
+            fields['comment'] = self.comment
+        if self.createdBy:
+            fields['created by'] = self.createdBy
+        return fields
+
+def infoSpan(torrentDict):
+    """
+    Returns (start, end) of the info dict within
+    the bytes of a lazily decoded torrent.
+    """
+
+    start, end = torrentDict.spanOf('info')
+    return (start - torrentDict.start, end - torrentDict.start)
+
+class PieceTable:
+    """
+    The SHA-1 hashes of a torrent's pieces,
+    kept as the one contiguous string they
+    are stored as in the info dict rather
+    than as a string object per piece.
+
+    Indexing returns the 20 byte hash of a
+    piece, slicing returns another PieceTable.
+    """
+
+    hashLen = 20
+
+    def __init__(self, hashes):
+        """
+        `hashes' is the concatenated hashes, as
+        a string or anything str() turns into one
+        (e.g. a buffer into a memory mapped file).
+        """
+
+        self.data = str(hashes)
+
+        if len(self.data) % self.hashLen != 0:
+            raise Exception, 'List of file hashes is incomplete'
+
+        self.count = len(self.data) / self.hashLen
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                raise Exception, 'PieceTable slices must be contiguous'
+            stop = max(start, stop)
+            return PieceTable(self.data[start * self.hashLen : stop * self.hashLen])
+
+        i = self.__offset(index)
+        return self.data[i:i + self.hashLen]
+
+    def __iter__(self):
+        data = self.data
+        hashLen = self.hashLen
+        for i in xrange(0, len(data), hashLen):
+            yield data[i:i + hashLen]
+
+    def __eq__(self, other):
+        if isinstance(other, PieceTable):
+            return self.data == other.data
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<PieceTable %d pieces>' % self.count
+
+    def view(self, index):
         """
-        pass
+        Returns the hash of a piece as a
+        buffer into the table (no copy).
+        """
+
+        return buffer(self.data, self.__offset(index), self.hashLen)
+
+    def matches(self, index, digest):
+        """
+        Checks a computed digest against the
+        hash of a piece without slicing it out.
+        """
+
+        return len(digest) == self.hashLen and \
+            self.data.startswith(digest, self.__offset(index))
+
+    def find(self, digest):
+        """
+        Returns the index of the first piece
+        with the given hash, or -1.
+        """
+
+        if len(digest) != self.hashLen:
+            return -1
+
+        i = self.data.find(digest)
+        while i >= 0 and i % self.hashLen:
+            i = self.data.find(digest, i + 1)
+        if i < 0:
+            return -1
+        return i / self.hashLen
+
+    def toString(self):
+        """
+        Returns the hashes concatenated, as
+        they appear in the info dict.
+        """
+
+        return self.data
+
+    def __offset(self, index):
+        """
+        Byte offset of a piece's hash.
+        """
+
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError, 'Piece index out of range'
+        return index * self.hashLen
+
+################
+
+def makeTorrent(path,
+                pieceLen,
+                trackers,
+                comment = '',
+                createdBy = '',
+                private = False,
+                name = None,
+                workers = None,
+                processes = False,
+                progress = None):
+    """
+    Creates a torrent for a file, or for every
+    file under a directory, and returns it as a
+    Torrent (see Torrent.toString() for the
+    bencoded form).
+
+    pieceLen    : Piece length in bytes, or None to
+                  pick one from the size of the data
+    trackers    : List of tracker urls, or of tiers
+                  (lists of urls); the first is used
+                  as the main tracker
+    workers     : Number of threads (or processes if
+                  `processes' is True) used to hash
+                  the pieces, one per CPU by default
+    progress    : Optional callback, called as
+                  progress(piecesDone, numPieces)
+
+    Pieces run on across file boundaries, and
+    are read from memory mapped files.
+    """
+
+    path = os.path.abspath(path)
+    if name is None:
+        name = os.path.basename(path)
+
+    if not trackers:
+        raise Exception, 'At least one tracker is required'
+
+    tiers = []
+    for t in trackers:
+        if isinstance(t, list):
+            tiers.append(list(t))
+        else:
+            tiers.append([t])
+
+    # Find the files, in a stable order
+    #
+
+    paths = []
+    files = []
+    if os.path.isdir(path):
+        for dirPath, dirNames, fileNames in os.walk(path):
+            dirNames.sort()
+            fileNames.sort()
+            for fileName in fileNames:
+                filePath = os.path.join(dirPath, fileName)
+                if not os.path.isfile(filePath):
+                    continue
+
+                relPath = filePath[len(path):].lstrip(os.sep)
+                paths.append(filePath)
+                files.append({
+                    'length'    :   long(os.path.getsize(filePath)),
+                    'path'      :   relPath.split(os.sep)
+                })
+
+        if not files:
+            raise Exception, 'No files found in: %s' % path
+    elif os.path.isfile(path):
+        paths.append(path)
+    else:
+        raise Exception, 'No such file or directory: %s' % path
+
+    lengths = [os.path.getsize(p) for p in paths]
+    totalLen = sum(lengths)
+
+    if not pieceLen:
+        pieceLen = choosePieceLen(totalLen)
+
+    # Hash the pieces
+    #
+
+    fileIndex = FileIndex(lengths, pieceLen)
+    numPieces = fileIndex.numPieces
+    hashes = []
+
+    pool = storage.newPool(workers, processes)
+    try:
+        work = (task for first, task in
+                    storage.tasks(paths, fileIndex))
+        for digests in pool.imap(storage.hashPieces, work):
+            if None in digests:
+                raise Exception, 'Files changed while being hashed: %s' % path
+            hashes.extend(digests)
+
+            if progress:
+                progress(len(hashes), numPieces)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+    # Build the dictionary
+    #
+
+    info = {
+        'name'          :   name,
+        'piece length'  :   long(pieceLen),
+        'pieces'        :   ''.join(hashes)
+    }
+    if files:
+        info['files'] = files
+    else:
+        info['length'] = long(totalLen)
+    if private:
+        info['private'] = 1L
+
+    t = {
+        'announce'      :   tiers[0][0],
+        'creation date' :   long(time.time()),
+        'info'          :   info
+    }
+    if len(tiers) > 1 or len(tiers[0]) > 1:
+        t['announce-list'] = tiers
+    if comment:
+        t['comment'] = comment
+    if createdBy:
+        t['created by'] = createdBy
+
+    return Torrent(t)
+
+def choosePieceLen(totalLen):
+    """
+    Picks a power of two piece length giving
+    no more than about 2000 pieces, between
+    16KiB and 16MiB.
+    """
+
+    pieceLen = 2**14
+    while pieceLen < 2**24 and totalLen / pieceLen > 2000:
+        pieceLen *= 2
+    return pieceLen
@@ -5,16 +5,234 @@ Copyright (C) 2007 Matt Waddell
 ALL RIGHTS RESERVED
 """
 
-import urllib2,urllib,socket,struct,urlparse,gzip,StringIO
-import bencode, torrent
+import urllib,socket,struct,urlparse,zlib,time,random,threading,Queue,httplib
+import multiprocessing.pool
+import bencode, torrent, connection, udp, metrics
 
 userAgent = 'PyBTOMG/0001'
 
+# Size of the reads made on a tracker response
+readSize = 16384
+
 EVENT_START = 'started'
 EVENT_STOP = 'stopped'
 EVENT_DONE = 'completed'
 EVENT_UPDATE = '' 
 
+# Most info hashes asked for in one scrape
+scrapeBatch = 50
+
+# Weight of the latest request in the
+# moving average of a tracker's latency
+latencyWeight = 0.3
+
+# Timeouts of requests made through the shared
+# connection pool: to connect, and for each read
+# (seconds).  Read on every request, so changes
+# apply to the next one.
+connectTimeout = 10
+readTimeout = 30
+
+# Longest a UDP request is retransmitted
+# for, unless given a timeout (seconds)
+udpTimeout = 60
+
+# Failures in a row after which a tracker host
+# is taken to be down.  Requests to it then fail
+# fast for `breakerCooldown' seconds (plus up to
+# `breakerJitter' of that at random), doubling
+# each time it is found to be still down, up to
+# `maxBreakerCooldown'.
+breakerThreshold = 5
+breakerCooldown = 30
+breakerJitter = 0.2
+maxBreakerCooldown = 900
+
+# What a Tracker's lastFailureKind may be:
+# the kinds of failure told apart on the
+# status page (see failureKind())
+failureKinds = ('timeout', 'http', 'failure reason', 'decode', 'breaker open')
+
+# Keep-alive connections to trackers,
+# shared by every Tracker by default
+connectionPool = connection.ConnectionPool(timeout = readTimeout,
+                                           connectTimeout = connectTimeout)
+
+# Statistics of every tracker url
+# requests have been made to
+trackerStats = {}
+trackerStatsLock = threading.Lock()
+
+def statsFor(url):
+    """
+    Returns the TrackerStats of a tracker url.
+    """
+
+    trackerStatsLock.acquire()
+    try:
+        if url not in trackerStats:
+            trackerStats[url] = TrackerStats()
+        return trackerStats[url]
+    finally:
+        trackerStatsLock.release()
+
+# Circuit breaker of every tracker host
+# (as given by metrics.hostOf())
+breakers = {}
+breakersLock = threading.Lock()
+
+def breakerFor(url):
+    """
+    Returns the CircuitBreaker of the
+    host of a tracker url.
+    """
+
+    host = metrics.hostOf(url)
+    breakersLock.acquire()
+    try:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker()
+        return breakers[host]
+    finally:
+        breakersLock.release()
+
+class TrackerStats:
+    """
+    Keeps track of how a tracker url has been
+    responding, across every Tracker using it.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+
+        # Failures since the last success
+        self.consecutiveFailures = 0
+
+        # Exponentially weighted moving average of
+        # the latency of successful requests (seconds)
+        self.latency = None
+
+        self.lastFailure = ''
+        self.lastSuccess = None
+
+    def succeeded(self, latency):
+        self.requests += 1
+        self.consecutiveFailures = 0
+        self.lastSuccess = time.time()
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += latencyWeight * (latency - self.latency)
+
+    def failed(self, msg):
+        self.requests += 1
+        self.failures += 1
+        self.consecutiveFailures += 1
+        self.lastFailure = msg
+
+    def rank(self):
+        """
+        Sort key putting trackers that have been
+        failing last, and faster ones first.
+        Trackers not heard from yet come after
+        those known to work.
+        """
+
+        if self.latency is None:
+            return (self.consecutiveFailures, 1, 0.0)
+        return (self.consecutiveFailures, 0, self.latency)
+
+class CircuitBreaker:
+    """
+    Makes requests to a tracker host fail fast
+    while it is down, for every Tracker using it.
+
+    After `breakerThreshold' failures in a row the
+    breaker opens and requests fail straight away.
+    Once the cooldown is over, a single request is
+    let through to try the host again: if it gets
+    a response the breaker closes, otherwise the
+    cooldown doubles.  A tracker that answers with
+    a failure reason is up, as far as this goes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.consecutiveFailures = 0
+
+        # While open, requests fail fast until
+        # then, or None if closed
+        self.openUntil = None
+        self.cooldown = breakerCooldown
+
+        # Whether a request is trying the host again
+        self.trying = False
+
+        # Requests failed fast
+        self.rejected = 0
+
+    def isOpen(self):
+        return self.openUntil is not None
+
+    def allow(self):
+        """
+        Raises an exception if a request to
+        the host should fail fast.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.openUntil is None:
+                return
+
+            now = time.time()
+            if now >= self.openUntil and not self.trying:
+                self.trying = True
+                return
+
+            self.rejected += 1
+            if self.trying:
+                raise Exception, 'Tracker host is down, being retried'
+            raise Exception, 'Tracker host is down, retrying in %d seconds' % \
+                (int(self.openUntil - now) + 1)
+        finally:
+            self.lock.release()
+
+    def succeeded(self):
+        self.lock.acquire()
+        try:
+            self.consecutiveFailures = 0
+            self.openUntil = None
+            self.cooldown = breakerCooldown
+            self.trying = False
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        self.lock.acquire()
+        try:
+            self.consecutiveFailures += 1
+            if self.trying:
+                # Still down
+                self.trying = False
+                self.cooldown = min(self.cooldown * 2, maxBreakerCooldown)
+                self.__open()
+            elif self.openUntil is None and \
+                    self.consecutiveFailures >= breakerThreshold:
+                self.__open()
+        finally:
+            self.lock.release()
+
+    def __open(self):
+        """
+        Must hold the lock.
+        """
+
+        cooldown = self.cooldown * (1 + breakerJitter * random.random())
+        self.openUntil = time.time() + cooldown
+
 class Tracker:
     """
     Provides an interface to interact with
@@ -34,6 +252,26 @@ class Tracker:
 
         self.tracker = tracker
         self.backupTrackers = backupTrackers
+
+        # Tiers of tracker urls to announce to (BEP 12),
+        # shuffled within each tier.  If the torrent has
+        # an announce-list, `tracker' is only where to
+        # start; otherwise it is the only tracker used.
+        self.tiers = []
+        for tier in backupTrackers or []:
+            if isinstance(tier, str):
+                tier = [tier]
+            tier = [url for url in tier if isinstance(url, str) and url]
+            if tier:
+                random.shuffle(tier)
+                self.tiers.append(tier)
+
+        # Try the fastest, most reliable trackers of a
+        # tier first, rather than the last to respond
+        self.preferFast = True
+
+        # Number of trackers of a tier asked at once
+        self.race = 1
         self.peerID = peerID
 
         # Port the client is listening on
@@ -47,12 +285,19 @@ class Tracker:
 
         # Key to be used to identify the client
         self.key = key
+
+        # connection.ConnectionPool requests are made through
+        self.pool = connectionPool
         
         ### Data from interacting with tracker ###
 
         self.lastFailure = ''
         self.lastWarning = ''
 
+        # Which of failureKinds the last failure was
+        self.lastFailureKind = ''
+        self.__failureKind = None
+
         # Suggested interval to wait between polls
         self.interval = None
 
@@ -68,6 +313,10 @@ class Tracker:
         # Number of peers that haven't completed DL
         self.incomplete = None
 
+        # Number of times the torrent has been
+        # downloaded, as reported by a scrape
+        self.timesDownloaded = None
+
         # Ask for a compressed peer list?
         self.getCompressedPeerList = True
 
@@ -75,11 +324,22 @@ class Tracker:
         # if getCompressedPeerList is False
         self.noPeerID = True
 
-        # If tracker is responding in compressed or regular mode
-        # peers list returned { ip, port } if in compressed mode
-        # { peerid, ip, port} if not and noPeerID is False
+        # If tracker is responding in compressed or regular mode;
+        # either way, the peers list holds (ip, port) tuples
         self.compressedPeerList = False
 
+        ### Counters, read by the status page ###
+
+        # Number of requests made, and how many failed
+        self.numRequests = 0
+        self.numFailures = 0
+
+        # When the last request was made, and how
+        # long it (and all requests together) took
+        self.lastRequest = None
+        self.lastLatency = None
+        self.totalLatency = 0.0
+
     def update(self, infoHash, uploaded, downloaded, left, numwant):
         """
         Sends an update announcement to the tracker.
@@ -89,39 +349,12 @@ class Tracker:
         """
 
         # A null event specifies an update
-        try:
-            comp,res = self.__sendRequest(infoHash, 
-                                    uploaded, 
-                                    downloaded, 
-                                    left, 
-                                    EVENT_UPDATE, 
-                                    numwant)
-        except Exception, msg:
-            self.lastFailure = str(msg)
-            raise Exception, msg
-
-        if 'warning message' in res:
-            self.lastWarning = res['warning message']
-
-        self.CompressedPeerList = comp
-
-        # Expect at least a list of peers
-        # and an interval
-        self.peers = res['peers']
-
-        self.interval = res['interval']
-
-        if 'min interval' in res:
-            self.minInterval = res['min interval']
-
-        if 'tracker id' in res:
-            self.trackerID = res['tracker id']
-
-        if 'complete' in res:
-            self.complete = res['complete']
-
-        if 'incomplete' in res:
-            self.incomplete = res['incomplete']
+        self.announce(infoHash, 
+                      uploaded, 
+                      downloaded, 
+                      left, 
+                      EVENT_UPDATE, 
+                      numwant)
 
     def scrape(self, infoHash, uploaded, downloaded, left, numwant):
         """
@@ -131,40 +364,12 @@ class Tracker:
         Raises exception on failure
         """
 
-        # A null event specifies an update
-        try:
-            comp,res = self.__sendRequest(infoHash, 
-                                    uploaded, 
-                                    downloaded, 
-                                    left, 
-                                    EVENT_START, 
-                                    numwant)
-        except Exception, msg:
-            self.lastFailure = str(msg)
-            raise Exception, msg
-
-        if 'warning message' in res:
-            self.lastWarning = res['warning message']
-
-        self.CompressedPeerList = comp
-
-        # Expect at least a list of peers
-        # and an interval
-        self.peers = res['peers']
-
-        self.interval = res['interval']
-
-        if 'min interval' in res:
-            self.minInterval = res['min interval']
-
-        if 'tracker id' in res:
-            self.trackerID = res['tracker id']
-
-        if 'complete' in res:
-            self.complete = res['complete']
-
-        if 'incomplete' in res:
-            self.incomplete = res['incomplete']
+        self.announce(infoHash, 
+                      uploaded, 
+                      downloaded, 
+                      left, 
+                      EVENT_START, 
+                      numwant)
 
     def stop(self, infoHash, uploaded, downloaded, left):
         """
@@ -174,27 +379,12 @@ class Tracker:
         Raises exception on failure
         """
 
-        # A null event specifies an update
-        try:
-            comp,res = self.__sendRequest(infoHash, 
-                                    uploaded, 
-                                    downloaded, 
-                                    left, 
-                                    EVENT_STOP, 
-                                    0)
-        except Exception, msg:
-            self.lastFailure = str(msg)
-            raise Exception, msg
-
-        if 'warning message' in res:
-            self.lastWarning = res['warning message']
-
-        self.peers = []
-        self.interval = None
-        self.minInterval = None
-        self.trackerID = None
-        self.complete = None
-        self.incomplet = None
+        self.announce(infoHash,
+                      uploaded,
+                      downloaded,
+                      left,
+                      EVENT_STOP,
+                      0)
 
     def complete(self, infoHash, uploaded, downloaded, numwant):
         """
@@ -204,22 +394,58 @@ class Tracker:
         Raises exception on failure
         """
 
-        # A null event specifies an update
+        self.announce(infoHash,
+                      uploaded,
+                      downloaded,
+                      0,
+                      EVENT_DONE,
+                      numwant)
+
+    def announce(self, 
+                 infoHash, 
+                 uploaded, 
+                 downloaded, 
+                 left, 
+                 event, 
+                 numwant, 
+                 timeout = None):
+        """
+        Sends an announcement with the given event
+        (one of the EVENT_ constants) to the tracker.
+        Sets internal tracker state.
+
+        `timeout' overrides the socket timeout of
+        the connection pool for this request.
+
+        Raises exception on failure
+        """
+
         try:
             comp,res = self.__sendRequest(infoHash, 
                                     uploaded, 
                                     downloaded, 
-                                    0, 
-                                    EVENT_DONE, 
-                                    numwant)
+                                    left, 
+                                    event, 
+                                    numwant,
+                                    timeout)
         except Exception, msg:
             self.lastFailure = str(msg)
+            self.lastFailureKind = self.__failureKind or failureKind(msg)
             raise Exception, msg
 
         if 'warning message' in res:
             self.lastWarning = res['warning message']
 
-        self.CompressedPeerList = comp
+        if event == EVENT_STOP:
+            self.peers = []
+            self.interval = None
+            self.minInterval = None
+            self.trackerID = None
+            self.complete = None
+            self.incomplete = None
+            return
+
+        self.compressedPeerList = comp
 
         # Expect at least a list of peers
         # and an interval
@@ -239,7 +465,14 @@ class Tracker:
         if 'incomplete' in res:
             self.incomplete = res['incomplete']
 
-    def __sendRequest(self, infoHash, uploaded, downloaded, left, event, numwant):
+    def __sendRequest(self, 
+                      infoHash, 
+                      uploaded, 
+                      downloaded, 
+                      left, 
+                      event, 
+                      numwant, 
+                      timeout = None):
         """
         Sends a request to a tracker, and
         returns:
@@ -250,9 +483,198 @@ class Tracker:
         a compressed peer list or not, and dict is the
         dictionary of response values.
 
+        The trackers are tried tier by tier (BEP 12)
+        until one responds, which then becomes
+        self.tracker and moves to the front of its
+        tier.  If `race' is more than 1, that many
+        trackers of a tier are asked at once and the
+        first to respond is used.
+
         If something failes an exception will be thrown.
         """
-        
+
+        args = (infoHash, uploaded, downloaded, left, event, numwant, timeout)
+
+        self.numRequests += 1
+        self.lastRequest = time.time()
+        self.__failureKind = None
+        try:
+            errors = []
+            url = dic = None
+            for tier in self.__tiers():
+                candidates = tier[:]
+                if self.preferFast:
+                    candidates.sort(key = lambda u: statsFor(u).rank())
+
+                for i in xrange(0, len(candidates), max(1, self.race)):
+                    group = candidates[i:i + max(1, self.race)]
+                    try:
+                        url, dic = self.__race(group, args)
+                        break
+                    except Exception, msg:
+                        last = msg
+                        if len(group) == 1:
+                            errors.append('%s: %s' % (group[0], str(msg)))
+                        else:
+                            errors.append(str(msg))
+                if dic is not None:
+                    # Stick to the tracker that responded
+                    tier.remove(url)
+                    tier.insert(0, url)
+                    break
+
+            if dic is None:
+                if len(errors) == 1 and len(group) == 1:
+                    # Just the one tracker
+                    raise Exception, last
+                raise Exception, 'No tracker responded (%s)' % '; '.join(errors)
+            self.__failureKind = None
+
+            if url != self.tracker:
+                # A tracker id is only good
+                # for the tracker that gave it
+                self.tracker = url
+                self.trackerID = None
+
+            # Check to see if the reponse is compressed.
+            # If the peers key is a string, the peers list
+            # is compressed otherwise assume its a list of dicts
+            compressed, dic['peers'] = decodePeers(dic)
+
+        except Exception, msg:
+            self.numFailures += 1
+            raise Exception, 'Tracker Error: %s' % str(msg)
+        finally:
+            self.lastLatency = time.time() - self.lastRequest
+            self.totalLatency += self.lastLatency
+
+        return (compressed, dic)
+
+    def __tiers(self):
+        """
+        The tiers of tracker urls to try, or just
+        self.tracker if the torrent has no
+        announce-list.
+        """
+
+        if self.tiers:
+            return self.tiers
+        return [[self.tracker]]
+
+    def __race(self, urls, args):
+        """
+        Sends the request to all of `urls' at once,
+        returning (url, dict) for the first to
+        respond.  The others are left to finish in
+        the background (and count towards their
+        statistics).
+        """
+
+        if len(urls) == 1:
+            return (urls[0], self.__requestOne(urls[0], args))
+
+        results = Queue.Queue()
+        def run(url):
+            try:
+                results.put((url, self.__requestOne(url, args), None))
+            except Exception, msg:
+                results.put((url, None, msg))
+
+        for url in urls:
+            t = threading.Thread(target = run, args = (url,))
+            t.setDaemon(True)
+            t.start()
+
+        errors = []
+        for i in xrange(len(urls)):
+            url, dic, err = results.get()
+            if err is None:
+                return (url, dic)
+            errors.append('%s: %s' % (url, str(err)))
+        raise Exception, '; '.join(errors)
+
+    def __requestOne(self, url, args):
+        """
+        Sends the request to the tracker at `url',
+        keeping its statistics, and returns the
+        response.  Fails fast if the tracker's
+        host is known to be down.
+        """
+
+        infoHash, uploaded, downloaded, left, event, numwant, timeout = args
+
+        breaker = breakerFor(url)
+        try:
+            breaker.allow()
+        except Exception:
+            self.__failureKind = 'breaker open'
+            raise
+
+        stats = statsFor(url)
+        sample = metrics.newSample()
+        start = time.time()
+        kind = None
+        try:
+            try:
+                # inspect the supplied tracker url
+                # (it will always have a protocol extension)
+                if urlparse.urlparse(url)[0].lower() == 'udp':
+                    dic = udp.getClient(url).announce(infoHash,
+                                                      self.peerID,
+                                                      uploaded,
+                                                      downloaded,
+                                                      left,
+                                                      event,
+                                                      numwant,
+                                                      self.port,
+                                                      self.ip,
+                                                      self.key,
+                                                      timeout or udpTimeout,
+                                                      sample)
+                else:
+                    dic = self.__httpRequest(url,
+                                             infoHash, 
+                                             uploaded, 
+                                             downloaded, 
+                                             left, 
+                                             event, 
+                                             numwant, 
+                                             timeout,
+                                             sample)
+            except:
+                breaker.failed()
+                raise
+            breaker.succeeded()
+
+            # Check out the response
+            if 'failure reason' in dic:
+                kind = 'failure reason'
+                raise Exception, dic['failure reason']
+        except Exception, msg:
+            self.__failureKind = kind or failureKind(msg)
+            stats.failed(str(msg))
+            metrics.record(url, sample, msg)
+            raise
+
+        stats.succeeded(time.time() - start)
+        metrics.record(url, sample, None, dic.get('warning message'))
+        return dic
+
+    def __httpRequest(self, 
+                      url,
+                      infoHash, 
+                      uploaded, 
+                      downloaded, 
+                      left, 
+                      event, 
+                      numwant, 
+                      timeout,
+                      sample = None):
+        """
+        Sends an announce to an HTTP tracker,
+        and returns the decoded response.
+        """
+
         params = {
             'info_hash'     :   infoHash,
             'peer_id'       :   self.peerID,
@@ -273,14 +695,13 @@ class Tracker:
             params['numwant'] = numwant
         if self.key:
             params['key'] = self.key
-        if self.trackerID:
+        if self.trackerID and url == self.tracker:
             params['trackerid'] = self.trackerID
 
         headers = {
             #'Content-type'  :   'application/x-www-form-urlencoded',
             'User-Agent'        :   self.userAgent,
             'Accept'            :   'text/plain',
-            'Connection'        :   'close',
             'Accept-Encoding'   :   'gzip'
         }
 
@@ -289,88 +710,456 @@ class Tracker:
         for key,val in params.items():
             vars.append('%s=%s' % (urllib.quote(key), urllib.quote(str(val))))
 
-        # inspect the supplied tracker url
-        # (it will always have a protocol extension)
-        (scheme, dom, path, params, query, fragment) = urlparse.urlparse(self.tracker)
-
         # If a query string is already present, append to it
+        query = urlparse.urlparse(url)[4]
         if query:
-            get = '&'.join(vars)
+            get = '&' + '&'.join(vars)
         else:
             get = '?' + '&'.join(vars)
-        t = self.tracker + get
+        t = url + get
 
+        return readResponse(httpGet(self.pool, t, headers, timeout, sample), sample)
+
+def failureKind(err):
+    """
+    Sorts an exception raised by a request
+    to a tracker into one of failureKinds.
+    Errors not raised while getting or reading
+    the response are the tracker's own (such
+    as those UDP trackers send back).
+    """
+
+    if isinstance(err, socket.timeout):
+        return 'timeout'
+    if isinstance(err, (socket.error, httplib.HTTPException)):
+        return 'http'
+
+    msg = str(err)
+    if msg in ('timed out', 'Tracker did not respond'):
+        return 'timeout'
+    if msg.startswith('Tracker host is down'):
+        return 'breaker open'
+    if msg.startswith(('HTTP Error', 'Too many redirects',
+                       'Unsupported URL scheme', 'No host in URL')):
+        return 'http'
+    if msg.startswith(('Unrecognizable response', 'Malformed',
+                       'Unexpected action')) or \
+            msg.endswith(('is too short', 'is malformed')):
+        return 'decode'
+    return 'failure reason'
+
+def httpGet(pool, url, headers, timeout, sample = None):
+    """
+    Sends a GET request to a tracker through
+    `pool'.  Requests through the shared
+    connectionPool use the current connectTimeout
+    and readTimeout, unless given a `timeout';
+    other pools use their own.
+    """
+
+    connect = None
+    if pool is connectionPool:
+        if timeout is None:
+            timeout = readTimeout
+        connect = connectTimeout
+    return pool.get(url, headers, timeout, sample, connect)
+
+def readResponse(fd, sample = None):
+    """
+    Reads and decodes the response to
+    a tracker request, gunzipping it if
+    need be, and closes it.  The time
+    spent gunzipping and decoding is
+    added to `sample' if given.
+    """
+
+    gunzip = decode = 0.0
+    decoded = 0
+    zipper = None
+    try:
+        if fd.status != 200:
+            raise Exception, 'HTTP Error %d: %s' % (fd.status, fd.reason)
+
+        # Check to see if the data was compressed 
+        #
+
+        encoding = fd.getheader('Content-Encoding')
+        if encoding == 'gzip':
+            # Data was compressed with gzip,
+            # (16 + MAX_WBITS expects a gzip header)
+            zipper = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # Assume data is not compressed?
+            zipper = None
+
+        # Decode the response as it arrives rather
+        # than buffering (and gunzipping) all of it
+        decoder = bencode.Decoder()
+        values = []
         try:
-            req = urllib2.Request(t, None, headers)
-            opener = urllib2.build_opener()
-            fd = opener.open(req)
-
-            # Check to see if the data was compressed 
-            #
-
-            encoding = fd.headers.get('Content-Encoding')
-            if encoding == 'gzip':
-                # Data was compressed with gzip
-                compressed = fd.read()
-                stream = StringIO.StringIO(compressed)
-                zipper = gzip.GzipFile(fileobj = stream)
-                data = zipper.read()
-            else:
-                # Assume data is not compressed?
-                data = fd.read()
+            while not values:
+                raw = fd.read(readSize)
+
+                start = time.time()
+                data = raw
+                if zipper:
+                    if raw:
+                        data = zipper.decompress(raw)
+                    else:
+                        data = zipper.flush()
+                    now = time.time()
+                    gunzip += now - start
+                    start = now
+                decoded += len(data)
+
+                if data:
+                    values = decoder.feed(data)
+                if not raw:
+                    decoder.close()
+                decode += time.time() - start
+                if not raw:
+                    break
+
+            if not values:
+                raise Exception, 'Empty response'
+        except Exception, msg:
+            raise Exception, 'Unrecognizable response: %s' % str(msg)
+    finally:
+        if sample is not None:
+            if zipper:
+                sample.add('gunzip', gunzip)
+            sample.add('decode', decode)
+            sample.decodedBytes += decoded
 
-            try:
-                dic = bencode.decode(data)
-            except Exception, msg:
-                raise Exception, 'Unrecognizable response: %s' % str(msg)
+        # Hands the connection back for reuse
+        fd.close()
 
-            # Check out the response
-            if 'failure reason' in dic:
-                raise Exception, dic['failure reason']
+    return values[0]
 
-            compressed = False
-            # Check to see if the reponse is compressed.
-            # If the peers key is a string, the peers list
-            # is compressed otherwise assume its a list of dicts
-            if isinstance(dic['peers'], str):
-                compressed = True
-                # 4 bytes per IP,
-                # 2 bytes per port.
-
-                hostEntLen = 6
-
-                dLen = len(dic['peers'])
-                if dLen % hostEntLen != 0:
-                    raise Exception, 'Compressed peers list is malformed'
-     
-                peers = []
-                # list of peers and ports dicts
-                if dLen > 0:
-                    i,j = 0, hostEntLen
-                    while j < dLen:
-                        hostEnt = dic['peers'][i:j]
-                        i += hostEntLen
-                        j += hostEntLen
-
-                        # First 4 bytes -> ip (network byte order)
-                        # Next 2 bytes -> port (network byte order)
-                        ip = hostEnt[0:4]
-                        ip = socket.inet_ntoa(ip)
-
-                        port, = struct.unpack('H', hostEnt[4:6])
-                        port = socket.ntohs(port)
-
-                        h = {
-                            'host'  : ip,
-                            'port'  : port
-                        }
-
-                        peers.append(h)
-
-                dic['peers'] = peers
+def announceMany(announces, workers = 32, timeout = None, progress = None):
+    """
+    Makes many announcements at once, `workers'
+    at a time, rather than one after another.
+    `announces' is a list of:
+
+    (tracker, infoHash, uploaded, downloaded, left, event, numwant)
+
+    as taken by Tracker.announce(), and each
+    Tracker is updated just as if it had been
+    called directly.  A Tracker may only appear
+    once.  Returns a list holding, for each
+    announcement in turn, None if it succeeded
+    or the exception it raised.
+
+    timeout     : Socket timeout of each request
+                  (seconds), by default that of
+                  the connection pool
+    progress    : Optional callback, called as
+                  progress(announcesMade, numAnnounces)
+
+    Requests to one host still share the few
+    connections the pool allows per host.
+    """
 
+    results = [None] * len(announces)
+    if not announces:
+        return results
+
+    def run(i):
+        tracker, infoHash, uploaded, downloaded, left, event, numwant = announces[i]
+        try:
+            tracker.announce(infoHash, 
+                             uploaded, 
+                             downloaded, 
+                             left, 
+                             event, 
+                             numwant, 
+                             timeout)
         except Exception, msg:
-            raise Exception, 'Tracker Error: %s' % str(msg)
+            return (i, msg)
+        return (i, None)
+
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(announces)))
+    try:
+        done = 0
+        for i, err in pool.imap_unordered(run, xrange(len(announces))):
+            results[i] = err
+            done += 1
+            if progress:
+                progress(done, len(announces))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+def scrapeURL(url):
+    """
+    Returns the scrape URL of the tracker with
+    the announce URL `url', or None if it does
+    not support scraping.  By convention, it is
+    the announce URL with the 'announce' at the
+    start of its last path component replaced
+    by 'scrape'.
+    """
 
-        return (compressed, dic)
+    parts = urlparse.urlparse(url)
+    if parts[0].lower() == 'udp':
+        return url
+
+    path = parts[2]
+    i = path.rfind('/') + 1
+    if not path[i:].startswith('announce'):
+        return None
+
+    path = path[:i] + 'scrape' + path[i + len('announce'):]
+    return urlparse.urlunparse(parts[:2] + (path,) + parts[3:])
+
+def scrape(url, 
+           infoHashes, 
+           timeout = None, 
+           pool = None, 
+           userAgent = userAgent):
+    """
+    Asks the tracker with the announce URL `url'
+    about all of `infoHashes' in a single request,
+    and returns:
+
+    { infoHash : { complete, downloaded, incomplete } }
+
+    leaving out the torrents the tracker
+    doesn't know about.  Requests to HTTP
+    trackers go through `pool' (by default,
+    the shared connectionPool).
+
+    Raises exception on failure
+    """
+
+    sample = None
+    try:
+        surl = scrapeURL(url)
+        if surl is None:
+            raise Exception, 'Scraping is not supported'
+
+        breaker = breakerFor(url)
+        breaker.allow()
+
+        sample = metrics.newSample()
+        try:
+            if urlparse.urlparse(url)[0].lower() == 'udp':
+                res = udp.getClient(url).scrape(infoHashes, timeout or udpTimeout, sample)
+            else:
+                vars = ['info_hash=%s' % urllib.quote(h) for h in infoHashes]
+                if urlparse.urlparse(surl)[4]:
+                    t = surl + '&' + '&'.join(vars)
+                else:
+                    t = surl + '?' + '&'.join(vars)
+
+                headers = {
+                    'User-Agent'        :   userAgent,
+                    'Accept'            :   'text/plain',
+                    'Accept-Encoding'   :   'gzip'
+                }
+                res = readResponse(httpGet(pool or connectionPool, t, headers, timeout, sample),
+                                   sample)
+        except:
+            breaker.failed()
+            raise
+        breaker.succeeded()
+
+        if 'failure reason' in res:
+            raise Exception, res['failure reason']
+
+        files = res.get('files', {})
+        if not isinstance(files, dict):
+            raise Exception, 'Malformed scrape response'
+
+        stats = {}
+        for infoHash in infoHashes:
+            if isinstance(files.get(infoHash), dict):
+                stats[infoHash] = files[infoHash]
+
+    except Exception, msg:
+        metrics.record(url, sample, msg)
+        raise Exception, 'Tracker Error: %s' % str(msg)
+
+    metrics.record(url, sample, None, res.get('warning message'))
+    return stats
+
+def scrapeMany(scrapes, 
+               batchSize = None, 
+               workers = 8, 
+               timeout = None, 
+               progress = None):
+    """
+    Scrapes many torrents, grouping them by tracker
+    so that each request asks about up to `batchSize'
+    (by default `scrapeBatch') torrents at once.
+    `scrapes' is a list of:
+
+    (tracker, infoHash)
+
+    and the complete, incomplete and timesDownloaded
+    members of each Tracker are set from the results.
+    Returns a list holding, for each scrape in turn,
+    None if it succeeded or the exception it raised.
+
+    workers     : Number of requests made at once
+    timeout     : Socket timeout of each request
+                  (seconds)
+    progress    : Optional callback, called as
+                  progress(requestsMade, numRequests)
+    """
+
+    batchSize = batchSize or scrapeBatch
+    results = [None] * len(scrapes)
+
+    # scrape URL -> { infoHash : [index, ...] }
+    groups = {}
+    for i in xrange(len(scrapes)):
+        tracker, infoHash = scrapes[i]
+        surl = scrapeURL(tracker.tracker)
+        if surl is None:
+            results[i] = Exception('Tracker Error: Scraping is not supported')
+            continue
+        groups.setdefault(surl, {}).setdefault(infoHash, []).append(i)
+
+    batches = []
+    for surl, byHash in groups.items():
+        size = batchSize
+        if urlparse.urlparse(surl)[0].lower() == 'udp':
+            size = min(size, udp.maxScrape)
+
+        hashes = byHash.keys()
+        for j in xrange(0, len(hashes), size):
+            batches.append((surl, hashes[j:j + size], byHash))
+
+    if not batches:
+        return results
+
+    def run(batch):
+        surl, hashes, byHash = batch
+        first = scrapes[byHash[hashes[0]][0]][0]
+        try:
+            stats = scrape(first.tracker, hashes, timeout, first.pool, first.userAgent)
+        except Exception, msg:
+            return (batch, None, msg)
+        return (batch, stats, None)
+
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(batches)))
+    try:
+        done = 0
+        for batch, stats, err in pool.imap_unordered(run, batches):
+            surl, hashes, byHash = batch
+            for infoHash in hashes:
+                for i in byHash[infoHash]:
+                    tracker = scrapes[i][0]
+                    if err is not None:
+                        results[i] = err
+                    elif infoHash not in stats:
+                        results[i] = Exception('Tracker Error: Torrent not found')
+                    else:
+                        st = stats[infoHash]
+                        tracker.complete = st.get('complete')
+                        tracker.incomplete = st.get('incomplete')
+                        tracker.timesDownloaded = st.get('downloaded')
+
+            done += 1
+            if progress:
+                progress(done, len(batches))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+def decodePeers(res):
+    """
+    Decodes the peers of an announce response,
+    in whichever formats it holds them: a compact
+    list (BEP 23) or a list of dicts under 'peers',
+    and a compact list of IPv6 peers (BEP 7) under
+    'peers6'.  Returns:
+
+    (compressed, peers)
+
+    where compressed says if the response used a
+    compact list, and peers is a list of (ip, port)
+    tuples.
+    """
+
+    peers = res.get('peers', [])
+    if isinstance(peers, str):
+        compressed = True
+        peers = decodeCompactPeers(peers)
+    elif isinstance(peers, list):
+        compressed = False
+        peers = decodeDictPeers(peers)
+    else:
+        raise Exception, 'Peers list is malformed'
+
+    if 'peers6' in res:
+        if not isinstance(res['peers6'], str):
+            raise Exception, 'IPv6 peers list is malformed'
+        compressed = True
+        peers.extend(decodeCompactPeers6(res['peers6']))
+
+    return (compressed, peers)
+
+def decodeCompactPeers(s):
+    """
+    Decodes a compact (BEP 23) peer list,
+    returning a list of (ip, port) tuples.
+    """
+
+    # 4 bytes per IP,
+    # 2 bytes per port,
+    # both in network byte order.
+
+    if len(s) % 6 != 0:
+        raise Exception, 'Compressed peers list is malformed'
+
+    n = len(s) / 6
+    if not n:
+        return []
+
+    # Unpack every entry in one go,
+    # then pair up ips and ports
+    fields = struct.unpack('!' + '4sH' * n, s)
+    return zip(map(socket.inet_ntoa, fields[0::2]), fields[1::2])
+
+def decodeCompactPeers6(s):
+    """
+    Decodes a compact IPv6 (BEP 7) peer list,
+    returning a list of (ip, port) tuples.
+    """
+
+    # 16 bytes per IP,
+    # 2 bytes per port.
+
+    if len(s) % 18 != 0:
+        raise Exception, 'Compressed IPv6 peers list is malformed'
+
+    n = len(s) / 18
+    if not n:
+        return []
+
+    fields = struct.unpack('!' + '16sH' * n, s)
+    return zip(map(socket.inet_ntop, [socket.AF_INET6] * n, fields[0::2]),
+               fields[1::2])
+
+def decodeDictPeers(l):
+    """
+    Decodes a list of { peer id, ip, port }
+    dicts, returning a list of (ip, port)
+    tuples.
+    """
 
+    peers = []
+    for peer in l:
+        if not isinstance(peer, dict) or \
+                not isinstance(peer.get('ip'), str) or \
+                not isinstance(peer.get('port'), (int, long)):
+            raise Exception, 'Peers list is malformed'
+        peers.append((peer['ip'], int(peer['port'])))
+    return peers
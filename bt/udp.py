@@ -0,0 +1,347 @@
+"""
+Defines a client for the UDP tracker
+protocol (BEP 15).
+
+Copyright (C) 2007 Matt Waddell
+ALL RIGHTS RESERVED
+"""
+
+import socket, struct, random, threading, time, urlparse
+
+# Magic number a connect request starts with
+protocolID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+# Announce events, by the name
+# used in HTTP announces
+events = {
+    ''          :   0,
+    'completed' :   1,
+    'started'   :   2,
+    'stopped'   :   3
+}
+
+# How long a connection ID may be used for
+connectionLifetime = 60
+
+# Requests are retransmitted after 15 * 2^n
+# seconds, n going from 0 to `maxRetries'
+baseTimeout = 15
+maxRetries = 8
+
+# Most info hashes one scrape can carry
+maxScrape = 74
+
+# One client per tracker address, so that
+# connection IDs are shared by every torrent
+clients = {}
+clientsLock = threading.Lock()
+
+def getClient(url):
+    """
+    Returns the Client for the
+    tracker at a udp:// URL.
+    """
+
+    parts = urlparse.urlparse(url)
+    if parts.scheme.lower() != 'udp':
+        raise Exception, 'Not a UDP tracker: %s' % url
+    if not parts.hostname or not parts.port:
+        raise Exception, 'UDP tracker URL needs a host and port: %s' % url
+
+    key = (parts.hostname, parts.port)
+    clientsLock.acquire()
+    try:
+        if key not in clients:
+            clients[key] = Client(parts.hostname, parts.port)
+        return clients[key]
+    finally:
+        clientsLock.release()
+
+class Client:
+    """
+    Talks to a single UDP tracker.
+
+    A connection ID is fetched before the first
+    request and reused by later ones until it is
+    `connectionLifetime' seconds old.  Each request
+    goes out on a socket of its own, so a Client
+    may be used from several threads at once.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+        self.lock = threading.Lock()
+        self.connectionID = None
+        self.connectedAt = 0
+
+        # Client statistics
+        self.connects = 0
+        self.retransmits = 0
+
+    def announce(self,
+                 infoHash,
+                 peerID,
+                 uploaded,
+                 downloaded,
+                 left,
+                 event,
+                 numwant,
+                 port,
+                 ip = None,
+                 key = None,
+                 timeout = None,
+                 sample = None):
+        """
+        Announces to the tracker, returning the
+        response in the same form as an HTTP
+        tracker's:
+
+        { interval, complete, incomplete, peers }
+
+        `peers' being a compact peer list (or
+        `peers6' if the tracker was reached
+        over IPv6).  `timeout' bounds the time
+        spent on retransmissions (seconds).  If
+        a metrics.Sample is given, the time spent
+        and bytes moved are added to it.
+        """
+
+        if event not in events:
+            raise Exception, 'Unknown event: %s' % event
+
+        if ip:
+            # Only an IPv4 address fits
+            try:
+                ip, = struct.unpack('!I', socket.inet_aton(ip))
+            except socket.error:
+                ip = 0
+        else:
+            ip = 0
+
+        # The key is a 32 bit number here
+        if key is None:
+            key = 0
+        elif not isinstance(key, (int, long)):
+            key = hash(key)
+        key &= 0xffffffff
+
+        if not numwant:
+            numwant = -1
+
+        body = struct.pack('!20s20sQQQIIIiH',
+                           infoHash,
+                           peerID,
+                           downloaded,
+                           left,
+                           uploaded,
+                           events[event],
+                           ip,
+                           key,
+                           numwant,
+                           port)
+
+        family, data = self.__request(ACTION_ANNOUNCE, body, timeout, sample)
+        if len(data) < 12:
+            raise Exception, 'Announce response is too short'
+
+        interval, leechers, seeders = struct.unpack('!III', data[:12])
+        res = {
+            'interval'      :   interval,
+            'complete'      :   seeders,
+            'incomplete'    :   leechers,
+            'peers'         :   ''
+        }
+        if family == socket.AF_INET6:
+            res['peers6'] = data[12:]
+        else:
+            res['peers'] = data[12:]
+        return res
+
+    def scrape(self, infoHashes, timeout = None, sample = None):
+        """
+        Scrapes up to `maxScrape' torrents, returning
+        the response in the same form as an HTTP
+        tracker's:
+
+        { 'files' : { infoHash : { complete, downloaded, incomplete } } }
+        """
+
+        if len(infoHashes) > maxScrape:
+            raise Exception, 'Too many info hashes for one scrape'
+
+        family, data = self.__request(ACTION_SCRAPE, ''.join(infoHashes), timeout, sample)
+        if len(data) < 12 * len(infoHashes):
+            raise Exception, 'Scrape response is too short'
+
+        files = {}
+        for i in xrange(len(infoHashes)):
+            seeders, completed, leechers = \
+                struct.unpack('!III', data[12 * i:12 * i + 12])
+            files[infoHashes[i]] = {
+                'complete'      :   seeders,
+                'downloaded'    :   completed,
+                'incomplete'    :   leechers
+            }
+        return { 'files' : files }
+
+    def __request(self, action, body, timeout, sample):
+        """
+        Sends a request (connecting first if need
+        be), retransmitting it on the BEP 15
+        schedule, and returns (addressFamily,
+        response) with the response header removed.
+        """
+
+        start = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+
+        family, socktype, proto, name, address = \
+            socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)[0]
+        if sample is not None:
+            sample.add('dns', time.time() - start)
+        sock = socket.socket(family, socktype, proto)
+        try:
+            # Only hear from the tracker (and hear
+            # about it if nothing is listening)
+            sock.connect(address)
+
+            n = 0
+            connectionID = None
+            while True:
+                if n > maxRetries:
+                    raise Exception, 'Tracker did not respond'
+
+                wait = baseTimeout * 2**n
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise Exception, 'timed out'
+
+                if connectionID is None:
+                    connectionID = self.__connectionID()
+                if connectionID is None:
+                    tid = newTransactionID()
+                    packet = struct.pack('!QII', protocolID, ACTION_CONNECT, tid)
+                    reply = self.__exchange(sock, packet, tid, wait, sample, 'connect')
+                    if reply is None:
+                        n += 1
+                        self.retransmits += 1
+                        continue
+
+                    replyAction, data = reply
+                    if replyAction == ACTION_ERROR:
+                        raise Exception, data
+                    if replyAction != ACTION_CONNECT or len(data) < 8:
+                        raise Exception, 'Malformed connect response'
+
+                    connectionID, = struct.unpack('!Q', data[:8])
+                    self.__setConnectionID(connectionID)
+                    continue
+
+                tid = newTransactionID()
+                packet = struct.pack('!QII', connectionID, action, tid) + body
+                reply = self.__exchange(sock, packet, tid, wait, sample, 'transfer')
+                if reply is None:
+                    n += 1
+                    self.retransmits += 1
+
+                    # Check it hasn't expired meanwhile
+                    connectionID = None
+                    continue
+
+                replyAction, data = reply
+                if replyAction == ACTION_ERROR:
+                    # In case it was turned down for
+                    # its connection ID, get a new one
+                    self.__forget(connectionID)
+                    raise Exception, data
+                if replyAction != action:
+                    raise Exception, 'Unexpected action in response: %d' % replyAction
+                if sample is not None:
+                    sample.bodyBytes += len(data)
+                    sample.decodedBytes += len(data)
+                return (family, data)
+        finally:
+            sock.close()
+
+    def __exchange(self, sock, packet, tid, wait, sample, phase):
+        """
+        Sends a packet and waits up to `wait' seconds
+        for the response with the same transaction ID.
+        Returns (action, data), or None if none came.
+        The time taken counts towards `phase' of
+        `sample', if given.
+        """
+
+        start = time.time()
+        try:
+            sock.send(packet)
+            if sample is not None:
+                sample.bytesOut += len(packet)
+
+            end = start + wait
+            while True:
+                left = end - time.time()
+                if left <= 0:
+                    return None
+                sock.settimeout(left)
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    return None
+                if sample is not None:
+                    sample.bytesIn += len(data)
+
+                # Anything else is a stray (or
+                # late) response, so ignore it
+                if len(data) >= 8:
+                    replyAction, replyTID = struct.unpack('!II', data[:8])
+                    if replyTID == tid:
+                        return (replyAction, data[8:])
+        finally:
+            if sample is not None:
+                sample.add(phase, time.time() - start)
+
+    def __connectionID(self):
+        self.lock.acquire()
+        try:
+            if self.connectionID is not None and \
+                    time.time() - self.connectedAt < connectionLifetime:
+                return self.connectionID
+            self.connectionID = None
+            return None
+        finally:
+            self.lock.release()
+
+    def __forget(self, connectionID):
+        self.lock.acquire()
+        try:
+            if self.connectionID == connectionID:
+                self.connectionID = None
+        finally:
+            self.lock.release()
+
+    def __setConnectionID(self, connectionID):
+        self.lock.acquire()
+        try:
+            self.connectionID = connectionID
+            self.connectedAt = time.time()
+            self.connects += 1
+        finally:
+            self.lock.release()
+
+def newTransactionID():
+    """
+    A random 32 bit transaction ID.
+    """
+
+    return random.getrandbits(32)
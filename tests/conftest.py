@@ -0,0 +1,8 @@
+"""
+Puts the repository root on the path, so the
+tests import the bt package from this tree.
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
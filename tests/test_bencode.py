@@ -0,0 +1,192 @@
+"""
+Tests of the bencode encoder and decoders.
+"""
+
+import pytest
+from bt import bencode
+
+reply = {
+    'interval'  :   1800,
+    'peers'     :   '\x7f\x00\x00\x01\x1a\xe1',
+    'files'     :   [{ 'length' : 12, 'path' : ['a', 'b'] }]
+}
+
+def feedAll(chunks):
+    decoder = bencode.Decoder()
+    values = []
+    for chunk in chunks:
+        values.extend(decoder.feed(chunk))
+    decoder.close()
+    return values
+
+def testRoundTrip():
+    s = bencode.encode(reply)
+    assert bencode.decode(s) == reply
+    assert bencode.decode(s, True) == reply
+
+def testRoundTripValues():
+    values = [
+        0L, -1L, 2L**70, -2L**70, '', 'x' * 5000, '\x00:e\xff',
+        [], {}, [[], {}, [[]]], { '' : '' },
+        { 'a' : [1L, 'b', { 'c' : [] }], 'b' : { 'd' : -5L, 'e' : 'i1e' } },
+        # Strings longer than the looked up lengths
+        { 'peers' : 'p' * 1023, 'peers6' : 'q' * 1024, 'x' : ['r' * 2000] },
+        [{ 'length' : long(n), 'path' : ['dir', 'f%d' % n] } for n in xrange(300)]
+    ]
+    for val in values:
+        s = bencode.encode(val)
+        assert bencode.decode(s) == val
+        assert bencode.decode(s, True) == val
+        assert bencode.decodeAt('xx' + s + 'yy', 2) == (val, len(s) + 2)
+        assert bencode.encode(bencode.decode(s)) == s
+
+class Writes:
+    """
+    Keeps every write, as a file would.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, s):
+        self.writes.append(s)
+
+    def getvalue(self):
+        return ''.join(self.writes)
+
+def testEncodeTo():
+    big = 'x' * 100
+    for val in (reply, 0, '', [], {}, [big, { 'a' : big, 'b' : [1, 'c'] }]):
+        for bufSize in (1, 7, 64, 65536):
+            fd = Writes()
+            bencode.encodeTo(fd, val, bufSize)
+            assert fd.getvalue() == bencode.encode(val)
+
+    # Writes are gathered up to `bufSize', and
+    # large strings written through as they are
+    fd = Writes()
+    bencode.encodeTo(fd, ['a' * 10, 'b' * 10, big, 'c'], 16)
+    assert fd.writes == ['l10:' + 'a' * 10 + '10:', 'b' * 10 + '100:', big, '1:ce']
+    assert fd.writes[2] is big
+
+    with pytest.raises(Exception) as e:
+        bencode.encodeTo(Writes(), { 1 : 2 })
+    assert str(e.value) == 'Encode Error: Dictionary keys must be Strings'
+
+def testEncodeSplice():
+    info = { 'name' : 'a', 'pieces' : 'x' * 20, 'piece length' : 16 }
+    raw = bencode.encode(info)
+    tor = { 'announce' : 'http://t/announce', 'info' : bencode.Encoded(raw) }
+
+    # Spliced as is, sorted among the other keys
+    s = bencode.encode(tor)
+    assert s == bencode.encode({ 'announce' : 'http://t/announce', 'info' : info })
+    assert bencode.decode(s)['info'] == info
+    fd = Writes()
+    bencode.encodeTo(fd, tor, 8)
+    assert fd.getvalue() == s
+
+    # Even bytes that wouldn't come out the same
+    unsorted = 'd1:bi1e1:ai2ee'
+    s = bencode.encode({ 'z' : [bencode.Encoded(unsorted)], 'a' : 0 })
+    assert s == 'd1:ai0e1:zl' + unsorted + 'ee'
+    assert repr(bencode.Encoded(unsorted)) == '<Encoded 14 bytes>'
+
+def testDecodeLongs():
+    # Integers are always longs, as Torrent
+    # checks file lengths for
+    assert isinstance(bencode.decode('i1e'), long)
+    assert isinstance(bencode.decode('d1:ai1ee')['a'], long)
+    assert isinstance(bencode.decode('li1ee')[0], long)
+
+def testDecodeNonStringKeys():
+    assert bencode.decode('di1ei2ee') == { 1L : 2L }
+
+# (input, message) of the errors the original
+# decoder reported, which must not change
+errors = [
+    ('di1ei2ee',    'Dictionary keys must be Strings'),
+    ('dli1ee1:ae',  'Dictionary keys must be Strings'),
+    ('d1:b0:1:a0:e', 'Dictionary keys must be in sorted order'),
+    ('d1:a0:1:a0:e', 'Dictionary keys must be in sorted order'),
+    ('i12x3e',      'Malformed Integer value: 12x3'),
+    ('d1:aixee',    'Malformed Integer value: x'),
+    ('x',           'Unexpected Character: x'),
+    ('d1:ax',       'Unexpected Character: x'),
+    ('l1:ax',       'Unexpected Character: x'),
+    ('l1:a',        'Unexpected EOF in List declaration'),
+    ('li1ei2e',     'Unexpected EOF in List declaration'),
+    ('d3:abci1e',   'Unexpected EOF in Dict declaration'),
+    ('i12',         'Unexpected EOF in Integer declaration'),
+    ('d1:ai12',     'Unexpected EOF in Integer declaration'),
+    ('5:abc',       'Unexpected EOF in String declaration'),
+    ('d1:a5:abc',   'Unexpected EOF in String declaration'),
+    ('l5:abc',      'Unexpected EOF in String declaration'),
+    ('l12',         'Unexpected EOF in String declaration'),
+]
+
+# Where it failed with an internal error
+# instead, and what is reported now
+fixedErrors = [
+    ('',            'Unexpected EOF'),
+    ('d',           'Unexpected EOF in Dict declaration'),
+    ('d1:a',        'Unexpected EOF in Dict declaration'),
+    ('l',           'Unexpected EOF in List declaration'),
+    ('1x:a',        'Malformed Integer value in String length: 1x'),
+    ('l1x:a',       'Malformed Integer value in String length: 1x'),
+]
+
+def testDecodeErrors():
+    for s, message in errors + fixedErrors:
+        strictOnly = message.startswith('Dictionary keys')
+        for strict in (False, True):
+            if strictOnly and not strict:
+                continue
+            with pytest.raises(Exception) as e:
+                bencode.decode(s, strict)
+            assert str(e.value) == 'Parse Error: ' + message, (s, strict)
+
+def testDecodeIgnoresTrailingData():
+    assert bencode.decode(bencode.encode(reply) + '\n') == reply
+
+def testDecoderOneChunk():
+    assert feedAll([bencode.encode(reply)]) == [reply]
+
+def testDecoderOneByteChunks():
+    s = bencode.encode(reply)
+    assert feedAll([c for c in s]) == [reply]
+
+def testDecoderTrailingNewline():
+    s = bencode.encode(reply) + '\n'
+    assert feedAll([s]) == [reply]
+    assert feedAll([c for c in s]) == [reply]
+
+def testDecoderIgnoresLaterChunks():
+    decoder = bencode.Decoder()
+    assert decoder.feed('i1e') == [1]
+    assert decoder.feed('garbage') == []
+    decoder.close()
+
+def testDecoderUnfinished():
+    decoder = bencode.Decoder()
+    assert decoder.feed('d3:foo') == []
+    with pytest.raises(Exception):
+        decoder.close()
+
+def testDecoderBadCharacter():
+    with pytest.raises(Exception):
+        bencode.Decoder().feed('x')
+
+def testSkipTally():
+    s = bencode.encode({ 'files' : [{ 'length' : 12, 'path' : ['length'] },
+                                    { 'length' : 30, 'path' : ['x'] }],
+                         'length' : 7,
+                         'other' : { 'length' : 100 } })
+    tally = { ('files', None, 'length') : 0, ('length',) : 0 }
+    assert bencode.skipAt(s, 0, None, tally) == len(s)
+    assert tally == { ('files', None, 'length') : 42, ('length',) : 7 }
+
+    tally = { ('x', 'files', None, 'length') : 0 }
+    d = bencode.decodeLazy(bencode.encode({ 'x' : bencode.decode(s) }), tally = tally)
+    assert tally.values() == [42]
+    assert d['x']['other']['length'] == 100
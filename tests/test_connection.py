@@ -0,0 +1,75 @@
+"""
+Tests of the pool of keep-alive connections.
+"""
+
+import socket, threading, time, BaseHTTPServer
+from bt import connection, tracker
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+def serve():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target = server.serve_forever, args = (0.05,))
+    t.setDaemon(True)
+    t.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+def testWaitIsBounded():
+    server, url = serve()
+    pool = connection.ConnectionPool(maxPerHost = 1, timeout = 5)
+    try:
+        held = pool.get(url)
+
+        start = time.time()
+        try:
+            pool.get(url, timeout = 0.2)
+        except socket.timeout:
+            pass
+        else:
+            assert False, 'no timeout'
+        assert 0.15 < time.time() - start < 2
+
+        # Released in time
+        threading.Timer(0.1, held.close).start()
+        resp = pool.get(url, timeout = 2)
+        assert resp.read() == 'ok'
+        resp.close()
+        assert pool.connects == 1 and pool.reuses == 1
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+class RecordingPool:
+    def __init__(self):
+        self.calls = []
+
+    def get(self, *args):
+        self.calls.append(args)
+
+def testTrackerTimeouts(monkeypatch):
+    shared = RecordingPool()
+    other = RecordingPool()
+    monkeypatch.setattr(tracker, 'connectionPool', shared)
+
+    monkeypatch.setattr(tracker, 'readTimeout', 7)
+    monkeypatch.setattr(tracker, 'connectTimeout', 3)
+    tracker.httpGet(shared, 'u', {}, None)
+    monkeypatch.setattr(tracker, 'readTimeout', 8)
+    tracker.httpGet(shared, 'u', {}, None)
+    tracker.httpGet(shared, 'u', {}, 1)
+    assert [c[2:] for c in shared.calls] == [(7, None, 3), (8, None, 3), (1, None, 3)]
+
+    # Other pools keep their own timeouts
+    tracker.httpGet(other, 'u', {}, None)
+    assert other.calls[0][2:] == (None, None, None)
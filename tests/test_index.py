@@ -0,0 +1,52 @@
+"""
+Tests of the status page, as JSON and
+in the Prometheus text format.
+"""
+
+import json
+from hashlib import sha1
+from bt import index, metrics, state, torrent
+
+def makeState(peerID, name = 'test', url = 'http://tracker.example.com/announce'):
+    tor = torrent.Torrent({
+        'announce'  :   url,
+        'info'      :   {
+            'name'          :   name,
+            'piece length'  :   2**18,
+            'pieces'        :   sha1(name).digest(),
+            'length'        :   2**18
+        }
+    })
+    return state.State(tor, peerID, 6881)
+
+def testBinaryStrings():
+    st = makeState('-TS0001-\xff\xfe000000000', name = 'caf\xe9',
+                   url = 'http://tracker.example.com/\xff')
+    st.tracker.lastFailure = 'bad \xc3('
+    st.tracker.lastFailureKind = 'failure reason'
+    hosts = { 'http://tracker.example.com:80' : metrics.HostMetrics().snapshot() }
+    hosts['http://tracker.example.com:80']['lastFailure'] = 'gone \x80'
+
+    page = json.loads(index.toJSON([index.status(st)], hosts))
+    t = page['torrents'][0]
+    assert t['name'] == u'caf\ufffd'
+    assert t['tracker']['url'] == u'http://tracker.example.com/\ufffd'
+    assert t['tracker']['lastFailure'] == u'bad \ufffd('
+    assert page['trackers']['http://tracker.example.com:80']['lastFailure'] == \
+        u'gone \ufffd'
+
+    text = index.toPrometheus([index.status(st)], hosts)
+    text.decode('utf-8')
+    assert 'name="caf\xef\xbf\xbd"' in text
+    assert 'bad' not in text
+    assert 'reason="failure reason"' in text
+    assert t['tracker']['lastFailureKind'] == 'failure reason'
+
+def testSharedTorrent():
+    states = [makeState('-TS0001-%012d' % i) for i in xrange(3)]
+    text = index.toPrometheus([index.status(st) for st in states])
+
+    samples = [l for l in text.splitlines() if l.startswith('bt_torrent_state{')]
+    assert len(samples) == 3
+    labels = [l[:l.rindex(' ')] for l in samples]
+    assert len(set(labels)) == 3
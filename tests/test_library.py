@@ -0,0 +1,136 @@
+"""
+Tests of indexing a directory of torrent
+files, and of saving and loading the index.
+"""
+
+import os
+from hashlib import sha1
+from bt import bencode, library
+
+def info(name, files = None):
+    d = {
+        'name'          :   name,
+        'piece length'  :   2**18,
+        'pieces'        :   sha1(name).digest()
+    }
+    if files is None:
+        d['length'] = 2**18
+    else:
+        d['files'] = [{ 'length' : 2**17, 'path' : path } for path in files]
+    return d
+
+def writeTorrent(directory, fileName, d):
+    path = directory.join(fileName)
+    path.write(bencode.encode({
+        'announce'  :   'http://tracker.example.com/announce',
+        'info'      :   d
+    }), 'wb')
+    return str(path)
+
+def testScan(tmpdir):
+    root = tmpdir.mkdir('torrents')
+    sub = root.mkdir('sub')
+    single = writeTorrent(root, 'single.torrent', info('single'))
+    multi = writeTorrent(sub, 'multi.torrent', info('multi', [['a', 'b'], ['c']]))
+    copy = writeTorrent(sub, 'copy.torrent', info('single'))
+    root.join('corrupt.torrent').write('d4:infod4:name', 'wb')
+    root.join('notes.txt').write('not a torrent')
+    corrupt = str(root.join('corrupt.torrent'))
+
+    lib = library.Library()
+    assert lib.scan(str(root), processes = False) == (4, 0, 0)
+    assert len(lib) == 4
+
+    infoHash = sha1(bencode.encode(info('single'))).digest()
+    assert lib.lookup(infoHash) == sorted([single, copy])
+    assert lib.lookup('x' * 20) == []
+    assert lib.named('multi') == [multi]
+    assert lib.containing(os.path.join('multi', 'a', 'b')) == [multi]
+    assert lib.containing('multi/a/../c') == [multi]
+    assert lib.containing('single') == sorted([single, copy])
+
+    assert lib.errors().keys() == [corrupt]
+    assert lib.info(corrupt)['error']
+    assert 'hash' not in lib.info(corrupt)
+    assert lib.info(multi)['length'] == 2**18
+    assert lib.info(str(root.join('notes.txt'))) is None
+
+    # Nothing changed
+    assert lib.scan(str(root), processes = False) == (0, 0, 0)
+
+    # Gone
+    os.remove(copy)
+    assert lib.scan(str(root), processes = False) == (0, 0, 1)
+    assert lib.lookup(infoHash) == [single]
+
+def testScanPool(tmpdir):
+    root = tmpdir.mkdir('torrents')
+    for i in xrange(library.chunkSize * 2):
+        writeTorrent(root, '%d.torrent' % i, info('t%d' % i))
+
+    calls = []
+    lib = library.Library()
+    assert lib.scan(str(root), workers = 2, processes = False,
+                    progress = lambda *a: calls.append(a)) == (32, 0, 0)
+    assert calls[-1] == (32, 32)
+    assert lib.errors() == {}
+    for i in xrange(32):
+        assert lib.named('t%d' % i) == [str(root.join('%d.torrent' % i))]
+
+def testRescanChanged(tmpdir):
+    root = tmpdir.mkdir('torrents')
+    path = writeTorrent(root, 'a.torrent', info('before'))
+    lib = library.Library()
+    lib.scan(str(root), processes = False)
+
+    # Same size, new mtime
+    writeTorrent(root, 'a.torrent', info('after!'))
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+    assert os.stat(path).st_size == st.st_size
+
+    assert lib.scan(str(root), processes = False) == (0, 1, 0)
+    assert lib.named('before') == []
+    assert lib.named('after!') == [path]
+    assert len(lib.byHash) == 1
+
+    # Broken, then mended
+    root.join('a.torrent').write('garbage', 'wb')
+    assert lib.scan(str(root), processes = False) == (0, 1, 0)
+    assert lib.errors().keys() == [path] and lib.byName == {}
+    writeTorrent(root, 'a.torrent', info('after!'))
+    assert lib.scan(str(root), processes = False) == (0, 1, 0)
+    assert lib.errors() == {}
+
+def testSaveLoad(tmpdir):
+    root = tmpdir.mkdir('torrents')
+    path = writeTorrent(root, 'a.torrent', info('a', [['x'], ['y', 'z']]))
+    root.join('bad.torrent').write('garbage', 'wb')
+    saved = str(tmpdir.join('library'))
+
+    lib = library.Library(saved)
+    lib.scan(str(root), processes = False)
+    lib.save()
+    assert not [p for p in os.listdir(str(tmpdir)) if p.endswith('.tmp')]
+
+    again = library.Library(saved)
+    assert again.entries == lib.entries
+    assert again.byHash == lib.byHash
+    assert again.byFile == lib.byFile
+    assert again.errors() == lib.errors()
+    assert again.containing(os.path.join('a', 'y', 'z')) == [path]
+
+    # Nothing to parse again
+    assert again.scan(str(root), processes = False) == (0, 0, 0)
+
+    # Saved by another version
+    old = library.libraryVersion
+    library.libraryVersion = old + 1
+    try:
+        assert len(library.Library(saved)) == 0
+    finally:
+        library.libraryVersion = old
+
+    # Not an index at all
+    tmpdir.join('library').write('junk', 'wb')
+    assert len(library.Library(saved)) == 0
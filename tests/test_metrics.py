@@ -0,0 +1,65 @@
+"""
+Tests of the per tracker host metrics.
+"""
+
+import json
+from hashlib import sha1
+from bt import connection, metrics, mocktracker, tracker
+
+def testQuantile():
+    h = metrics.Histogram()
+    assert h.quantile(0.5) is None
+
+    for v in (0.0005, 0.003, 0.003, 0.2):
+        h.observe(v)
+    assert h.quantile(0.25) == 0.001
+    assert h.quantile(0.5) == 0.005
+    assert h.quantile(1.0) == 0.25
+
+    # Past the last bucket
+    h.observe(1000.0)
+    assert h.quantile(1.0) == metrics.buckets[-1]
+    assert h.snapshot()['buckets'][-1] == 5
+
+def testSnapshotIsJSON():
+    m = metrics.HostMetrics()
+    for seconds in (0.01, 100.0, 500.0):
+        s = metrics.Sample()
+        s.add('total', seconds)
+        s.add('transfer', seconds)
+        m.add(s)
+
+    snap = json.loads(json.dumps(m.snapshot(), allow_nan = False))
+    assert snap['requests'] == 3
+    assert snap['latency']['total']['p99'] == metrics.buckets[-1]
+    assert snap['latency']['dns']['p50'] is None
+
+def testListenerErrors(monkeypatch):
+    monkeypatch.setattr(metrics, 'hosts', {})
+    monkeypatch.setattr(metrics, 'listeners', [])
+    monkeypatch.setattr(metrics, 'listenerErrors', 0)
+    monkeypatch.setattr(tracker, 'breakers', {})
+
+    seen = []
+    def broken(host, sample):
+        raise ValueError, 'exporter is down'
+    metrics.addListener(broken)
+    metrics.addListener(lambda host, sample: seen.append((host, sample.error)))
+
+    # Dropped, and the listeners after still called
+    metrics.record('http://t.example.com/announce', metrics.newSample())
+    assert metrics.listenerErrors == 1
+    assert seen == [('http://t.example.com:80', None)]
+
+    # Nor does it fail an announce
+    mock = mocktracker.MockTracker(seed = 1)
+    mock.start()
+    try:
+        tr = tracker.Tracker(mock.announceURL(), None, '-TS0001-000000000000', 6881)
+        tr.pool = connection.ConnectionPool(timeout = 5)
+        tr.announce(sha1('x').digest(), 0, 0, 100, tracker.EVENT_START, 50)
+        assert tr.numFailures == 0 and tr.interval == 1800
+    finally:
+        mock.stop()
+    assert metrics.listenerErrors == 2
+    assert len(seen) == 2
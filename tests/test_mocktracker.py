@@ -0,0 +1,192 @@
+"""
+Tests of the tracker client against a
+MockTracker: connection reuse, circuit
+breaking, timeouts, error responses and
+announcing for many torrents at once.
+"""
+
+import socket, time
+from hashlib import sha1
+import pytest
+from bt import connection, mocktracker, tracker
+
+infoHash = sha1('mock').digest()
+
+@pytest.fixture
+def mock(monkeypatch):
+    monkeypatch.setattr(tracker, 'breakers', {})
+    m = mocktracker.MockTracker(seed = 1)
+    m.start()
+    yield m
+    m.stop()
+
+def newTracker(mock, peer = 0):
+    tr = tracker.Tracker(mock.announceURL(), None, '-TS0001-%012d' % peer, 6881 + peer)
+    tr.pool = connection.ConnectionPool(timeout = 5)
+    return tr
+
+def announce(tr, timeout = None):
+    return tr.announce(infoHash, 0, 0, 100, tracker.EVENT_UPDATE, 50, timeout)
+
+def fails(tr, timeout = None):
+    try:
+        announce(tr, timeout)
+    except Exception, msg:
+        return str(msg)
+    assert False, 'no exception raised'
+
+def testKeepAlive(mock):
+    tr = newTracker(mock)
+    for i in xrange(5):
+        announce(tr)
+    assert mock.stats['announces'] == 5
+    assert mock.stats['connects'] == 1
+    assert (tr.pool.connects, tr.pool.reuses) == (1, 4)
+
+def testReconnect(mock):
+    tr = newTracker(mock)
+    announce(tr)
+
+    # The server drops the idle connection
+    mock.http.closeAll()
+    announce(tr)
+    assert mock.stats['announces'] == 2
+    assert mock.stats['connects'] == 2
+    assert (tr.pool.connects, tr.pool.reuses) == (2, 1)
+
+def testErrorResponse(mock):
+    tr = newTracker(mock)
+    mock.errorRate = 1.0
+    assert 'HTTP Error 500' in fails(tr)
+    assert tr.pool.busy == {}
+
+    # The connection was kept
+    mock.errorRate = 0.0
+    announce(tr)
+    assert mock.stats['connects'] == 1
+    assert tr.numFailures == 1 and tr.numRequests == 2
+
+def testBreaker(mock, monkeypatch):
+    monkeypatch.setattr(tracker, 'breakerThreshold', 2)
+    monkeypatch.setattr(tracker, 'breakerCooldown', 0.2)
+    monkeypatch.setattr(tracker, 'breakerJitter', 0.0)
+    tr = newTracker(mock)
+    breaker = tracker.breakerFor(mock.announceURL())
+
+    mock.errorRate = 1.0
+    fails(tr)
+    assert not breaker.isOpen()
+    fails(tr)
+    assert breaker.isOpen()
+
+    # Fails fast, without reaching the tracker
+    assert 'Tracker host is down' in fails(tr)
+    assert mock.stats['errors'] == 2
+    assert breaker.rejected == 1
+
+    # Half open: the one request let through
+    # fails, and the cooldown doubles
+    time.sleep(0.25)
+    assert 'HTTP Error 500' in fails(tr)
+    assert mock.stats['errors'] == 3
+    assert breaker.isOpen() and breaker.cooldown == 0.4
+    assert 'Tracker host is down' in fails(tr)
+
+    # Then succeeds, closing the breaker
+    mock.errorRate = 0.0
+    time.sleep(0.45)
+    announce(tr)
+    assert not breaker.isOpen() and breaker.cooldown == 0.2
+    announce(tr)
+
+def testTimeout(mock):
+    tr = newTracker(mock)
+    mock.latency = 1.0
+
+    start = time.time()
+    assert 'timed out' in fails(tr, 0.2)
+    assert time.time() - start < 0.8
+    assert tr.pool.busy == {}
+
+    # Waiting for a connection is bounded too
+    tr.pool.maxPerHost = 1
+    held = tr.pool.get(mock.announceURL() + '?info_hash=x')
+    try:
+        start = time.time()
+        assert 'Timed out waiting' in fails(tr, 0.2)
+        assert time.time() - start < 0.8
+    finally:
+        held.close()
+
+def testFailureKinds(mock, monkeypatch):
+    monkeypatch.setattr(tracker, 'breakerThreshold', 2)
+    tr = newTracker(mock)
+    assert tr.lastFailureKind == ''
+
+    mock.failureRate = 1.0
+    fails(tr)
+    assert tr.lastFailure == 'Tracker Error: Injected failure'
+    assert tr.lastFailureKind == 'failure reason'
+
+    mock.failureRate = 0.0
+    mock.latency = 0.5
+    fails(tr, 0.1)
+    assert tr.lastFailureKind == 'timeout'
+
+    # The timeout was the first failure in a row
+    mock.latency = 0.0
+    mock.errorRate = 1.0
+    fails(tr)
+    assert tr.lastFailureKind == 'http'
+    assert 'Tracker host is down' in fails(tr)
+    assert tr.lastFailureKind == 'breaker open'
+
+    # Kept until the next failure
+    tracker.breakers.clear()
+    mock.errorRate = 0.0
+    announce(tr)
+    assert tr.lastFailureKind == 'breaker open'
+
+    for msg, kind in (('Unrecognizable response: Parse Error: Unexpected EOF', 'decode'),
+                      ('Tracker Error: Peers list is malformed', 'decode'),
+                      ('Announce response is too short', 'decode'),
+                      ('Tracker did not respond', 'timeout'),
+                      ('[Errno 111] Connection refused', 'failure reason')):
+        assert tracker.failureKind(Exception(msg)) == kind
+    assert tracker.failureKind(socket.error(111, 'Connection refused')) == 'http'
+    assert tracker.failureKind(socket.timeout('timed out')) == 'timeout'
+
+def testAnnounceMany(mock):
+    mock.latency = 0.2
+    trackers = [newTracker(mock, i) for i in xrange(20)]
+    # A url that isn't a tracker's, and
+    # a tracker that isn't up
+    trackers[5].tracker = mock.announceURL().replace('announce', 'bogus')
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    trackers[12].tracker = 'http://127.0.0.1:%d/announce' % s.getsockname()[1]
+    s.close()
+    announces = [(tr, infoHash, 0, 0, 100, tracker.EVENT_START, 50)
+                    for tr in trackers]
+
+    calls = []
+    start = time.time()
+    results = tracker.announceMany(announces, workers = 10, timeout = 2,
+                                   progress = lambda *a: calls.append(a))
+
+    # Two rounds of 10, not 20 one after another
+    assert time.time() - start < 2.0
+    assert sorted(calls) == [(i, 20) for i in xrange(1, 21)]
+
+    assert 'HTTP Error 404' in str(results[5])
+    assert trackers[5].interval is None and trackers[5].numFailures == 1
+    assert 'Connection refused' in str(results[12])
+    for i in xrange(20):
+        if i in (5, 12):
+            continue
+        assert results[i] is None
+        assert trackers[i].interval == 1800
+        assert trackers[i].lastFailure == ''
+    assert mock.stats['announces'] == 18
+    assert len(mock.swarms[infoHash]) == 18
+    assert tracker.announceMany([]) == []
@@ -0,0 +1,115 @@
+"""
+Tests of the peer store: merging peers
+from several trackers, expiry, eviction
+and backing off after failures.
+"""
+
+from hashlib import sha1
+from bt import peers, state, torrent
+
+def makePeers(n, base = 0):
+    return [('10.0.%d.%d' % ((base + i) / 256, (base + i) % 256), 6881)
+                for i in xrange(n)]
+
+def testDedupAcrossSources():
+    store = peers.PeerStore()
+    assert store.add(makePeers(3), now = 100) == 3
+    assert store.add(makePeers(2) + [('::1', 6881)], now = 200) == 1
+
+    assert len(store) == 4
+    info = store.info(('10.0.0.0', 6881))
+    assert info['timesSeen'] == 2
+    assert info['firstSeen'] == 100
+    assert info['lastSeen'] == 200
+    assert store.info(('10.0.0.2', 6881))['timesSeen'] == 1
+
+    # Most recently seen first, each once
+    got = store.candidates(10, now = 200)
+    assert len(got) == 4
+    assert set(got[:3]) == set(makePeers(2) + [('::1', 6881)])
+    assert got[3] == ('10.0.0.2', 6881)
+    assert store.candidates(10, now = 200) == []
+
+def testExpiry():
+    store = peers.PeerStore(ttl = 100)
+    store.add(makePeers(3), now = 0)
+    store.add(makePeers(1), now = 50)
+    store.connected(('10.0.0.2', 6881))
+
+    assert store.expire(now = 120) == 1
+    assert ('10.0.0.0', 6881) in store
+    assert ('10.0.0.1', 6881) not in store
+    # Connected peers stay
+    assert ('10.0.0.2', 6881) in store
+
+    # Stale peers aren't handed out
+    assert store.candidates(10, now = 200) == []
+    assert ('10.0.0.0', 6881) not in store
+
+def testEvictWhenFullOfActivePeers():
+    store = peers.PeerStore(maxPeers = 10, maxActive = 4)
+    store.add(makePeers(10), now = 0)
+
+    busy = store.candidates(10, now = 0)
+    assert len(busy) == 4
+    for peer in busy[:2]:
+        store.connected(peer)
+
+    # New peers push out the stalest idle ones,
+    # never those being connected to
+    assert store.add(makePeers(6, base = 100), now = 10) == 6
+    assert len(store) == 10
+    for peer in busy + makePeers(6, base = 100):
+        assert peer in store
+
+    # Failed peers go before merely stale ones
+    store.failed(busy[2], now = 20)
+    assert store.add(makePeers(1, base = 200), now = 30) == 1
+    assert busy[2] not in store
+    assert busy[3] in store
+
+def testBackoff():
+    store = peers.PeerStore(retryDelay = 60)
+    peer = ('10.0.0.1', 6881)
+    store.add([peer], now = 0)
+
+    # Each failure doubles the wait
+    for failures, now, retryAt in ((1, 0, 60), (2, 60, 180), (3, 180, 420)):
+        assert store.candidates(1, now = now) == [peer]
+        store.failed(peer, now = now)
+        info = store.info(peer)
+        assert info['failures'] == failures
+        assert info['retryAt'] == retryAt
+        assert store.candidates(1, now = retryAt - 1) == []
+
+    # A connection clears the failures
+    assert store.candidates(1, now = 420) == [peer]
+    store.connected(peer)
+    store.disconnected(peer, now = 500)
+    assert store.info(peer)['failures'] == 0
+    assert store.candidates(1, now = 500) == [peer]
+
+def testStateReportsOutcomes():
+    tor = torrent.Torrent({
+        'announce'  :   'http://tracker.example.com/announce',
+        'info'      :   {
+            'name'          :   'test',
+            'piece length'  :   2**18,
+            'pieces'        :   sha1('test').digest(),
+            'length'        :   2**18
+        }
+    })
+    st = state.State(tor, '-TS0001-000000000000', 6881)
+    st.peers.add(makePeers(2))
+
+    first, second = st.nextPeers(2)
+    assert st.nextPeers(2) == []
+    st.peerConnected(first)
+    st.peerFailed(second)
+    assert st.peers.info(first)['status'] == peers.PEER_CONNECTED
+    assert st.peers.info(second)['failures'] == 1
+
+    st.peerDisconnected(first)
+    assert st.peers.info(first)['status'] == peers.PEER_READY
+    assert st.nextPeers(2) == [first]
+    assert st.peers.active == set([peers.peerKey(*first)])
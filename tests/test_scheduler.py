@@ -0,0 +1,158 @@
+"""
+Tests of the announce scheduler: intervals,
+jitter, retries and batching by tracker host.
+"""
+
+import threading, time
+from bt import connection, scheduler
+
+class Tracker:
+    def __init__(self, url, pool):
+        self.tracker = url
+        self.pool = pool
+        self.interval = None
+        self.minInterval = None
+
+class State:
+    """
+    Stands in for a bt.state.State, recording
+    when it was announced and how many of its
+    kind were announcing at once.
+    """
+
+    lock = threading.Lock()
+    running = {}
+    mostRunning = {}
+
+    def __init__(self, url = 'http://tracker.example.com/announce',
+                 pool = None, latency = 0.0, fail = False):
+        self.tracker = Tracker(url, pool or connection.ConnectionPool())
+        self.latency = latency
+        self.fail = fail
+        self.calls = []
+
+    def trackerScrape(self, numPeers):
+        self.__announce('started')
+
+    def trackerUpdate(self, numPeers):
+        self.__announce('')
+
+    def __announce(self, event):
+        self.calls.append((time.time(), event))
+        host = self.tracker.tracker
+
+        State.lock.acquire()
+        State.running[host] = State.running.get(host, 0) + 1
+        State.mostRunning[host] = max(State.mostRunning.get(host, 0),
+                                      State.running[host])
+        State.lock.release()
+
+        time.sleep(self.latency)
+
+        State.lock.acquire()
+        State.running[host] -= 1
+        State.lock.release()
+
+        if self.fail:
+            raise Exception, 'Tracker is down'
+
+def waitFor(test, timeout = 5.0):
+    end = time.time() + timeout
+    while not test():
+        assert time.time() < end, 'timed out'
+        time.sleep(0.01)
+
+def announced(sched, state, interval = None, minInterval = None):
+    """
+    Runs a State's first announce, and returns
+    how long until its next one is due.
+    """
+
+    state.tracker.interval = interval
+    state.tracker.minInterval = minInterval
+    done = []
+    sched.onAnnounce = lambda st, error: done.append(time.time())
+    sched.add(state)
+    sched.start()
+    try:
+        waitFor(lambda: done and sched.nextAnnounce(state) is not None)
+    finally:
+        sched.stop()
+    return sched.nextAnnounce(state) - done[0]
+
+def testInterval():
+    st = State()
+    assert 99.9 < announced(scheduler.Scheduler(jitter = 0.0), st, 100) <= 100.0
+    assert st.calls[0][1] == 'started'
+
+    st = State()
+    left = announced(scheduler.Scheduler(jitter = 0.0), st)
+    assert scheduler.defaultInterval - 0.1 < left <= scheduler.defaultInterval
+
+def testJitter():
+    lefts = [announced(scheduler.Scheduler(jitter = 0.5), State(), 100)
+                for i in xrange(20)]
+    assert min(lefts) >= 49.9 and max(lefts) <= 100.0
+    assert max(lefts) - min(lefts) > 5.0
+
+def testMinInterval():
+    sched = scheduler.Scheduler(jitter = 0.5, window = 2.0)
+    left = announced(sched, State(), 10, 60)
+    assert 61.9 < left <= 62.0
+
+def testBackoff():
+    sched = scheduler.Scheduler(jitter = 0.0, window = 0.0,
+                                retryInterval = 0.05, maxRetryInterval = 0.2)
+    st = State(fail = True)
+    sched.add(st)
+    sched.start()
+    try:
+        waitFor(lambda: len(st.calls) >= 6)
+    finally:
+        sched.stop()
+
+    times = [t for t, event in st.calls]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    for gap, expected in zip(gaps, [0.05, 0.1, 0.2, 0.2, 0.2]):
+        assert expected - 0.01 < gap < expected + 0.05
+    assert sched.failures >= 6
+    assert [event for t, event in st.calls] == ['started'] * len(st.calls)
+
+def testBatchesPerHost():
+    State.running.clear()
+    State.mostRunning.clear()
+
+    pool = connection.ConnectionPool(maxPerHost = 4)
+    states = [State('http://a.example.com/announce', pool, 0.05) for i in xrange(40)]
+    states += [State('http://b.example.com/announce', pool, 0.05) for i in xrange(8)]
+
+    sched = scheduler.Scheduler(workers = 16)
+    for st in states:
+        sched.add(st)
+    start = time.time()
+    sched.start()
+    try:
+        waitFor(lambda: sched.announces == len(states))
+    finally:
+        sched.stop()
+    seconds = time.time() - start
+
+    # 4 announces at a time to each host
+    assert State.mostRunning == { 'http://a.example.com/announce' : 4,
+                                  'http://b.example.com/announce' : 4 }
+    assert sched.batches == 8
+    assert seconds < 40 * 0.05 / 2
+
+    # Or as many as asked for
+    State.mostRunning.clear()
+    states = [State('http://a.example.com/announce', pool, 0.05) for i in xrange(10)]
+    sched = scheduler.Scheduler(workers = 16, perHost = 2)
+    for st in states:
+        sched.add(st)
+    sched.start()
+    try:
+        waitFor(lambda: sched.announces == len(states))
+    finally:
+        sched.stop()
+    assert State.mostRunning == { 'http://a.example.com/announce' : 2 }
+    assert sched.batches == 2
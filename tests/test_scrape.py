@@ -0,0 +1,115 @@
+"""
+Tests of scraping: scrape URLs, asking about
+many torrents at once and grouping scrapes
+by tracker, against a MockTracker.
+"""
+
+from hashlib import sha1
+import pytest
+from bt import connection, mocktracker, tracker
+
+def hashes(n, base = 0):
+    return [sha1('scrape %d' % i).digest() for i in xrange(base, base + n)]
+
+@pytest.fixture
+def mock(monkeypatch):
+    monkeypatch.setattr(tracker, 'breakers', {})
+    m = mocktracker.MockTracker(seed = 1)
+    m.start()
+    yield m
+    m.stop()
+
+def populate(mock, infoHashes):
+    """
+    Gives each torrent a seed and,
+    for every other, a leecher.
+    """
+
+    for i in xrange(len(infoHashes)):
+        mock.announce(infoHashes[i], 'seed', '10.0.0.1', 6881, 0, 'completed', 0)
+        if i % 2:
+            mock.announce(infoHashes[i], 'leech', '10.0.0.2', 6881, 100, 'started', 0)
+
+def newTracker(url, peer = 0):
+    tr = tracker.Tracker(url, None, '-TS0001-%012d' % peer, 6881)
+    tr.pool = connection.ConnectionPool(timeout = 5)
+    return tr
+
+def testScrapeURL():
+    for url, surl in (
+            ('http://t.example.com/announce', 'http://t.example.com/scrape'),
+            ('http://t.example.com:8080/x/announce.php?passkey=a',
+                'http://t.example.com:8080/x/scrape.php?passkey=a'),
+            ('http://t.example.com/announce/x', None),
+            ('http://t.example.com/a', None),
+            ('http://t.example.com/x/tracker', None),
+            ('udp://t.example.com:80/announce', 'udp://t.example.com:80/announce')):
+        assert tracker.scrapeURL(url) == surl
+
+def testScrapeManyHashes(mock):
+    infoHashes = hashes(3)
+    populate(mock, infoHashes)
+    pool = connection.ConnectionPool(timeout = 5)
+
+    url = mock.announceURL() + '?passkey=abc'
+    stats = tracker.scrape(url, infoHashes + hashes(1, 3), pool = pool)
+    assert mock.stats['scrapes'] == 1
+    assert stats == {
+        infoHashes[0]   :   { 'complete' : 1, 'downloaded' : 1, 'incomplete' : 0 },
+        infoHashes[1]   :   { 'complete' : 1, 'downloaded' : 1, 'incomplete' : 1 },
+        infoHashes[2]   :   { 'complete' : 1, 'downloaded' : 1, 'incomplete' : 0 }
+    }
+
+def testGroupByScrapeURL(mock):
+    infoHashes = hashes(60)
+    populate(mock, infoHashes)
+
+    # Two trackers per torrent, all on the one
+    # tracker: 60 torrents, in batches of 50
+    scrapes = [(newTracker(mock.announceURL(), i), infoHashes[i / 2])
+                    for i in xrange(120)]
+    calls = []
+    results = tracker.scrapeMany(scrapes, progress = lambda *a: calls.append(a))
+
+    assert results == [None] * 120
+    assert mock.stats['scrapes'] == 2
+    assert sorted(calls) == [(1, 2), (2, 2)]
+    for i in xrange(120):
+        tr = scrapes[i][0]
+        assert (tr.complete, tr.incomplete, tr.timesDownloaded) == (1, (i / 2) % 2, 1)
+
+def testNoScrapeURL(mock):
+    infoHashes = hashes(2)
+    populate(mock, infoHashes)
+    scrapes = [(newTracker('http://127.0.0.1:%d/tracker' % mock.port), infoHashes[0]),
+               (newTracker(mock.announceURL()), infoHashes[1])]
+
+    results = tracker.scrapeMany(scrapes)
+    assert 'Scraping is not supported' in str(results[0])
+    assert scrapes[0][0].complete is None
+    assert results[1] is None and scrapes[1][0].incomplete == 1
+    assert mock.stats['scrapes'] == 1
+
+    # Nothing to ask at all
+    assert tracker.scrapeMany(scrapes[:1])[0] is not None
+    assert mock.stats['scrapes'] == 1
+
+def testPartialFiles(mock):
+    known, unknown = hashes(2), hashes(2, 2)
+    populate(mock, known)
+    scrapes = [(newTracker(mock.announceURL(), i), h)
+                    for i, h in enumerate(known + unknown)]
+
+    results = tracker.scrapeMany(scrapes)
+    assert mock.stats['scrapes'] == 1
+    assert results[:2] == [None, None]
+    for i in (2, 3):
+        assert 'Torrent not found' in str(results[i])
+        assert scrapes[i][0].complete is None
+    assert scrapes[1][0].incomplete == 1
+
+    # A failed request fails each of its scrapes
+    mock.errorRate = 1.0
+    results = tracker.scrapeMany(scrapes)
+    for err in results:
+        assert 'HTTP Error 500' in str(err)
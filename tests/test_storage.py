@@ -0,0 +1,51 @@
+"""
+Tests of grouping pieces into hashing tasks,
+and of verifying downloaded data on disk.
+"""
+
+import os
+from bt import storage, torrent
+
+def writeFiles(tmpdir, sizes):
+    root = tmpdir.mkdir('data')
+    for i in xrange(len(sizes)):
+        root.join('f%d' % i).write(''.join([chr((i + j) % 251)
+                                            for j in xrange(sizes[i])]), 'wb')
+    return str(root)
+
+def testTasks():
+    fileIndex = storage.FileIndex([10, 0, 25, 5], 16)
+    paths = ['a', 'b', 'c', 'd']
+
+    old = storage.taskSize
+    storage.taskSize = 32
+    try:
+        work = list(storage.tasks(paths, fileIndex))
+        part = list(storage.tasks(paths, fileIndex, 1, 2))
+    finally:
+        storage.taskSize = old
+
+    assert [first for first, task in work] == [0, 2]
+    assert work[0][1] == [[('a', 0, 10), ('c', 0, 6)], [('c', 6, 16)]]
+    assert work[1][1] == [[('c', 22, 3), ('d', 0, 5)]]
+    assert part == [(1, [[('c', 6, 16)]])]
+
+def testVerify(tmpdir):
+    root = writeFiles(tmpdir, [10, 0, 25, 5])
+    tor = torrent.makeTorrent(root, 16, ['http://tracker.example.com/announce'],
+                              workers = 2)
+    assert tor.fileIndex.numPieces == len(tor.pieces) == 3
+
+    bitfield, completion = storage.verify(tor, os.path.dirname(root), workers = 2)
+    assert bitfield.complete()
+    assert completion == [1.0, 1.0, 1.0, 1.0]
+
+    # Damage the middle of the third file, in the second piece
+    fd = open(os.path.join(root, 'f2'), 'r+b')
+    fd.seek(10)
+    fd.write('x')
+    fd.close()
+
+    bitfield, completion = storage.verify(tor, os.path.dirname(root), workers = 2)
+    assert [bitfield[i] for i in xrange(3)] == [True, False, True]
+    assert completion == [1.0, 1.0, 9.0 / 25, 1.0]
@@ -0,0 +1,172 @@
+"""
+Tests of announcing to a torrent's tiers of
+trackers (BEP 12) against MockTrackers:
+falling over, shuffling, ranking by latency
+and racing trackers.
+"""
+
+import random, socket, threading, time
+from hashlib import sha1
+import pytest
+from bt import connection, mocktracker, tracker
+
+infoHash = sha1('tiers').digest()
+
+@pytest.fixture
+def mocks(monkeypatch):
+    monkeypatch.setattr(tracker, 'breakers', {})
+    monkeypatch.setattr(tracker, 'trackerStats', {})
+    started = []
+    def start(**kw):
+        m = mocktracker.MockTracker(seed = len(started), **kw)
+        m.start()
+        started.append(m)
+        return m
+    yield start
+    for m in started:
+        m.stop()
+
+def deadURL():
+    """
+    The url of a tracker nothing listens at.
+    """
+
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/announce' % port
+
+def newTracker(tiers):
+    tr = tracker.Tracker(tiers[0][0], tiers, '-TS0001-000000000000', 6881)
+    tr.pool = connection.ConnectionPool(timeout = 5, connectTimeout = 1)
+    return tr
+
+def announce(tr, timeout = 2):
+    return tr.announce(infoHash, 0, 0, 100, tracker.EVENT_UPDATE, 50, timeout)
+
+def testDeadTierFallsOver(mocks):
+    a, b = mocks(), mocks()
+    dead = [deadURL(), deadURL()]
+    tr = newTracker([dead, [a.announceURL(), b.announceURL()]])
+
+    announce(tr)
+    assert tr.tracker in (a.announceURL(), b.announceURL())
+    assert a.stats['announces'] + b.stats['announces'] == 1
+    for url in dead:
+        assert tracker.statsFor(url).consecutiveFailures == 1
+    assert tr.numFailures == 0
+
+    # Every tier down
+    a.stop()
+    b.stop()
+    tr = newTracker([dead, [a.announceURL(), b.announceURL()]])
+    try:
+        announce(tr)
+    except Exception, msg:
+        assert 'No tracker responded' in str(msg)
+        for url in dead + [a.announceURL(), b.announceURL()]:
+            assert url in str(msg)
+    else:
+        assert False, 'no exception raised'
+
+def testShuffleAndPromotion(mocks):
+    live = mocks()
+    urls = [deadURL(), deadURL(), live.announceURL()]
+
+    # Each tier is shuffled, trackers kept
+    orders = set()
+    for seed in xrange(20):
+        random.seed(seed)
+        tr = newTracker([urls[:], ['http://backup.example.com/announce']])
+        assert sorted(tr.tiers[0]) == sorted(urls)
+        assert tr.tiers[1] == ['http://backup.example.com/announce']
+        orders.add(tuple(tr.tiers[0]))
+    assert len(orders) > 1
+
+    # The tracker that responds moves to the
+    # front of its tier, the others keep order
+    tr.preferFast = False
+    tr.tiers[0] = urls[:]
+    announce(tr)
+    assert tr.tiers[0] == [live.announceURL()] + urls[:2]
+    assert tr.tracker == live.announceURL()
+
+    # and is asked first from then on
+    announce(tr)
+    assert live.stats['announces'] == 2
+    for url in urls[:2]:
+        assert tracker.statsFor(url).requests == 1
+
+def testLatencyRanking(mocks):
+    slow, fast = mocks(latency = 0.1), mocks()
+
+    stats = tracker.statsFor(slow.announceURL())
+    for latency in (0.1, 0.3):
+        stats.succeeded(latency)
+    assert abs(stats.latency - (0.1 + tracker.latencyWeight * 0.2)) < 1e-9
+
+    tr = newTracker([[slow.announceURL(), fast.announceURL()]])
+    tr.tiers[0] = [slow.announceURL(), fast.announceURL()]
+
+    # Not heard from yet: after the known to work
+    announce(tr)
+    assert slow.stats['announces'] == 1 and fast.stats['announces'] == 0
+
+    # Measured faster: first, despite BEP 12 order
+    tracker.statsFor(fast.announceURL()).succeeded(0.01)
+    for i in xrange(3):
+        announce(tr)
+    assert slow.stats['announces'] == 1 and fast.stats['announces'] == 3
+    assert tr.tiers[0][0] == fast.announceURL()
+
+    # Failing: last, however fast
+    fast.errorRate = 1.0
+    try:
+        announce(tr)
+    except Exception:
+        assert False, 'slow tracker not tried'
+    assert tracker.statsFor(fast.announceURL()).consecutiveFailures == 1
+    announce(tr)
+    assert fast.stats['errors'] == 1 and slow.stats['announces'] == 3
+
+def testRace(mocks):
+    slow, fast = mocks(latency = 0.5), mocks()
+    urls = [deadURL(), slow.announceURL(), fast.announceURL()]
+    tr = newTracker([urls])
+    tr.race = 3
+
+    before = threading.activeCount()
+    start = time.time()
+    announce(tr)
+    assert time.time() - start < 0.4
+    assert tr.tracker == fast.announceURL()
+    assert tr.tiers[0][0] == fast.announceURL()
+
+    # The losers finish in the background,
+    # counting towards their statistics
+    stats = tracker.statsFor(slow.announceURL())
+    end = time.time() + 2
+    while stats.requests == 0 and time.time() < end:
+        time.sleep(0.01)
+    assert stats.requests == 1 and stats.failures == 0
+    assert slow.stats['announces'] == 1
+
+    # and no thread is left behind, once the
+    # trackers drop the kept alive connections
+    slow.http.closeAll()
+    fast.http.closeAll()
+    end = time.time() + 2
+    while threading.activeCount() > before and time.time() < end:
+        time.sleep(0.01)
+    assert threading.activeCount() <= before
+    assert tracker.statsFor(urls[0]).consecutiveFailures == 1
+
+    # Every racer failing fails the tier
+    slow.errorRate = fast.errorRate = 1.0
+    try:
+        announce(tr)
+    except Exception, msg:
+        assert 'HTTP Error 500' in str(msg) and urls[0] in str(msg)
+    else:
+        assert False, 'no exception raised'
@@ -0,0 +1,158 @@
+"""
+Tests of Torrent parsing, lazy and cached
+loading, and round trips back to bencode.
+"""
+
+import os, copy, pickle
+from hashlib import sha1
+from bt import bencode, cache, torrent
+
+def makeDict(numFiles = 3, pieceLen = 32):
+    files = [{ 'length' : long(10 + 17 * i), 'path' : ['dir', 'f%d' % i] }
+                for i in xrange(numFiles)]
+    total = sum([f['length'] for f in files])
+    numPieces = (total + pieceLen - 1) / pieceLen
+    return {
+        'announce'      :   'http://tracker.example.com/announce',
+        'comment'       :   'test',
+        'info'          :   {
+            'name'          :   'test',
+            'piece length'  :   long(pieceLen),
+            'pieces'        :   ''.join([sha1(str(i)).digest()
+                                            for i in xrange(numPieces)]),
+            'files'         :   files
+        }
+    }
+
+def writeTorrent(tmpdir, name = 'test.torrent', d = None):
+    path = str(tmpdir.join(name))
+    fd = open(path, 'wb')
+    fd.write(bencode.encode(d or makeDict()))
+    fd.close()
+    return path
+
+def fileTable(t):
+    """
+    The files of a torrent, with the
+    piece ranges made comparable.
+    """
+
+    return [(f['path'], f['length'], f['md5sum'], list(f['pieces']))
+                for f in t.files]
+
+def openFiles():
+    return len(os.listdir('/proc/self/fd'))
+
+def testFromFile(tmpdir):
+    d = makeDict()
+    path = writeTorrent(tmpdir, d = d)
+    t = torrent.Torrent(path)
+    assert t.hash == sha1(bencode.encode(d['info'])).digest()
+    assert t.length == sum([f['length'] for f in d['info']['files']])
+    assert len(t.pieces) == len(d['info']['pieces']) / 20
+    assert t.toString() == open(path, 'rb').read()
+
+def testLazyMatchesEager(tmpdir):
+    path = writeTorrent(tmpdir)
+    t = torrent.Torrent(path)
+    l = torrent.Torrent(path, lazy = True)
+    assert l.hash == t.hash
+    assert l.length == t.length
+    assert fileTable(l) == fileTable(t)
+    assert l.pieces == t.pieces
+    assert l.toString() == t.toString()
+
+def testLazyLength(tmpdir, monkeypatch):
+    d = makeDict(numFiles = 20)
+    # Lengths elsewhere in the torrent don't count
+    d['info']['files'][3]['path'] = ['length', 'length']
+    d['extra'] = { 'files' : [{ 'length' : 5L }] }
+    path = writeTorrent(tmpdir, d = d)
+
+    def materialize(self, key = None):
+        assert False, 'materialized %s' % key
+    monkeypatch.setattr(bencode.LazyNode, 'materialize', materialize)
+
+    t = torrent.Torrent(path, lazy = True)
+    assert t.length == sum([f['length'] for f in d['info']['files']])
+    assert 'files' not in t.__dict__
+    assert 'torrentDict' not in t.__dict__
+
+def testCached(tmpdir):
+    path = writeTorrent(tmpdir)
+    c = cache.Cache(str(tmpdir.join('cache')))
+    t = torrent.Torrent(path, c)
+    r = torrent.Torrent(path, c)
+    assert r.hash == t.hash
+    assert fileTable(r) == fileTable(t)
+    assert r.toString() == t.toString()
+
+def testFilesNotKeptOpen(tmpdir):
+    if not os.path.isdir('/proc/self/fd'):
+        return
+    path = writeTorrent(tmpdir)
+    before = openFiles()
+    torrents = [torrent.Torrent(path) for i in xrange(50)]
+    lazy = [torrent.Torrent(path, lazy = True) for i in xrange(50)]
+    assert openFiles() == before
+
+    for t in lazy:
+        t.pieces
+        t.toString()
+    assert openFiles() == before
+
+def testCopyAndPickle(tmpdir):
+    path = writeTorrent(tmpdir)
+    for t in (torrent.Torrent(path), torrent.Torrent(path, lazy = True)):
+        for c in (copy.deepcopy(t), pickle.loads(pickle.dumps(t, 2))):
+            assert c.hash == t.hash
+            assert c.length == t.length
+            assert c.toString() == open(path, 'rb').read()
+
+def testToStringAfterChange(tmpdir):
+    path = writeTorrent(tmpdir)
+    t = torrent.Torrent(path)
+    t.comment = 'changed'
+    d = bencode.decode(t.toString())
+    assert d['comment'] == 'changed'
+    assert sha1(bencode.encode(d['info'])).digest() == t.hash
+
+def testInfoSpliced(tmpdir):
+    # Keys out of order, so that encoding the
+    # info dict again would change its hash
+    info = 'd4:name4:test12:piece lengthi32e6:pieces20:%s6:lengthi10ee' % \
+        sha1('0').digest()
+    path = str(tmpdir.join('unsorted.torrent'))
+    fd = open(path, 'wb')
+    fd.write('d8:announce35:http://tracker.example.com/announce4:info%se' % info)
+    fd.close()
+
+    t = torrent.Torrent(path)
+    assert t.hash == sha1(info).digest()
+
+    # Only the file's bytes are kept, not
+    # another copy of the info dict
+    raw = t._Torrent__raw
+    assert raw is t.torrentDict.source
+    assert [v for v in t.__dict__.values()
+                if isinstance(v, str) and info in v] == [raw]
+
+    t.comment = 'changed'
+    s = t.toString()
+    assert info in s
+    assert sha1(bencode.decodeLazy(s)['info'].raw()).digest() == t.hash
+
+    # Made from a dictionary, it is encoded
+    d = makeDict()
+    t = torrent.Torrent(d)
+    t.comment = 'changed'
+    assert bencode.decode(t.toString())['info'] == d['info']
+
+def testFileIndex():
+    index = torrent.FileIndex([10, 0, 25, 5], 16)
+    assert index.numPieces == 3
+    assert index.pieceSpans(0) == [(0, 0, 10), (2, 0, 6)]
+    assert index.pieceSpans(1) == [(2, 6, 16)]
+    assert index.pieceSpans(2) == [(2, 22, 3), (3, 0, 5)]
+    assert list(index.piecesForFile(2)) == [0, 1, 2]
+    assert list(index.piecesForFile(1)) == []
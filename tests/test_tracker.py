@@ -0,0 +1,143 @@
+"""
+Tests of reading tracker responses
+and decoding their peer lists.
+"""
+
+import socket, struct, zlib
+from bt import bencode, metrics, tracker
+
+class Response:
+    """
+    Stands in for a connection.Response.
+    """
+
+    def __init__(self, status, body = '', headers = {}, reason = 'OK'):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.headers = headers
+        self.closed = False
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name, default)
+
+    def read(self, n):
+        data = self.body[:n]
+        self.body = self.body[n:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+def testReadResponse():
+    res = { 'interval' : 1800, 'peers' : '' }
+    fd = Response(200, bencode.encode(res) + '\n')
+    sample = metrics.Sample()
+    assert tracker.readResponse(fd, sample) == res
+    assert fd.closed
+    assert 'gunzip' not in sample.phases
+    assert sample.decodedBytes == len(bencode.encode(res)) + 1
+
+def testReadGzipped():
+    res = { 'interval' : 1800, 'peers' : 'x' * 6000 }
+    z = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = z.compress(bencode.encode(res)) + z.flush()
+    fd = Response(200, body, { 'Content-Encoding' : 'gzip' })
+    sample = metrics.Sample()
+    assert tracker.readResponse(fd, sample) == res
+    assert 'gunzip' in sample.phases
+
+def testReadError():
+    fd = Response(500, 'oops', reason = 'Internal Server Error')
+    sample = metrics.Sample()
+    try:
+        tracker.readResponse(fd, sample)
+    except Exception, msg:
+        assert str(msg) == 'HTTP Error 500: Internal Server Error'
+    else:
+        assert False, 'no exception raised'
+    assert fd.closed
+    assert 'gunzip' not in sample.phases
+    assert sample.phases['decode'] == 0.0
+
+def testReadEmpty():
+    fd = Response(200, '')
+    try:
+        tracker.readResponse(fd)
+    except Exception, msg:
+        assert str(msg).startswith('Unrecognizable response')
+    else:
+        assert False, 'no exception raised'
+    assert fd.closed
+
+def compact(ip, port):
+    return socket.inet_aton(ip) + struct.pack('!H', port)
+
+def compact6(ip, port):
+    return socket.inet_pton(socket.AF_INET6, ip) + struct.pack('!H', port)
+
+def fails(f, *args):
+    try:
+        f(*args)
+    except Exception, msg:
+        return str(msg)
+    assert False, 'no exception raised'
+
+def testCompactPeers():
+    s = compact('10.0.0.1', 6881) + compact('192.168.1.255', 65535)
+    assert tracker.decodeCompactPeers(s) == [('10.0.0.1', 6881), ('192.168.1.255', 65535)]
+    assert tracker.decodeCompactPeers('') == []
+
+    # Truncated
+    for n in (1, 5, 7, 11):
+        assert 'malformed' in fails(tracker.decodeCompactPeers, s[:n])
+
+def testCompactPeers6():
+    s = compact6('2001:db8::1', 6881) + compact6('::ffff:10.0.0.1', 1)
+    assert tracker.decodeCompactPeers6(s) == [('2001:db8::1', 6881), ('::ffff:10.0.0.1', 1)]
+    assert tracker.decodeCompactPeers6('') == []
+
+    # Truncated, or a v4 list
+    for n in (6, 17, 19, 35):
+        assert 'IPv6 peers list is malformed' in fails(tracker.decodeCompactPeers6, s[:n])
+
+def testDictPeers():
+    l = [{ 'ip' : '10.0.0.1', 'port' : 6881, 'peer id' : 'x' * 20 },
+         { 'ip' : 'peer.example.com', 'port' : 6882L }]
+    assert tracker.decodeDictPeers(l) == [('10.0.0.1', 6881), ('peer.example.com', 6882)]
+    assert tracker.decodeDictPeers([]) == []
+
+    for peer in ({ 'ip' : 167772161, 'port' : 6881 },
+                 { 'ip' : ['10.0.0.1'], 'port' : 6881 },
+                 { 'port' : 6881 },
+                 { 'ip' : '10.0.0.1', 'port' : '6881' },
+                 { 'ip' : '10.0.0.1' },
+                 '10.0.0.1:6881'):
+        assert 'Peers list is malformed' in fails(tracker.decodeDictPeers, l + [peer])
+
+def testMergePeers():
+    peers6 = compact6('2001:db8::1', 6881)
+    compressed, peers = tracker.decodePeers({
+        'peers'     :   compact('10.0.0.1', 6881),
+        'peers6'    :   peers6
+    })
+    assert compressed
+    assert peers == [('10.0.0.1', 6881), ('2001:db8::1', 6881)]
+
+    # Dict peers with v6 peers are compact too
+    compressed, peers = tracker.decodePeers({
+        'peers'     :   [{ 'ip' : '10.0.0.2', 'port' : 1 }],
+        'peers6'    :   peers6
+    })
+    assert compressed
+    assert peers == [('10.0.0.2', 1), ('2001:db8::1', 6881)]
+
+    assert tracker.decodePeers({ 'peers' : [] }) == (False, [])
+    assert tracker.decodePeers({ 'peers6' : peers6 }) == (True, [('2001:db8::1', 6881)])
+    assert tracker.decodePeers({}) == (False, [])
+
+    assert 'Peers list is malformed' in fails(tracker.decodePeers, { 'peers' : 1 })
+    assert 'IPv6 peers list is malformed' in \
+        fails(tracker.decodePeers, { 'peers' : '', 'peers6' : [] })
+    assert 'IPv6 peers list is malformed' in \
+        fails(tracker.decodePeers, { 'peers' : '', 'peers6' : peers6[:-1] })
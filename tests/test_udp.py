@@ -0,0 +1,169 @@
+"""
+Tests of the UDP tracker client against
+a scripted responder running in process.
+"""
+
+import socket, struct, threading, time
+import pytest
+from bt import udp
+
+infoHash = '\x01' * 20
+peerID = '-TS0001-000000000000'
+
+class Responder:
+    """
+    Answers UDP tracker requests, dropping the
+    ones `drop(action, n)' is true for, `n'
+    counting the requests seen with that
+    action.  Every request is kept in
+    `requests' as (time, connectionID,
+    action, body).
+    """
+
+    def __init__(self, host = '127.0.0.1', family = socket.AF_INET):
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.port = self.sock.getsockname()[1]
+
+        self.drop = lambda action, n: False
+        self.error = None
+        self.peers = '\x0a\x00\x00\x01\x1a\xe1'
+        self.requests = []
+        self.nextID = 1000
+
+        t = threading.Thread(target = self.serve)
+        t.setDaemon(True)
+        t.start()
+
+    def seen(self, action):
+        return [r for r in self.requests if r[2] == action]
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except socket.error:
+                return
+            connectionID, action, tid = struct.unpack('!QII', data[:16])
+            self.requests.append((time.time(), connectionID, action, data[16:]))
+            if self.drop(action, len(self.seen(action))):
+                continue
+
+            if action == udp.ACTION_CONNECT:
+                self.nextID += 1
+                reply = struct.pack('!IIQ', action, tid, self.nextID)
+            elif self.error:
+                reply = struct.pack('!II', udp.ACTION_ERROR, tid) + self.error
+            else:
+                reply = struct.pack('!IIIII', action, tid, 1800, 3, 5) + self.peers
+            self.sock.sendto(reply, addr)
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def responder():
+    r = Responder()
+    yield r
+    r.close()
+
+def announce(client, timeout = 5):
+    return client.announce(infoHash, peerID, 0, 0, 100, '', 50, 6881,
+                           timeout = timeout)
+
+def testAnnounce(responder):
+    client = udp.Client('127.0.0.1', responder.port)
+    res = announce(client)
+    assert res == { 'interval' : 1800, 'complete' : 5, 'incomplete' : 3,
+                    'peers' : responder.peers }
+    assert [r[2] for r in responder.requests] == [udp.ACTION_CONNECT, udp.ACTION_ANNOUNCE]
+    assert responder.requests[0][1] == udp.protocolID
+
+def testRetransmit(responder, monkeypatch):
+    monkeypatch.setattr(udp, 'baseTimeout', 0.1)
+    client = udp.Client('127.0.0.1', responder.port)
+
+    # The first two connects and the first announce are lost
+    responder.drop = lambda action, n: \
+        (action == udp.ACTION_CONNECT and n <= 2) or \
+        (action == udp.ACTION_ANNOUNCE and n == 1)
+    announce(client)
+    assert client.retransmits == 3
+
+    # Waiting 0.1, then 0.2 seconds, then 0.4
+    # for the announce (using the same ID)
+    connects = [r[0] for r in responder.seen(udp.ACTION_CONNECT)]
+    assert len(connects) == 3
+    assert 0.08 < connects[1] - connects[0] < 0.18
+    assert 0.18 < connects[2] - connects[1] < 0.3
+    announces = responder.seen(udp.ACTION_ANNOUNCE)
+    assert len(announces) == 2
+    assert 0.38 < announces[1][0] - announces[0][0] < 0.55
+    assert announces[0][1] == announces[1][1] == responder.nextID
+
+def testGiveUp(responder, monkeypatch):
+    monkeypatch.setattr(udp, 'baseTimeout', 0.05)
+    monkeypatch.setattr(udp, 'maxRetries', 2)
+    client = udp.Client('127.0.0.1', responder.port)
+    responder.drop = lambda action, n: True
+
+    start = time.time()
+    with pytest.raises(Exception) as e:
+        announce(client, None)
+    assert 'did not respond' in str(e.value)
+    assert len(responder.requests) == 3
+    assert 0.3 < time.time() - start < 0.6
+
+    # The timeout cuts the retransmissions short
+    monkeypatch.setattr(udp, 'maxRetries', 8)
+    start = time.time()
+    with pytest.raises(Exception) as e:
+        announce(client, 0.12)
+    assert str(e.value) == 'timed out'
+    assert time.time() - start < 0.3
+
+def testConnectionIDReuse(responder, monkeypatch):
+    monkeypatch.setattr(udp, 'connectionLifetime', 0.3)
+    client = udp.Client('127.0.0.1', responder.port)
+
+    announce(client)
+    client.scrape([infoHash])
+    assert len(responder.seen(udp.ACTION_CONNECT)) == 1
+    ids = [r[1] for r in responder.requests[1:]]
+    assert ids == [responder.nextID] * 2
+    assert client.connects == 1
+
+    # Expired
+    time.sleep(0.35)
+    announce(client)
+    assert len(responder.seen(udp.ACTION_CONNECT)) == 2
+    assert responder.requests[-1][1] == responder.nextID
+    assert client.connects == 2
+
+def testError(responder):
+    client = udp.Client('127.0.0.1', responder.port)
+    announce(client)
+
+    responder.error = 'Torrent not registered'
+    with pytest.raises(Exception) as e:
+        announce(client)
+    assert str(e.value) == 'Torrent not registered'
+
+    # The connection ID is not trusted after an error
+    responder.error = None
+    announce(client)
+    assert len(responder.seen(udp.ACTION_CONNECT)) == 2
+
+def testPeers6():
+    try:
+        r = Responder('::1', socket.AF_INET6)
+    except socket.error:
+        pytest.skip('no IPv6')
+
+    try:
+        r.peers = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + '\x1a\xe1'
+        res = announce(udp.Client('::1', r.port))
+        assert res['peers'] == ''
+        assert res['peers6'] == r.peers
+    finally:
+        r.close()